@@ -1,17 +1,20 @@
 import argparse
+import hashlib
+import json
 import os
 import gc
 from multiprocessing import Pool
 import sys
-import time
 
 import numpy as np
 from Bio import SeqIO
-from Bio.Alphabet import generic_dna
-from Bio.Seq import Seq
 
 sys.path.append("../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number, get_word_dict_for_n_gram_alphabet
+from bgi.common.fasta_utils import load_fasta_index, read_fasta_region, strided_windows
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, codes_to_kmer_ids_both_strands
+from bgi.common.sequence_utils import check_sequence_codes
+from bgi.common.shard_utils import TOKEN_SHARD_SUFFIX, get_vocab_hash, write_token_shard
 
 atcg_dict = {
     'A': 1,
@@ -22,241 +25,155 @@ atcg_dict = {
 }
 
 
-def preccess_seq_chunks(seq_chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path, hg_name):
-    set_atcg = set(list('ATCG'))
-    slice_seq_num_data = []
-    for ii in range(0, len(seq_chunks), seq_stride):
-        if ii + seq_size <= len(seq_chunks):
-            seq = seq_chunks[ii:int(ii + seq_size)]
-            seq_number = []
-            for jj in range(0, len(seq), stride):
-                if jj + ngram <= len(seq):
-                    if word_dict is not None:
-                        seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
-
-            slice_seq_num_data.append(seq_number)
-
-            my_dna = Seq(seq, generic_dna)
-            seq_flip = str(my_dna.reverse_complement())
-            seq_list = []
-            seq_number = []
-            for jj in range(0, len(seq_flip), stride):
-                if jj + ngram <= len(seq_flip):
-                    if word_dict is not None:
-                        seq_number.append(word_dict.get(seq_flip[jj:jj + ngram], 0))
-                    # seq_list.append(seq[jj:jj+ngram])
-            slice_seq_num_data.append(seq_number)
-
-    save_dict = {
-        'data': slice_seq_num_data,
+def get_manifest_path(output_path, hg_name, ngram, stride):
+    return os.path.join(output_path, '{}_seq_gram_{}_stride_{}_manifest.json'.format(hg_name, str(ngram), str(stride)))
+
+
+def get_shard_name(hg_name, ngram, stride, chrom, start, shard_format='int16'):
+    # The name only depends on the region, so reruns overwrite the same shard
+    suffix = TOKEN_SHARD_SUFFIX if shard_format == 'int16' else '.npz'
+    return '{}_seq_gram_{}_stride_{}_slice_{}_{}{}'.format(hg_name, str(ngram), str(stride), chrom, str(start), suffix)
+
+
+def get_region_tasks(records, seq_size=1000, seq_stride=500, slice_size=100000, chroms=None):
+    """
+    Partition the genome by chromosome and offset range, each region holds at most slice_size windows
+    :param records: load_fasta_index(fname)
+    :param seq_size:
+    :param seq_stride:
+    :param slice_size:
+    :param chroms: Only these chromosomes, default all records
+    :return: [(record, start, end), ...], windows start in [start, end)
+    """
+    tasks = []
+    region_size = seq_stride * slice_size
+    for record in records:
+        if chroms is not None and record['name'] not in chroms:
+            continue
+        num_starts = record['length'] - seq_size + 1
+        for start in range(0, max(num_starts, 0), region_size):
+            tasks.append((record, start, min(start + region_size, num_starts)))
+    return tasks
+
+
+_worker_state = {}
+
+
+def init_worker(fname, word_dict, ngram):
+    # Every worker reads its own regions with its own file handle
+    _worker_state['file'] = open(fname, mode='rb')
+    _worker_state['kmer_lut'] = get_kmer_lookup_table_from_dict(word_dict, ngram)
+    _worker_state['vocab_hash'] = get_vocab_hash(word_dict)
+
+
+def preccess_region(task):
+    """
+    Read one region by the index, drop windows with non 'ATCG' bases and save the forward and
+    reverse complement tokens (interleaved) into one shard
+    :param task: (record, start, end, seq_size, seq_stride, stride, ngram, output_path, shard_name, shard_format)
+    :return: Manifest entry
+    """
+    record, start, end, seq_size, seq_stride, stride, ngram, output_path, shard_name, shard_format = task
+
+    region_end = min((end - 1 - start) // seq_stride * seq_stride + start + seq_size, record['length'])
+    codes = read_fasta_region(_worker_state['file'], record, start, region_end)
+    windows = strided_windows(codes, seq_size, seq_stride)
+    keep, _, _, _ = check_sequence_codes(windows, policy='drop')
+    windows = windows[keep]
+
+    seq_number, seq_flip_number = codes_to_kmer_ids_both_strands(windows, _worker_state['kmer_lut'], ngram, stride)
+    data = np.stack([seq_number, seq_flip_number], axis=1).reshape((-1, seq_number.shape[-1]))
+    if shard_format == 'int16':
+        data = data.astype(np.int16)
+
+    entry = {
+        'chrom': record['name'],
+        'start': int(start),
+        'end': int(region_end),
+        'n_windows': int(len(windows)),
+        'checksum': hashlib.md5(data.tobytes()).hexdigest(),
+        'file': None,
     }
-    save_path = os.path.join(output_path,
-                             '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-                                                                            str(stride),
-                                                                            str(slice_index)))
-    np.savez_compressed(save_path, **save_dict)
-    time.sleep(5)
-
-
-def process_fasta_raw_text_parallel(fname,
-                                    chunk_size=10000,
-                                    seq_size=1000,
-                                    seq_stride=500,
-                                    ngram=3,
-                                    stride=1,
-                                    filter_txt=None,
-                                    skip_n: bool = False,
-                                    word_dict: dict = None,
-                                    slice_size: int = 100000,
-                                    output_path: str = './',
-                                    hg_name: str = 'hg19',
-                                    pool_size: int = 8):
-    index = 0
-    chunks = ''
-
-    # Sequence size
-    seq_size = max(seq_size, seq_size // ngram * ngram + (ngram - 1))
-
-    slice_index = 0
-
-    slice_seq_raw_data = []
-    slice_seq_num_data = []
-    set_atcg = set(list('ATCG'))
-
-    print("seq_size: ", seq_size)
-    with open(fname, mode='r', encoding='utf-8') as f:
-
-        pool = Pool(processes=pool_size)
-
-        for line in f:
-            # Delete '\n'
-            line = line[:-1]
-            line = line.upper()
-            if filter_txt is not None and line.startswith(filter_txt):
-                continue
-
-            if skip_n is True:
-                if line.find('N') > -1:
-                    continue
-
-            # Check if it’s not ‘ATCG’
-            set_seq = set(list(line))
-            is_atcg = True
-            for atcg in set_seq:
-                if atcg not in set_atcg:
-                    is_atcg = False
-            if is_atcg is False:
-                continue
-
-            if len(chunks) < (seq_stride * slice_size + (seq_size - seq_stride)):
-                chunks += line
-            else:
-                for ii in range(0, int(seq_stride * slice_size), seq_stride):
-                    if ii + seq_size <= (seq_stride * slice_size + (seq_size - seq_stride)):
-                        continue
-
-                print("ii: ", slice_index, seq_stride * slice_size, len(chunks))
-                print("chunks: ", len(chunks))
-
-                seq_chunks = chunks[:(ii + seq_size)]
-                chunks = chunks[(ii + seq_size):]
-                chunks += line
-
-                slice_index += int((ii + seq_stride) / seq_stride)
-                pool.apply_async(preccess_seq_chunks, args=(
-                seq_chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path, hg_name))
-
-            index += 1
-            if index % 100000 == 0:
-                print(index, len(line))
-
-        if len(chunks) > 0:
-            slice_index += int(len(chunks) / seq_stride)
-            pool.apply_async(preccess_seq_chunks,
-                             args=(chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path,
-                                   hg_name))
-
-        pool.close()
-        pool.join()
-
-
-def process_fasta_raw_text(fname,
-                           chunk_size=10000,
+    if len(windows) > 0:
+        # Write to a temporary file first, so an interrupted run never leaves a truncated shard
+        save_path = os.path.join(output_path, shard_name)
+        if shard_format == 'int16':
+            write_token_shard(save_path, data, ngram, stride, vocab_hash=_worker_state['vocab_hash'],
+                              chrom=record['name'], start=int(start), end=int(region_end))
+        else:
+            with open(save_path + '.tmp', mode='wb') as f:
+                np.savez_compressed(f, data=data)
+            os.replace(save_path + '.tmp', save_path)
+        entry['file'] = shard_name
+    return entry
+
+
+def save_manifest(manifest_path, params, entries, records):
+    order = {record['name']: ii for ii, record in enumerate(records)}
+    shards = sorted(entries.values(), key=lambda entry: (order.get(entry['chrom'], len(order)), entry['start']))
+    with open(manifest_path + '.tmp', mode='w') as f:
+        json.dump({'params': params, 'shards': shards}, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def generate_refseq_corpus(fname,
                            seq_size=1000,
                            seq_stride=500,
                            ngram=3,
                            stride=1,
-                           filter_txt=None,
-                           skip_n: bool = False,
                            word_dict: dict = None,
                            slice_size: int = 100000,
                            output_path: str = './',
-                           hg_name: str = 'hg19'):
-    index = 0
-    chunks = ''
-
-    # Sequence length
+                           hg_name: str = 'hg19',
+                           pool_size: int = 8,
+                           chroms: list = None,
+                           shard_format: str = 'int16'):
+    """
+    Per-chromosome parallel corpus generation. Each worker reads its own regions through the .fai index,
+    shards are named by (chrom, start) and listed in a manifest of (chrom, start, end, n_windows, checksum).
+    Regions already in the manifest (with the same parameters) are skipped, so an interrupted run can be resumed.
+    :param shard_format: 'int16' fixed-width memmap shards (bgi.common.shard_utils) or 'npz'
+    :return: manifest entries
+    """
+    # Sequence size
     seq_size = max(seq_size, seq_size // ngram * ngram + (ngram - 1))
-
-    slice_index = 0
-
-    slice_seq_raw_data = []
-    slice_seq_num_data = []
-
-    set_atcg = set(list('ATCG'))
-
     print("seq_size: ", seq_size)
-    with open(fname, mode='r', encoding='utf-8') as f:
-        for line in f:
-            # Delete '\n'
-            line = line[:-1]
-            line = line.upper()
-            if filter_txt is not None and line.startswith(filter_txt):
-                continue
-
-            if skip_n is True:
-                if line.find('N') > -1:
-                    continue
-
-            # Check if it’s not ‘ATCG’
-            set_seq = set(list(line))
-            is_atcg = True
-            for atcg in set_seq:
-                if atcg not in set_atcg:
-                    is_atcg = False
-            if is_atcg is False:
-                continue
-
-            if len(chunks) < chunk_size:
-                chunks += line
-            else:
-                for ii in range(0, chunk_size, seq_stride):
-                    if ii + seq_size <= chunk_size:
-                        seq = chunks[ii:int(ii + seq_size)]
-
-                        # Check if it’s not ‘ATCG’
-                        set_seq = set(list(seq))
-                        is_atcg = True
-                        for atcg in set_seq:
-                            if atcg not in set_atcg:
-                                is_atcg = False
-                        if is_atcg is False:
-                            continue
-
-                        seq_list = []
-                        seq_number = []
-                        for jj in range(0, len(seq), stride):
-                            if jj + ngram <= len(seq):
-                                if word_dict is not None:
-                                    seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
-
-                        slice_seq_num_data.append(seq_number)
-
-                        my_dna = Seq(seq, generic_dna)
-                        seq_flip = str(my_dna.reverse_complement())
-                        seq_list = []
-                        seq_number = []
-                        for jj in range(0, len(seq_flip), stride):
-                            if jj + ngram <= len(seq_flip):
-                                if word_dict is not None:
-                                    seq_number.append(word_dict.get(seq_flip[jj:jj + ngram], 0))
-
-                        slice_seq_num_data.append(seq_number)
-                        slice_index += 1
-
-                        if slice_index > 0 and slice_index % slice_size == 0:
-                            save_dict = {
-                                'data': slice_seq_num_data,
-                                # 'dict': word_dict
-                            }
-                            save_path = os.path.join(output_path,
-                                                     '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-                                                                                                    str(stride),
-                                                                                                    str(slice_index)))
-                            np.savez_compressed(save_path, **save_dict)
-
-                            slice_seq_raw_data = []
-                            slice_seq_num_data = []
-
-                # Update to the remaining sequence
-                chunks = chunks[ii:]
-                chunks += line
-
-            index += 1
-            if index % 100000 == 0:
-                print(index, len(line))
-
-        if len(slice_seq_num_data) > 0:
-            save_dict = {
-                'data': slice_seq_num_data,
-                'dict': word_dict
-            }
-            save_path = os.path.join(output_path,
-                                     '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-                                                                                    str(stride), str(slice_index)))
-            np.savez_compressed(save_path, **save_dict)
-            del slice_seq_raw_data
-            del slice_seq_num_data
+
+    records = load_fasta_index(fname)
+    tasks = get_region_tasks(records, seq_size=seq_size, seq_stride=seq_stride, slice_size=slice_size, chroms=chroms)
+
+    params = {'fasta': os.path.basename(fname), 'seq_size': seq_size, 'seq_stride': seq_stride, 'ngram': ngram,
+              'stride': stride, 'slice_size': slice_size, 'vocab_size': len(word_dict),
+              'vocab_hash': get_vocab_hash(word_dict), 'shard_format': shard_format}
+    manifest_path = get_manifest_path(output_path, hg_name, ngram, stride)
+
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, mode='r') as f:
+            manifest = json.load(f)
+        if manifest['params'] == params:
+            for entry in manifest['shards']:
+                if entry['file'] is None or os.path.exists(os.path.join(output_path, entry['file'])):
+                    entries[(entry['chrom'], entry['start'])] = entry
+        else:
+            print("Parameters changed, regenerate all shards: ", manifest_path)
+
+    pending = []
+    for record, start, end in tasks:
+        if (record['name'], start) in entries:
+            continue
+        pending.append((record, start, end, seq_size, seq_stride, stride, ngram, output_path,
+                        get_shard_name(hg_name, ngram, stride, record['name'], start, shard_format), shard_format))
+    print("Regions: ", len(tasks), ", pending: ", len(pending))
+
+    with Pool(processes=pool_size, initializer=init_worker, initargs=(fname, word_dict, ngram)) as pool:
+        for entry in pool.imap_unordered(preccess_region, pending):
+            entries[(entry['chrom'], entry['start'])] = entry
+            save_manifest(manifest_path, params, entries, records)
+            print(entry['chrom'], entry['start'], entry['end'], entry['n_windows'])
+
+    save_manifest(manifest_path, params, entries, records)
+    return list(entries.values())
 
 
 if __name__ == '__main__':
@@ -269,9 +186,6 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--output', type=str, default='transformer_gene', metavar='NAME',
         help='A path which save processed file')
-    _argparser.add_argument(
-        '--chunk-size', type=int, default=10000, metavar='INTEGER',
-        help='chunk size')
     _argparser.add_argument(
         '--seq-size', type=int, default=1000, metavar='INTEGER',
         help='Sequence size')
@@ -293,12 +207,17 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--pool-size', type=int, default=4, metavar='INTEGER',
         help='Pool size')
+    _argparser.add_argument(
+        '--chroms', type=str, default=None, metavar='NAMES',
+        help='Comma separated chromosomes (e.g. NC_000001.10,NC_000002.11), default all records')
+    _argparser.add_argument(
+        '--shard-format', type=str, default='int16', choices=['int16', 'npz'],
+        help='int16: fixed-width memmap shards, npz: compressed numpy shards')
 
     _args = _argparser.parse_args()
 
     data_path = _args.data
     output_path = _args.output
-    chunk_size = _args.chunk_size
     seq_size = _args.seq_size
     seq_stride = _args.seq_stride
     ngram = _args.ngram
@@ -306,6 +225,8 @@ if __name__ == '__main__':
     slice_size = _args.slice_size
     hg_name = _args.hg_name
     pool_size = _args.pool_size
+    chroms = _args.chroms.split(',') if _args.chroms is not None else None
+    shard_format = _args.shard_format
 
     word_dict_alphabet = get_word_dict_for_n_gram_alphabet(n_gram=ngram, word_index_from=10)
     print("word_dict_alphabet: ", len(word_dict_alphabet))
@@ -313,17 +234,15 @@ if __name__ == '__main__':
     word_dict_number = get_word_dict_for_n_gram_number(n_gram=ngram, word_index_from=10)
     print("word_dict_number: ", len(word_dict_number))
 
-    process_fasta_raw_text_parallel(data_path,
-                                    chunk_size=chunk_size,
-                                    seq_size=seq_size,
-                                    seq_stride=seq_stride,
-                                    ngram=ngram,
-                                    stride=stride,
-                                    filter_txt='>NC_',
-                                    word_dict=word_dict_alphabet,
-                                    slice_size=slice_size,
-                                    output_path=output_path,
-                                    hg_name=hg_name,
-                                    skip_n=True,
-                                    pool_size=pool_size)
-
+    generate_refseq_corpus(data_path,
+                           seq_size=seq_size,
+                           seq_stride=seq_stride,
+                           ngram=ngram,
+                           stride=stride,
+                           word_dict=word_dict_alphabet,
+                           slice_size=slice_size,
+                           output_path=output_path,
+                           hg_name=hg_name,
+                           pool_size=pool_size,
+                           chroms=chroms,
+                           shard_format=shard_format)
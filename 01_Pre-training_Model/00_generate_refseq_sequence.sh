@@ -3,7 +3,6 @@
 python 00_generate_refseq_sequence.py \
   --data /data/hg19/GCF_000001405.25_GRCh37.p13_genomic.fna \
   --output /data/hg19/train_5_gram \
-  --chunk-size 10000 \
   --seq-size 1000 \
   --seq-stride 100 \
   --ngram 5 \
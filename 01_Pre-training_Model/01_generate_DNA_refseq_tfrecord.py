@@ -1,5 +1,4 @@
 import os
-import random
 from multiprocessing import Pool
 import argparse
 import sys
@@ -10,6 +9,12 @@ import tensorflow.keras.backend as K
 
 sys.path.append("../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
+from bgi.common.tfrecord_utils import write_to_tfrecord, create_token_feature, get_token_feature_spec, \
+    decode_token_feature, detect_token_schema, load_tfrecord_dataset
+from bgi.common.mlm_utils import add_cls_sep, mask_tokens
+from bgi.common.pool_utils import apply_async_bounded
+from bgi.common.shard_utils import TOKEN_SHARD_SUFFIX, open_token_shard
+from bgi.common.kmer_utils import get_ngram_frame
 
 
 def generate_samples(train_data,
@@ -23,7 +28,12 @@ def generate_samples(train_data,
                      shuffle=True,
                      batch_size: int = 32,
                      output_path: str = '',
-                     file_name: str = ''
+                     file_name: str = '',
+                     seed: int = None,
+                     raw_sequence: bool = False,
+                     compression_type: str = 'ZLIB',
+                     max_shard_bytes: int = None,
+                     token_schema: str = 'int64'
                      ):
     """
     Generate masked sequence
@@ -35,117 +45,93 @@ def generate_samples(train_data,
         mask_token_id:
         sep_token_id:
         word_from_index:
+        seed: Seed of the masking Generator, a fresh one by default
+        raw_sequence: Only save the raw sequence, masking is done on the fly by tf.data at training time
+        compression_type: 'GZIP', 'ZLIB' or 'NONE'
+        max_shard_bytes: Target size of each tfrecord shard, no sharding by default
+        token_schema: 'int64' one int64 per token; 'bytes' the whole sequence as little-endian uint16 bytes, ~1/4 the size
     Returns:
 
     """
 
     batch_len = len(train_data)
 
-    if is_sep_mask:
-        sequence = np.zeros((batch_len, train_data.shape[1] + 2), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1] + 2), dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle is True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-            sequence[ii, 0] = cls_token_id
-            sequence[ii, 1:-1] = train_data[index, :]
-            sequence[ii, -1] = sep_token_id
-            masked_sequence[ii] = sequence[ii]
-
-            # Mask 15% tokens
-            for word_pos in range(1, len(sequence[ii]) - 1):
-                if random.random() < 0.15:
-                    dice = random.random()
-                    if dice < 0.8:
-                        masked_sequence[ii, word_pos + 1] = mask_token_id
-                    elif dice < 0.9:
-                        masked_sequence[ii, word_pos + 1] = random.randint(first_token_id, last_token_id)
+    # One seeded Generator draws all mask positions and 80/10/10 decisions of the slice at once
+    rng = np.random.default_rng(seed)
+    indexes = np.arange(batch_len)
+    if shuffle is True:
+        indexes = rng.permutation(batch_len)
 
+    if is_sep_mask:
+        sequence = add_cls_sep(train_data[indexes], cls_token_id, sep_token_id)
+    else:
+        sequence = np.asarray(train_data[indexes], dtype=np.int32)
+
+    # Raw sequences are masked at training time by tf.data
+    if raw_sequence is True:
+        masked_sequence = None
+    elif is_sep_mask:
+        # Every position is selected with 15% probability, [CLS] and [SEP] are never replaced
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='bernoulli', rng=rng)
     else:
-        sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle is True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-            sequence[ii] = train_data[index]
-            masked_sequence[ii] = train_data[index]
-
-            choice_index = np.random.choice(len(sequence[ii]), int(len(sequence[ii]) * 0.15))
-            for word_pos in choice_index:
-                if sequence[ii, word_pos] < word_from_index:
-                    continue
-
-                dice = random.random()
-                if dice < 0.8:
-                    masked_sequence[ii, word_pos] = mask_token_id
-                elif dice < 0.9:
-                    masked_sequence[ii, word_pos] = random.randint(first_token_id, last_token_id)
-
-    print("Masked_sequence: ", masked_sequence.shape)
+        # Mask 15% tokens, positions are drawn with replacement as np.random.choice did
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='choice', rng=rng)
+
+    if masked_sequence is not None:
+        print("Masked_sequence: ", masked_sequence.shape)
     print("Sequence: ", sequence.shape)
 
     # Save to file
-    serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'])
-    write_to_tfrecord(os.path.join(output_path, file_name), serialized_instances)
+    if raw_sequence is True:
+        serialized_instances = tfrecord_serialize([sequence], ['sequence'], token_schema=token_schema)
+    else:
+        serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'],
+                                                  token_schema=token_schema)
+    write_to_tfrecord(os.path.join(output_path, file_name), serialized_instances, compression_type=compression_type,
+                      max_shard_bytes=max_shard_bytes)
     print("Save: ", os.path.join(output_path, file_name))
 
 
-def tfrecord_serialize(instances, instance_keys):
+def tfrecord_serialize(instances, instance_keys, token_schema='int64'):
     """
-    Converted to tfrecord format record, waiting to be written to the file
+    Converted to tfrecord format record, yielded one by one and written as they are produced
     """
 
-    def create_feature(x):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=x))
-
-    serialized_instances = []
     for instance in zip(*instances):
         if len(instance) != len(instance_keys):
             continue
 
         features = {
-            k: create_feature(v)
+            k: create_token_feature(v, token_schema)
             for k, v in zip(instance_keys, instance)
         }
         tf_features = tf.train.Features(feature=features)
         tf_example = tf.train.Example(features=tf_features)
         serialized_instance = tf_example.SerializeToString()
-        serialized_instances.append(serialized_instance)
-
-    return serialized_instances
-
-
-def write_to_tfrecord(record_name, serialized_instances):
-    options = tf.io.TFRecordOptions(
-        compression_type=tf.io.TFRecordOptions.compression_type_map.get('ZLIB'))
-
-    writer = tf.io.TFRecordWriter(record_name, options)
-    for serialized_instance in serialized_instances:
-        writer.write(serialized_instance)
+        yield serialized_instance
 
 
-def load_tfrecord(record_names, sequence_length=100, batch_size=32):
+def load_tfrecord(record_names, sequence_length=100, batch_size=32, token_schema=None, **kwargs):
     """
-    Load tfrecord and parse_function
+    Load tfrecord as batches, each batch is parsed at once by tf.io.parse_example
+    The other arguments are passed to bgi.common.tfrecord_utils.load_tfrecord_dataset
     """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'sequence')
 
     def parse_function(serialized):
         features = {
-            'masked_sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
-            'sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'masked_sequence': get_token_feature_spec(sequence_length, token_schema),
+            'sequence': get_token_feature_spec(sequence_length, token_schema),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['masked_sequence']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['masked_sequence'], sequence_length, token_schema)
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
-        sequence = features['sequence']
+        sequence = decode_token_feature(features['sequence'], sequence_length, token_schema)
         x = {
             'Input-Token': masked_sequence,
             'Input-Segment': segment_id,
@@ -153,12 +139,54 @@ def load_tfrecord(record_names, sequence_length=100, batch_size=32):
         y = sequence
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
+    return load_tfrecord_dataset(record_names, parse_function, batch_size, **kwargs)
+
+
+def generate_samples_from_file(train_file, frame, ngram, *args):
+    """
+    Read one .npz or int16 shard (or its frame-th frame) in the worker and generate the samples,
+    the parent only passes the file path
+    :param train_file:
+    :param frame: Index of the frame, None for the whole sequence
+    :param ngram:
+    :param args: The other arguments of generate_samples
+    :return: train_file, frame, number of samples
+    """
+    if str(train_file).endswith(TOKEN_SHARD_SUFFIX):
+        # The int16 shard is a memmap, only the columns of this frame are read
+        train_data, _ = open_token_shard(train_file)
+    else:
+        with np.load(train_file) as loaded:
+            train_data = loaded['data']
+    if frame is not None:
+        train_data = get_ngram_frame(train_data, frame, ngram)
+    train_data = np.asarray(train_data, dtype=np.int32)
 
-    dataset = tf.data.TFRecordDataset(record_names)
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    return dataset
+    generate_samples(train_data, *args)
+    return train_file, frame, len(train_data)
+
+
+def get_pretrain_tasks(train_data_path: str, ngram: int, only_one_slice: bool, sample_args: tuple,
+                       record_args: tuple):
+    """
+    One task per frame of each file, only the file path and the frame are sent, workers read the data themselves
+    """
+    for file_name in sorted(os.listdir(train_data_path)):
+        if str(file_name).endswith(TOKEN_SHARD_SUFFIX):
+            base_name = file_name[:-len(TOKEN_SHARD_SUFFIX)]
+        elif str(file_name).endswith('.npz'):
+            base_name = file_name[:-len('.npz')]
+        else:
+            continue
+        train_file = os.path.join(train_data_path, file_name)
+
+        frames = range(ngram) if only_one_slice is True else [None]
+        for frame in frames:
+            if frame is None:
+                tf_file_name = base_name + '.tfrecord'
+            else:
+                tf_file_name = base_name + '_{}.tfrecord'.format(str(frame))
+            yield (train_file, frame, ngram) + sample_args + (tf_file_name,) + record_args
 
 
 def prepare_pretrain_data(train_data_path: str,
@@ -176,71 +204,40 @@ def prepare_pretrain_data(train_data_path: str,
                           shuffle=True,
                           batch_size: int = 32,
                           only_one_slice: bool = True,
+                          raw_sequence: bool = False,
+                          compression_type: str = 'ZLIB',
+                          max_shard_bytes: int = None,
+                          token_schema: str = 'int64',
                           ):
-    files = os.listdir(train_data_path)
-
-    # Generate data in parallel
+    sample_args = (first_token_id,
+                   last_token_id,
+                   CLS_ID,
+                   MASK_ID,
+                   PAD_ID,
+                   word_from_index,
+                   is_sep_mask,
+                   shuffle,
+                   batch_size,
+                   output_path,
+                   )
+    # seed, raw_sequence, compression_type, max_shard_bytes, token_schema
+    record_args = (None, raw_sequence, compression_type, max_shard_bytes, token_schema)
+
+    # Generate data in parallel, at most pool_size * 2 tasks are submitted at a time
     pool = Pool(processes=pool_size)
-    results = []
-    for file_name in files:
-
-        if str(file_name).endswith('.npz') is False:
-            continue
-        train_file = os.path.join(train_data_path, file_name)
-        print("File: ", train_file)
-        loaded = np.load(train_file)
-        x_train = loaded['data']
-
-        tf_file_name = file_name.replace('.npz', '.tfrecord')
-        # Read all data
-        if only_one_slice is True:
-            # kk = random.randint(0, int(ngram) - 1)
-            for kk in range(ngram):
-                slice_indexes = []
-                max_slice_seq_len = x_train.shape[1] // ngram * ngram
-                for gg in range(kk, max_slice_seq_len, ngram):
-                    slice_indexes.append(gg)
-
-                print("max_slice_seq_len: ", max_slice_seq_len, kk)
-                print("slice_indexes: ", len(slice_indexes))
-                suffix = '_{}.tfrecord'.format(str(kk))
-                tf_file_name = tf_file_name.replace('.tfrecord', suffix)
-
-                pool.apply_async(generate_samples,
-                                 args=(x_train[:, slice_indexes],
-                                       first_token_id,
-                                       last_token_id,
-                                       CLS_ID,
-                                       MASK_ID,
-                                       PAD_ID,
-                                       word_from_index,
-                                       is_sep_mask,
-                                       shuffle,
-                                       batch_size,
-                                       output_path,
-                                       tf_file_name,
-                                       ))
-                # results.append(result)
-
-        else:
-            pool.apply_async(generate_samples,
-                             args=(x_train,
-                                   first_token_id,
-                                   last_token_id,
-                                   CLS_ID,
-                                   MASK_ID,
-                                   PAD_ID,
-                                   word_from_index,
-                                   is_sep_mask,
-                                   shuffle,
-                                   batch_size,
-                                   output_path,
-                                   tf_file_name,
-                                   ))
-            # results.append(result)
+    tasks = get_pretrain_tasks(train_data_path, ngram, only_one_slice, sample_args, record_args)
+    results, errors = apply_async_bounded(pool, generate_samples_from_file, tasks, max_in_flight=pool_size * 2)
     pool.close()
     pool.join()
 
+    for _, (train_file, frame, num_samples) in results:
+        print("Done: ", train_file, frame, num_samples)
+    for args, message in errors:
+        print("Failed: ", args[0], args[1])
+        print(message)
+    if len(errors) > 0:
+        raise RuntimeError("{} of {} tasks failed".format(len(errors), len(results) + len(errors)))
+
 
 if __name__ == '__main__':
     _argparser = argparse.ArgumentParser(
@@ -276,6 +273,18 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--pool-size', type=int, default=4, metavar='INTEGER',
         help='Pool size')
+    _argparser.add_argument(
+        '--raw-sequence', action='store_true',
+        help='Only save the raw token sequence, masking is done on the fly at training time (--dynamic-mask)')
+    _argparser.add_argument(
+        '--compression', type=str, default='ZLIB', choices=['GZIP', 'ZLIB', 'NONE'],
+        help='Compression of the tfrecord files, NONE is much faster to read on local disks')
+    _argparser.add_argument(
+        '--shard-size', type=int, default=0, metavar='INTEGER',
+        help='Target size (MB, before compression) of each tfrecord shard, 0 for one file per slice')
+    _argparser.add_argument(
+        '--token-schema', type=str, default='int64', choices=['int64', 'bytes'],
+        help='Store each token as an int64, or each sequence as one little-endian uint16 bytes feature (~4x smaller)')
 
     _args = _argparser.parse_args()
 
@@ -289,6 +298,10 @@ if __name__ == '__main__':
     # slice_size = _args.slice_size
     # hg_name = _args.hg_name
     pool_size = _args.pool_size
+    raw_sequence = _args.raw_sequence
+    compression_type = _args.compression
+    max_shard_bytes = _args.shard_size * 1024 * 1024
+    token_schema = _args.token_schema
 
     word_index_from = 10
     word_dict_alphabet = get_word_dict_for_n_gram_alphabet(n_gram=ngram, word_index_from=10)
@@ -308,5 +321,9 @@ if __name__ == '__main__':
                           first_token_id=word_index_from,
                           last_token_id=last_token_id,
                           word_from_index=word_index_from,
-                          batch_size=global_batch_size
+                          batch_size=global_batch_size,
+                          raw_sequence=raw_sequence,
+                          compression_type=compression_type,
+                          max_shard_bytes=max_shard_bytes,
+                          token_schema=token_schema
                           )
@@ -11,16 +11,19 @@ import numpy as np
 import tensorflow as tf
 
 import keras
-from keras.callbacks import ModelCheckpoint
 from tensorflow.keras.layers import Input, Lambda
 from tensorflow.keras.models import Model
 
 import sys
 sys.path.append("../")
-from bgi.bert4keras.backend import K
-from bgi.bert4keras.models import build_transformer_model
-from bgi.common.callbacks import LRSchedulerPerStep
+from bgi.bert4keras.backend import K, MIXED_PRECISION_POLICIES, check_mixed_precision
+from bgi.bert4keras.models import build_transformer_model, load_weights_by_layer
+from bgi.bert4keras.optimizers import get_optimizer
+from bgi.common.callbacks import LRSchedulerPerStep, AsyncCheckpoint, get_profiling_callbacks
+from bgi.common.mlm_utils import mask_tokens_tf
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
 
 
 
@@ -43,46 +46,88 @@ MASK_ID = special_symbols["<mask>"]
 
 
 
-def load_tfrecord(record_names, sequence_length=100, num_parallel_calls=tf.data.experimental.AUTOTUNE, batch_size=32):
+def load_tfrecord(record_names, sequence_length=100, num_parallel_calls=tf.data.experimental.AUTOTUNE, batch_size=32,
+                  dynamic_mask=False, token_schema=None, mask_function=None, shuffle_size=0, repeat=False,
+                  deterministic=True, cache=None, prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
     """
-    parse_function
+    Batched dataset of the pretraining tfrecords, each batch is parsed at once by tf.io.parse_example
+    dynamic_mask: Only parse the raw 'sequence', the batches are masked by mask_function (get_dynamic_mask_function)
+    token_schema: 'int64' or 'bytes' (uint16 bytes decoded by tf.io.decode_raw), detected from the first record by default
+    shuffle_size, repeat, deterministic, cache, prefetch_buffer_size: See bgi.common.tfrecord_utils.load_tfrecord_dataset
     """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'sequence')
+
+    def parse_sequence(serialized):
+        features = {
+            'sequence': get_token_feature_spec(sequence_length, token_schema),
+        }
+        features = tf.io.parse_example(serialized, features)
+        sequence = decode_token_feature(features['sequence'], sequence_length, token_schema)
+        if mask_function is not None:
+            return mask_function(sequence)
+        return sequence
+
     def parse_function(serialized):
         features = {
-            'masked_sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'masked_sequence': get_token_feature_spec(sequence_length, token_schema),
             # 'segmentId': tf.io.FixedLenFeature([sequence_length], tf.int64),
-            'sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'sequence': get_token_feature_spec(sequence_length, token_schema),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['masked_sequence']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['masked_sequence'], sequence_length, token_schema)
+        # One zero segment tensor per batch
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
-        sequence = features['sequence']
+        sequence = decode_token_feature(features['sequence'], sequence_length, token_schema)
         x = {
             'Input-Token': masked_sequence,
             'Input-Segment': segment_id,
         }
 
         y = K.cast(sequence, K.floatx())
-        y = K.reshape(y, (y.shape[0], 1))
+        y = K.expand_dims(y, axis=-1)
 
         y = {
             ' MLM-Activation': y
         }
-        # print("y: ", y.shape)
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
+    dataset = load_tfrecord_dataset(record_names,
+                                    parse_sequence if dynamic_mask is True else parse_function,
+                                    batch_size,
+                                    shuffle_size=shuffle_size,
+                                    repeat=repeat,
+                                    deterministic=deterministic,
+                                    num_parallel_calls=num_parallel_calls,
+                                    cache=cache,
+                                    prefetch_buffer_size=prefetch_buffer_size)
+    return dataset
 
-    dataset = tf.data.TFRecordDataset(record_names)
 
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
-    # dataset = dataset.repeat()
-    # dataset = dataset.shuffle(batch_size * 1000)
-    # dataset = dataset.batch(batch_size)
-    # dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+def get_dynamic_mask_function(first_token_id, last_token_id, mask_token_id, word_from_index, mask_rate=0.15):
+    """
+    Mask a batch of raw sequences on the fly, a new mask is drawn every time a sequence is seen
+    """
+    def mask_function(sequence):
+        masked_sequence = mask_tokens_tf(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                         mask_rate=mask_rate)
+        segment_id = K.zeros_like(masked_sequence, dtype='int64')
+        x = {
+            'Input-Token': masked_sequence,
+            'Input-Segment': segment_id,
+        }
 
-    return dataset
+        y = K.cast(sequence, K.floatx())
+        y = K.expand_dims(y, axis=-1)
+
+        y = {
+            ' MLM-Activation': y
+        }
+        return x, y
+
+    return mask_function
 
 
 
@@ -194,6 +239,46 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--prefetch-buffer-size', type=int, default=4, metavar='INTEGER',
         help='Prefetch buffer size')
+    _argparser.add_argument(
+        '--dynamic-mask', action='store_true',
+        help='Mask the raw sequences on the fly in tf.data (tfrecords from 01_generate_DNA_refseq_tfrecord.py --raw-sequence)')
+    _argparser.add_argument(
+        '--mask-rate', type=float, default=0.15, metavar='FLOAT',
+        help='Probability of a token to be masked with --dynamic-mask')
+    _argparser.add_argument(
+        '--non-deterministic', action='store_true',
+        help='Let tf.data return records out of order for higher throughput')
+    _argparser.add_argument(
+        '--cache', type=str, default=None, metavar='PATH',
+        help='Cache the serialized records, "memory" or a cache file path')
+    _argparser.add_argument(
+        '--mixed-precision', type=str, default='float32', metavar='NAME',
+        choices=MIXED_PRECISION_POLICIES,
+        help='Mixed precision policy, mixed_float16 for GPU (with loss scaling), mixed_bfloat16 for TPU/CPU; both need tf >= 2.1')
+    _argparser.add_argument(
+        '--grad-accum-steps', type=int, default=1, metavar='INTEGER',
+        help='Accumulate gradients over this many batches before each update')
+    _argparser.add_argument(
+        '--fused-qkv', action='store_true',
+        help='Compute the attention q/k/v projections with a single matmul, separate q/k/v weights still load')
+    _argparser.add_argument(
+        '--profile-log', type=str, default=None, metavar='PATH',
+        help='Log step time, throughput and peak RSS per step to this .csv (or JSON lines) file')
+    _argparser.add_argument(
+        '--benchmark-input-steps', type=int, default=50, metavar='INTEGER',
+        help='With --profile-log, time the input pipeline alone over this many batches first (0 to skip)')
+    _argparser.add_argument(
+        '--trace-steps', type=str, default=None, metavar='START,END',
+        help='Record a tf.profiler trace of the steps [START, END) into <save>/profile')
+    _argparser.add_argument(
+        '--save-steps', type=int, default=None, metavar='INTEGER',
+        help='Also save a checkpoint every this many steps')
+    _argparser.add_argument(
+        '--keep-checkpoints', type=int, default=None, metavar='INTEGER',
+        help='Keep only the latest N checkpoints (plus --keep-best-checkpoints), default keeps all')
+    _argparser.add_argument(
+        '--keep-best-checkpoints', type=int, default=1, metavar='INTEGER',
+        help='With --keep-checkpoints, also keep the best N checkpoints by the monitored loss')
 
     _args = _argparser.parse_args()
 
@@ -251,6 +336,10 @@ if __name__ == '__main__':
     print("vocab_size: ", vocab_size)
 
     pool_size = _args.pool_size
+    # Fail before loading data if this tensorflow does not support the policy (mixed_* needs tf >= 2.1)
+    mixed_precision = check_mixed_precision(_args.mixed_precision)
+    grad_accum_steps = _args.grad_accum_steps
+    fused_qkv = _args.fused_qkv
 
     # Distributed Training
     strategy = tf.distribute.MirroredStrategy()
@@ -287,16 +376,26 @@ if __name__ == '__main__':
             model='bert',
             with_mlm='linear',
             application='lm',
-            return_keras_model=False
+            return_keras_model=False,
+            mixed_precision=mixed_precision,
+            fused_qkv=fused_qkv,
         )
         albert = bert.model
         albert.summary()
-        albert.compile(optimizer='adam', loss=[tf.keras.losses.SparseCategoricalCrossentropy()], metrics=['accuracy'])
+        optimizer = get_optimizer('adam',
+                                  learning_rate=_args.lr,
+                                  grad_accum_steps=grad_accum_steps,
+                                  mixed_precision=mixed_precision)
+        albert.compile(optimizer=optimizer, loss=[tf.keras.losses.SparseCategoricalCrossentropy()], metrics=['accuracy'])
 
     with strategy.scope():
         pretrain_weight_path = _args.weight_path
         if pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
-            albert.load_weights(pretrain_weight_path, by_name=True)
+            if fused_qkv:
+                # Weights saved with separate q/k/v projections are concatenated layer by layer
+                load_weights_by_layer(albert, pretrain_weight_path)
+            else:
+                albert.load_weights(pretrain_weight_path, by_name=True)
             print("Load weights: ", pretrain_weight_path)
 
     # CallBack
@@ -306,6 +405,10 @@ if __name__ == '__main__':
     shuffle_size = _args.shuffle_size
     num_parallel_calls = _args.num_parallel_calls
     prefetch_buffer_size = _args.prefetch_buffer_size
+    dynamic_mask = _args.dynamic_mask
+    mask_rate = _args.mask_rate
+    deterministic = not _args.non_deterministic
+    cache = _args.cache
 
     lr_scheduler = LRSchedulerPerStep(model_dim,
                                       warmup=2500,
@@ -314,7 +417,16 @@ if __name__ == '__main__':
 
     loss_name = "loss"
     filepath = os.path.join(save_path, model_name + "_weights_{epoch:02d}-{accuracy:.6f}.hdf5")
-    mc = ModelCheckpoint(filepath, monitor=loss_name, save_best_only=False, verbose=verbose)
+    if _args.save_steps is not None:
+        filepath = os.path.join(save_path, model_name + "_weights_{epoch:02d}-{step}-{accuracy:.6f}.hdf5")
+    # Weights are written on a background thread, only the latest --keep-checkpoints and the best
+    # --keep-best-checkpoints files are kept
+    mc = AsyncCheckpoint(filepath,
+                         monitor=loss_name,
+                         keep_last=_args.keep_checkpoints,
+                         keep_best=_args.keep_best_checkpoints,
+                         save_steps=_args.save_steps,
+                         verbose=verbose)
 
     last_token_id = len(word_dict) + word_from_index
 
@@ -325,16 +437,40 @@ if __name__ == '__main__':
 
         GLOBAL_BATCH_SIZE = batch_size * num_gpu
         print("batch size: ", GLOBAL_BATCH_SIZE)
-
-        dataset = load_tfrecord(slice_files, sequence_length=word_seq_len, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        dataset = dataset.shuffle(GLOBAL_BATCH_SIZE * shuffle_size, reshuffle_each_iteration=True).batch(GLOBAL_BATCH_SIZE)
-        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
-        dataset = dataset.repeat()
+        print("effective batch size: ", GLOBAL_BATCH_SIZE * grad_accum_steps)
+
+        mask_function = None
+        if dynamic_mask is True:
+            # Mask the whole batch at once, special tokens (< word_from_index) are never replaced
+            mask_function = get_dynamic_mask_function(min(word_dict.values()),
+                                                      max(word_dict.values()),
+                                                      MASK_ID,
+                                                      word_from_index,
+                                                      mask_rate=mask_rate)
+        dataset = load_tfrecord(slice_files,
+                                sequence_length=word_seq_len,
+                                num_parallel_calls=num_parallel_calls,
+                                batch_size=GLOBAL_BATCH_SIZE,
+                                dynamic_mask=dynamic_mask,
+                                mask_function=mask_function,
+                                shuffle_size=GLOBAL_BATCH_SIZE * shuffle_size,
+                                repeat=True,
+                                deterministic=deterministic,
+                                cache=cache,
+                                prefetch_buffer_size=prefetch_buffer_size)
+
+        profiling_callbacks = get_profiling_callbacks(dataset,
+                                                      GLOBAL_BATCH_SIZE,
+                                                      tokens_per_example=word_seq_len,
+                                                      profile_log=_args.profile_log,
+                                                      benchmark_input_steps=_args.benchmark_input_steps,
+                                                      trace_steps=_args.trace_steps,
+                                                      trace_dir=os.path.join(save_path, 'profile'))
 
         model_train_history = albert.fit(dataset,
                                          steps_per_epoch=steps_per_epoch,
                                          epochs=epochs,
-                                         callbacks=[lr_scheduler, mc],
+                                         callbacks=[lr_scheduler, mc] + profiling_callbacks,
                                          verbose=1
                                          )
 
@@ -8,6 +8,9 @@ import pandas as pd
 sys.path.append("../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
 from bgi.common.genebank_utils import get_refseq_gff, get_gene_feature_array
+from bgi.common.annotation_utils import encode_annotation_intervals
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, sequence_to_kmer_ids
+from bgi.common.sequence_utils import sequences_to_codes, check_sequence_codes, mask_invalid_tokens
 
 include_types = ['enhancer',
                  #'promoter',
@@ -138,15 +141,19 @@ def process_raw_text(sequences,
                      word_dict: dict = None,
                      output_path: str = './',
                      task_name: str = 'train',
-                     gene_type_dict: dict = None):
+                     gene_type_dict: dict = None,
+                     policy: str = 'drop'):
     slice_index = 0
     slice_seq_data = []
     slice_label_data = []
 
-    set_atcg = set(list('ATCG'))
-
     print("seq_size: ", seq_size)
 
+    # Check all sequences in one pass, policy: 'drop', 'mask' (non-ATCG tokens -> 0) or 'keep'
+    codes, _ = sequences_to_codes(sequences)
+    keep, invalid, _, _ = check_sequence_codes(codes, policy=policy)
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
+
     for row in range(len(sequences)):
         seq = sequences[row]
         label = labels[row]
@@ -162,22 +169,15 @@ def process_raw_text(sequences,
                 continue
 
         # Check if it’s not ‘ATCG’
-        set_seq = set(list(seq))
-        is_atcg = True
-        for atcg in set_seq:
-            if atcg not in set_atcg:
-                is_atcg = False
-        if is_atcg is False:
+        if not keep[row]:
             print(seq)
             continue
 
-        seq_number = []
+        # Tokens start before seq_size
+        seq_number = sequence_to_kmer_ids(seq[:seq_size + ngram - 1], kmer_lut, ngram, stride).tolist()
 
-        # seq = line
-        for jj in range(0, seq_size, stride):
-            if jj + ngram <= len(seq):
-                if word_dict is not None:
-                    seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
+        if policy == 'mask' and len(seq_number) > 0:
+            seq_number = list(mask_invalid_tokens(np.array([seq_number]), invalid[row:row + 1], ngram, stride)[0])
 
         slice_seq_data.append(seq_number)
         slice_label_data.append(label)
@@ -210,16 +210,21 @@ def process_raw_text_with_annotation(sequences,
                                      word_dict: dict = None,
                                      output_path: str = './',
                                      task_name: str = 'train',
-                                     gene_type_dict: dict = None):
+                                     gene_type_dict: dict = None,
+                                     sparse_annotation: bool = True,
+                                     policy: str = 'drop'):
     slice_index = 0
     slice_seq_data = []
     slice_anno_data = []
     slice_label_data = []
 
-    set_atcg = set(list('ATCG'))
-
     print("seq_size: ", seq_size)
 
+    # Check all sequences in one pass, policy: 'drop', 'mask' (non-ATCG tokens -> 0) or 'keep'
+    codes, _ = sequences_to_codes(sequences)
+    keep, invalid, _, _ = check_sequence_codes(codes, policy=policy)
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
+
     for row in range(len(sequences)):
         seq = sequences[row]
         anno = annotations[row]
@@ -236,39 +241,35 @@ def process_raw_text_with_annotation(sequences,
                 continue
 
         # Check if it’s not ‘ATCG’
-        set_seq = set(list(seq))
-        is_atcg = True
-        for atcg in set_seq:
-            if atcg not in set_atcg:
-                is_atcg = False
-        if is_atcg is False:
+        if not keep[row]:
             print(seq)
             continue
 
-        seq_number = []
+        # Tokens start before seq_size
+        seq_number = sequence_to_kmer_ids(seq[:seq_size + ngram - 1], kmer_lut, ngram, stride).tolist()
 
-        # seq = line
-        for jj in range(0, seq_size, stride):
-            if jj + ngram <= len(seq):
-                if word_dict is not None:
-                    seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
+        if policy == 'mask' and len(seq_number) > 0:
+            seq_number = list(mask_invalid_tokens(np.array([seq_number]), invalid[row:row + 1], ngram, stride)[0])
 
         slice_seq_data.append(seq_number)
         slice_label_data.append(label)
 
         # Sequence annotation information
-        anno_len = len(anno)
-        anno_position = np.zeros((len(gene_type_dict.keys()) + 2, seq_size), dtype=int)
-        if anno_len > 0:
-            for jj in range(anno_len):
-                gene_type = anno[jj][0]
-                gene_type = gene_type_dict.get(gene_type, 0)
-                start = int(anno[jj][1])
-                end = int(anno[jj][2])
-                anno_position[gene_type, start:min(seq_size, end)] = 1
-
-
-        slice_anno_data.append(anno_position)
+        if sparse_annotation is True:
+            # Kept as (type, start, end) intervals, rasterized at batch time
+            slice_anno_data.append(anno)
+        else:
+            anno_len = len(anno)
+            anno_position = np.zeros((len(gene_type_dict.keys()) + 2, seq_size), dtype=int)
+            if anno_len > 0:
+                for jj in range(anno_len):
+                    gene_type = anno[jj][0]
+                    gene_type = gene_type_dict.get(gene_type, 0)
+                    start = int(anno[jj][1])
+                    end = int(anno[jj][2])
+                    anno_position[gene_type, start:min(seq_size, end)] = 1
+
+            slice_anno_data.append(anno_position)
 
         slice_index += 1
 
@@ -280,11 +281,21 @@ def process_raw_text_with_annotation(sequences,
         os.makedirs(output_path)
 
     if len(slice_seq_data) > 0 and len(slice_label_data) > 0:
-        save_dict = {
-            'sequence': slice_seq_data,
-            'annotation': slice_anno_data,
-            'label': slice_label_data
-        }
+        if sparse_annotation is True:
+            intervals, offsets = encode_annotation_intervals(slice_anno_data, gene_type_dict, seq_size)
+            save_dict = {
+                'sequence': slice_seq_data,
+                'annotation_intervals': intervals,
+                'annotation_offsets': offsets,
+                'annotation_size': len(gene_type_dict.keys()) + 2,
+                'label': slice_label_data
+            }
+        else:
+            save_dict = {
+                'sequence': slice_seq_data,
+                'annotation': slice_anno_data,
+                'label': slice_label_data
+            }
         save_path = os.path.join(output_path, '{}_{}_gram.npz'.format(task_name, str(ngram)))
         np.savez_compressed(save_path, **save_dict)
 
@@ -362,7 +373,7 @@ def get_epdnew_data_with_annotation(fasta_file: str,
     gff_file = 'data/hg38/GCF_000001405.39_GRCh38.p13_genomic.gff'
 
     # Annotate the signature file
-    chr_gff_dict = get_refseq_gff(gff_file, include_types)
+    chr_gff_dict = get_refseq_gff(gff_file, include_types, use_index=True)
 
     chr_convert_dict = {}
     for k, v in chr_dict_hg38.items():
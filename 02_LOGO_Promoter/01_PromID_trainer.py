@@ -19,8 +19,12 @@ from sklearn import metrics
 
 sys.path.append("../")
 from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.backend import check_mixed_precision
+from bgi.bert4keras.optimizers import get_optimizer
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.bucket_utils import get_bucket_boundaries, bucket_by_length
 
 
 def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ngram_index=None, masked=True):
@@ -58,11 +62,7 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
             if ngram_index is not None and ii != ngram_index:
                 continue
             kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-            x_data_slice = x_data[:, slice_indexes]
+            x_data_slice = get_ngram_frame(x_data, kk, ngram)
             x_data_all.append(x_data_slice)
             y_data_all.append(y_data)
     else:
@@ -215,7 +215,8 @@ def model_def(embedding_size=128,
               num_heads=8,
               num_hidden_layers=1,
               vocab_size=10000,
-              drop_rate=0.25):
+              drop_rate=0.25,
+              mixed_precision=None):
     config = {
         "attention_probs_dropout_prob": 0,
         "hidden_act": "gelu",
@@ -245,12 +246,13 @@ def model_def(embedding_size=128,
         configs=config,
         model='bert',
         return_keras_model=False,
+        mixed_precision=mixed_precision,
     )
 
     promoter_output = Lambda(lambda x: x[:, 0])(bert.model.output)
     output = BatchNormalization()(promoter_output)
     output = Dropout(drop_rate)(output)
-    output = Dense(1, activation='sigmoid', name='CLS-Activation')(output)
+    output = Dense(1, activation='sigmoid', name='CLS-Activation', dtype='float32')(output)
 
     model = tf.keras.models.Model(inputs=bert.model.input, outputs=[output])
 
@@ -265,7 +267,13 @@ def train_kfold(train_data_file,
                 n_splits=10,
                 vocab_size=10000,
                 PROMOTER_RESIZED_LEN=600,
-                task_name='epdnew_both'):
+                task_name='epdnew_both',
+                mixed_precision=None,
+                grad_accum_steps=1,
+                num_buckets=None):
+    # 混合精度策略在读取数据之前检查 (mixed_* 需要 tf >= 2.1)
+    mixed_precision = check_mixed_precision(mixed_precision)
+
     # Distributed Training
     num_gpu = 1
     strategy = tf.distribute.MirroredStrategy()
@@ -298,6 +306,17 @@ def train_kfold(train_data_file,
     if only_one_slice:
         promoter_seq_len = promoter_seq_len // ngram
 
+    # Length-bucketed batching: each batch is only padded to its longest sequence
+    bucket_boundaries = None
+    if num_buckets is not None and num_buckets > 1:
+        bucket_boundaries = get_bucket_boundaries(promoter_seq_len, num_buckets=num_buckets)
+        print("bucket_boundaries: ", bucket_boundaries)
+
+    def batch_dataset(dataset):
+        if bucket_boundaries is None:
+            return dataset.batch(batch_size)
+        return bucket_by_length(dataset, batch_size, bucket_boundaries, sequence_groups=((0, 1),))
+
     k_fold = 0
     shuffle = True
     for train, test in kfold.split(X, Y):
@@ -324,10 +343,14 @@ def train_kfold(train_data_file,
                  test=test)
 
         with strategy.scope():
-            model = model_def(vocab_size=vocab_size)
+            model = model_def(vocab_size=vocab_size, mixed_precision=mixed_precision)
             print('compiling...')
+            optimizer = get_optimizer('adam',
+                                      learning_rate=0.0001,
+                                      grad_accum_steps=grad_accum_steps,
+                                      mixed_precision=mixed_precision)
             model.compile(loss='binary_crossentropy',
-                          optimizer=tf.keras.optimizers.Adam(0.0001),
+                          optimizer=optimizer,
                           metrics=['acc', tf.keras.metrics.Precision(), tf.keras.metrics.Recall(), f1_score])
             # model.summary()
 
@@ -350,7 +373,7 @@ def train_kfold(train_data_file,
                                                             )
 
         train_dataset = train_dataset.shuffle(train_total_size, reshuffle_each_iteration=True)
-        train_dataset = train_dataset.batch(batch_size)
+        train_dataset = batch_dataset(train_dataset)
         train_dataset = train_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -366,7 +389,7 @@ def train_kfold(train_data_file,
                                                             num_classes=1,
                                                             masked=False,
                                                             )
-        valid_dataset = valid_dataset.batch(batch_size)
+        valid_dataset = batch_dataset(valid_dataset)
         valid_dataset = valid_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -382,7 +405,7 @@ def train_kfold(train_data_file,
                                                             num_classes=1,
                                                             masked=False,
                                                             )
-        test_dataset = test_dataset.batch(batch_size)
+        test_dataset = batch_dataset(test_dataset)
         test_dataset = test_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         test_dataset = test_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -406,7 +429,7 @@ def train_kfold(train_data_file,
 
         # Make predictions and reload the optimal weights
         with strategy.scope():
-            model = model_def(vocab_size=vocab_size)
+            model = model_def(vocab_size=vocab_size, mixed_precision=mixed_precision)
             print('compiling...')
             model.compile(loss='binary_crossentropy',
                           optimizer=tf.keras.optimizers.Adam(0.0001),
@@ -19,8 +19,14 @@ from sklearn import metrics
 
 sys.path.append("../")
 from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.backend import check_mixed_precision
+from bgi.bert4keras.optimizers import get_optimizer
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.bucket_utils import get_bucket_boundaries, bucket_by_length
+from bgi.common.annotation_utils import pad_annotation_intervals, slice_annotation_intervals, \
+    rasterize_annotation_intervals
 
 
 # Comment type
@@ -83,13 +89,19 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
     anno_data_all = []
     y_data_all = []
     if str(file_name).endswith('.npz') is False or os.path.exists(file_name) is False:
-        return x_data_all, None, y_data_all
+        return x_data_all, None, y_data_all, False
 
     loaded = np.load(file_name)
     x_data = loaded['sequence']
-    anno_data = loaded['annotation']
     y_data = loaded['label']
 
+    # Sparse (type, start, end) intervals are sliced per frame and rasterized at batch time
+    sparse_annotation = 'annotation_intervals' in loaded.files
+    if sparse_annotation:
+        anno_data = pad_annotation_intervals(loaded['annotation_intervals'], loaded['annotation_offsets'])
+    else:
+        anno_data = loaded['annotation']
+
     # if masked:
     #     positive_samples = np.sum(y_data)
     #     RANDOM_STATE = 42
@@ -107,12 +119,11 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
             if ngram_index is not None and ii != ngram_index:
                 continue
             kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-            x_data_slice = x_data[:, slice_indexes]
-            anno_data_slice = anno_data[:, :, slice_indexes]
+            x_data_slice = get_ngram_frame(x_data, kk, ngram)
+            if sparse_annotation:
+                anno_data_slice = slice_annotation_intervals(anno_data, frame=kk, ngram=ngram)
+            else:
+                anno_data_slice = get_ngram_frame(anno_data, kk, ngram)
             x_data_all.append(x_data_slice)
             anno_data_all.append(anno_data_slice)
             y_data_all.append(y_data)
@@ -121,15 +132,16 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
         anno_data_all.append(anno_data)
         y_data_all.append(y_data)
 
-    return x_data_all, anno_data_all, y_data_all
+    return x_data_all, anno_data_all, y_data_all, sparse_annotation
 
 
 def load_all_data(record_names: list, ngram=3, only_one_slice=True, ngram_index=None, masked=False):
     x_data_all = []
     anno_data_all = []
     y_data_all = []
+    sparse_files = {}
     for file_name in record_names:
-        x_data, anno_data, y_data = load_npz_data_for_classification(file_name,
+        x_data, anno_data, y_data, sparse_files[file_name] = load_npz_data_for_classification(file_name,
                                                                      ngram,
                                                                      only_one_slice,
                                                                      ngram_index,
@@ -139,10 +151,22 @@ def load_all_data(record_names: list, ngram=3, only_one_slice=True, ngram_index=
         anno_data_all.extend(anno_data)
         y_data_all.extend(y_data)
 
+    # Dense (N, L) and sparse (N, max_intervals, 3) annotations cannot be concatenated
+    if len(set(sparse_files.values())) > 1:
+        raise ValueError("Mixed dense and sparse annotation files, sparse: {}, dense: {}".format(
+            [name for name, sparse in sparse_files.items() if sparse],
+            [name for name, sparse in sparse_files.items() if not sparse]))
+    sparse_annotation = any(sparse_files.values())
+
+    # Sparse annotations: (N, max_intervals, 3), pad every file to the same number of intervals
+    if sparse_annotation:
+        max_intervals = max([anno.shape[1] for anno in anno_data_all])
+        anno_data_all = [np.pad(anno, ((0, 0), (0, max_intervals - anno.shape[1]), (0, 0))) for anno in anno_data_all]
+
     x_data_all = np.concatenate(x_data_all)
     anno_data_all = np.concatenate(anno_data_all)
     y_data_all = np.concatenate(y_data_all)
-    return x_data_all, anno_data_all, y_data_all
+    return x_data_all, anno_data_all, y_data_all, sparse_annotation
 
 
 # @tf.function
@@ -158,6 +182,7 @@ def load_npz_dataset_for_classification(x_promoter_data_all,
                                         seq_len=200,
                                         num_classes=1,
                                         masked=True,
+                                        sparse_annotation=False,
                                         ):
     """
     Read sequence data from NPZ file and generate tf.data.DataSet
@@ -215,12 +240,16 @@ def load_npz_dataset_for_classification(x_promoter_data_all,
     if num_classes == 1:
         classes_shape = tf.TensorShape([1])
 
+    annotation_shape = tf.TensorShape([annotation_size, promoter_seq_len])
+    if sparse_annotation:
+        annotation_shape = tf.TensorShape(annotation_data_all.shape[1:])
+
     dataset = tf.data.Dataset.from_generator(data_generator,
                                              output_types=(tf.int16, tf.int16, tf.int16, tf.int16),
                                              output_shapes=(
                                                  tf.TensorShape([promoter_seq_len]),
                                                  tf.TensorShape([promoter_seq_len]),
-                                                 tf.TensorShape([annotation_size, promoter_seq_len]),
+                                                 annotation_shape,
                                                  classes_shape
                                              ))
     return dataset
@@ -253,6 +282,24 @@ def parse_function(x_promoter, segment_x, annotations, y):
     return x, y
 
 
+def get_parse_function(annotation_size, promoter_seq_len, sparse_annotation=False):
+    """
+    Rasterize sparse annotation intervals into the dense track of each batch before parse_function;
+    promoter_seq_len=None rasterizes to the length of each (bucketed) batch
+    """
+    if sparse_annotation is False:
+        return parse_function
+
+    def sparse_parse_function(x_promoter, segment_x, intervals, y):
+        seq_len = promoter_seq_len
+        if seq_len is None:
+            seq_len = tf.shape(x_promoter)[-1]
+        annotations = rasterize_annotation_intervals(intervals, annotation_size, seq_len)
+        return parse_function(x_promoter, segment_x, annotations, y)
+
+    return sparse_parse_function
+
+
 def f1_score(y_true, y_pred):
     y_true = tf.cast(y_true, 'float')
     y_pred = tf.cast(y_pred, 'float')
@@ -288,7 +335,8 @@ def model_def(embedding_size=128,
               num_heads=8,
               num_hidden_layers=1,
               vocab_size=10000,
-              drop_rate=0.25):
+              drop_rate=0.25,
+              mixed_precision=None):
 
     multi_inputs = [2] * (len(include_types) + 2)
 
@@ -321,12 +369,13 @@ def model_def(embedding_size=128,
         configs=config,
         model='multi_inputs_bert',
         return_keras_model=False,
+        mixed_precision=mixed_precision,
     )
 
     promoter_output = Lambda(lambda x: x[:, 0])(bert.model.output)
     output = BatchNormalization()(promoter_output)
     output = Dropout(drop_rate)(output)
-    output = Dense(1, activation='sigmoid', name='CLS-Activation')(output)
+    output = Dense(1, activation='sigmoid', name='CLS-Activation', dtype='float32')(output)
 
     model = tf.keras.models.Model(inputs=bert.model.input, outputs=[output])
 
@@ -342,7 +391,13 @@ def train_kfold(train_data_file,
                 n_splits=10,
                 vocab_size=10000,
                 PROMOTER_RESIZED_LEN=600,
-                task_name='epdnew_both'):
+                task_name='epdnew_both',
+                mixed_precision=None,
+                grad_accum_steps=1,
+                num_buckets=None):
+    # 混合精度策略在读取数据之前检查 (mixed_* 需要 tf >= 2.1)
+    mixed_precision = check_mixed_precision(mixed_precision)
+
     # Distributed Training
     num_gpu = 1
     strategy = tf.distribute.MirroredStrategy()
@@ -360,8 +415,10 @@ def train_kfold(train_data_file,
     print("train_promoter_files: ", train_promoter_files)
 
     only_one_slice = True
-    region1_seq, annotation, label = load_all_data(train_promoter_files, ngram=ngram, only_one_slice=only_one_slice,
-                                       ngram_index=None)
+    region1_seq, annotation, label, sparse_annotation = load_all_data(train_promoter_files,
+                                                                      ngram=ngram,
+                                                                      only_one_slice=only_one_slice,
+                                                                      ngram_index=None)
 
     seed = 7
     numpy.random.seed(seed)
@@ -380,6 +437,23 @@ def train_kfold(train_data_file,
     k_fold = 0
     shuffle = True
 
+    # Length-bucketed batching: each batch is only padded to its longest sequence,
+    # dense annotation tracks are trimmed together with the tokens
+    bucket_boundaries = None
+    if num_buckets is not None and num_buckets > 1:
+        bucket_boundaries = get_bucket_boundaries(promoter_seq_len, num_buckets=num_buckets)
+        print("bucket_boundaries: ", bucket_boundaries)
+    sequence_groups = ((0, 1),) if sparse_annotation else ((0, 1, 2),)
+
+    def batch_dataset(dataset):
+        if bucket_boundaries is None:
+            return dataset.batch(batch_size)
+        return bucket_by_length(dataset, batch_size, bucket_boundaries, sequence_groups=sequence_groups)
+
+    batch_parse_function = get_parse_function(annotation_size,
+                                              promoter_seq_len if bucket_boundaries is None else None,
+                                              sparse_annotation=sparse_annotation)
+
     for train, test in kfold.split(X, Y):
         early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_acc', patience=3)
 
@@ -407,10 +481,14 @@ def train_kfold(train_data_file,
                  test=test)
 
         with strategy.scope():
-            model = model_def(vocab_size=vocab_size)
+            model = model_def(vocab_size=vocab_size, mixed_precision=mixed_precision)
             print('compiling...')
+            optimizer = get_optimizer('adam',
+                                      learning_rate=0.0001,
+                                      grad_accum_steps=grad_accum_steps,
+                                      mixed_precision=mixed_precision)
             model.compile(loss='binary_crossentropy',
-                          optimizer=tf.keras.optimizers.Adam(0.0001),
+                          optimizer=optimizer,
                           metrics=['acc', tf.keras.metrics.Precision(), tf.keras.metrics.Recall(), f1_score])
             # model.summary()
 
@@ -433,12 +511,13 @@ def train_kfold(train_data_file,
                                                             shuffle=True,
                                                             seq_len=0,
                                                             masked=False,
-                                                            annotation_size=annotation_size
+                                                            annotation_size=annotation_size,
+                                                            sparse_annotation=sparse_annotation
                                                             )
 
         train_dataset = train_dataset.shuffle(train_total_size, reshuffle_each_iteration=True)
-        train_dataset = train_dataset.batch(batch_size)
-        train_dataset = train_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+        train_dataset = batch_dataset(train_dataset)
+        train_dataset = train_dataset.map(map_func=batch_parse_function, num_parallel_calls=num_parallel_calls)
         train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
         valid_total_size = len(y_valid_data)
@@ -453,10 +532,11 @@ def train_kfold(train_data_file,
                                                             seq_len=0,
                                                             num_classes=1,
                                                             masked=False,
-                                                            annotation_size=annotation_size
+                                                            annotation_size=annotation_size,
+                                                            sparse_annotation=sparse_annotation
                                                             )
-        valid_dataset = valid_dataset.batch(batch_size)
-        valid_dataset = valid_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+        valid_dataset = batch_dataset(valid_dataset)
+        valid_dataset = valid_dataset.map(map_func=batch_parse_function, num_parallel_calls=num_parallel_calls)
         valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
         test_total_size = len(y_test_data)
@@ -471,10 +551,11 @@ def train_kfold(train_data_file,
                                                             seq_len=0,
                                                             num_classes=1,
                                                             masked=False,
-                                                            annotation_size=annotation_size
+                                                            annotation_size=annotation_size,
+                                                            sparse_annotation=sparse_annotation
                                                             )
-        test_dataset = test_dataset.batch(batch_size)
-        test_dataset = test_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+        test_dataset = batch_dataset(test_dataset)
+        test_dataset = test_dataset.map(map_func=batch_parse_function, num_parallel_calls=num_parallel_calls)
         test_dataset = test_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 
@@ -497,7 +578,7 @@ def train_kfold(train_data_file,
 
         # Make predictions and reload the optimal weights
         with strategy.scope():
-            model = model_def(vocab_size=vocab_size)
+            model = model_def(vocab_size=vocab_size, mixed_precision=mixed_precision)
             print('compiling...')
             model.compile(loss='binary_crossentropy',
                           optimizer=tf.keras.optimizers.Adam(0.0001),
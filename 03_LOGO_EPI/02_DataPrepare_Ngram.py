@@ -12,7 +12,7 @@ import re
 sys.path.append("../")
 from bgi.bert4keras.models import build_transformer_model
 from bgi.common.callbacks import LRSchedulerPerStep
-from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_kmer_lookup_table, number_codes_to_kmer_ids
 
 
 def preccess_data(seq_data: np.ndarray,
@@ -21,7 +21,7 @@ def preccess_data(seq_data: np.ndarray,
                   seq_max_len,
                   n_gram,
                   n_gram_value,
-                  num_word_dict,
+                  kmer_lut,
                   ):
     """
     分批处理数据，生成npz文件
@@ -30,31 +30,17 @@ def preccess_data(seq_data: np.ndarray,
     :param step:
     :param n_gram:
     :param n_gram_value:
-    :param num_word_dict:
+    :param kmer_lut: 与 get_word_dict_for_n_gram_number 的 id 一致的查找表
     :return:
     """
 
     # AGCT转换为1，2，3，4
     actg = np.matmul(seq_data, actg_value)
-    gene = []
-    for kk in range(0, len(actg), stride):
-        if kk >= seq_max_len:
-            break
-
-        actg_temp_value = 0
-        if kk + n_gram <= len(actg):
-            actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-            actg_temp_value = int(actg_temp_value)
-        else:
-            for gg in range(kk, len(actg)):
-                actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-
-            # print("10 ** (kk % n_gram): ", 10 ** (kk % n_gram))
-            actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-        gene.append(num_word_dict.get(actg_temp_value, 0))
+    gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, stride)
+    # 只保留起始位置小于 seq_max_len 的 token
+    gene = gene[:(seq_max_len + stride - 1) // stride]
     # print("gene: ", len(gene), seq_max_len, len(actg))
-    return np.array(gene)
+    return gene
 
 
 def load_npz_data(data_path, prefix='', ngram=3, reshape=True, NUM_SEQ=4, masked=True):
@@ -76,7 +62,7 @@ def load_npz_data(data_path, prefix='', ngram=3, reshape=True, NUM_SEQ=4, masked
         n_gram_value[ii] = int(n_gram_value[ii] * (10 ** (ngram - ii - 1)))
     print("n_gram_value: ", n_gram_value)
 
-    num_word_dict = get_word_dict_for_n_gram_number(n_gram=ngram)
+    kmer_lut = get_kmer_lookup_table(ngram, number_keys=True)
 
     files = os.listdir(data_path)
     for file_name in files:
@@ -110,7 +96,7 @@ def load_npz_data(data_path, prefix='', ngram=3, reshape=True, NUM_SEQ=4, masked
                                      seq_max_len=seq_max_len,
                                      n_gram=ngram,
                                      n_gram_value=n_gram_value,
-                                     num_word_dict=num_word_dict,
+                                     kmer_lut=kmer_lut,
                                      )
             x_gene_seq_all.append(gene_seq)
 
@@ -18,9 +18,11 @@ import numpy
 from sklearn import metrics
 
 sys.path.append("../")
-from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.models import build_transformer_model, InferenceModel
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.bucket_utils import get_bucket_boundaries, bucket_by_length, batch_by_length, sort_by_length, unsort
 
 
 def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ngram_index=None, masked=True):
@@ -58,11 +60,7 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
             if ngram_index is not None and ii != ngram_index:
                 continue
             kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-            x_data_slice = x_data[:, slice_indexes]
+            x_data_slice = get_ngram_frame(x_data, kk, ngram)
             x_data_all.append(x_data_slice)
             y_data_all.append(y_data)
     else:
@@ -293,7 +291,8 @@ def train_kfold(CELL, TYPE,
                 NUM_SEQ=4,
                 vocab_size=10000,
                 ENHANCER_RESIZED_LEN=2000,
-                PROMOTER_RESIZED_LEN=1000):
+                PROMOTER_RESIZED_LEN=1000,
+                num_buckets=None):
     # Distributed Training
     num_gpu = 1
     strategy = tf.distribute.MirroredStrategy()
@@ -328,6 +327,17 @@ def train_kfold(CELL, TYPE,
     enhancer_seq_len = ENHANCER_RESIZED_LEN // ngram // ngram * ngram
     promoter_seq_len = PROMOTER_RESIZED_LEN // ngram // ngram * ngram
 
+    # Length-bucketed batching on the enhancer length: each batch is only padded to its longest enhancer/promoter
+    bucket_boundaries = None
+    if num_buckets is not None and num_buckets > 1:
+        bucket_boundaries = get_bucket_boundaries(enhancer_seq_len, num_buckets=num_buckets)
+        print("bucket_boundaries: ", bucket_boundaries)
+
+    def batch_dataset(dataset):
+        if bucket_boundaries is None:
+            return dataset.batch(batch_size)
+        return bucket_by_length(dataset, batch_size, bucket_boundaries, sequence_groups=((0, 1), (2, 3)))
+
     k_fold = 0
     for train, test in kfold.split(X, Y):
         early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_acc', patience=3)
@@ -373,7 +383,7 @@ def train_kfold(CELL, TYPE,
                                                             )
 
         train_dataset = train_dataset.shuffle(train_total_size, reshuffle_each_iteration=True)
-        train_dataset = train_dataset.batch(batch_size)
+        train_dataset = batch_dataset(train_dataset)
         train_dataset = train_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -391,7 +401,7 @@ def train_kfold(CELL, TYPE,
                                                             num_classes=1,
                                                             masked=False,
                                                             )
-        valid_dataset = valid_dataset.batch(batch_size)
+        valid_dataset = batch_dataset(valid_dataset)
         valid_dataset = valid_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -425,7 +435,8 @@ def bagging_predict(label, bag_pred, bag_score):
     return f1, auprc
 
 # @tf.function
-def evaluate(CELL, TYPE, NUM_ENSEMBL=1, ngram=6, batch_size=128, num_parallel_calls=16, ENHANCER_RESIZED_LEN=2000, PROMOTER_RESIZED_LEN=1000):
+def evaluate(CELL, TYPE, NUM_ENSEMBL=1, ngram=6, batch_size=128, num_parallel_calls=16, ENHANCER_RESIZED_LEN=2000, PROMOTER_RESIZED_LEN=1000,
+             length_batching=False):
     ## load data: sequence
     data_path = CELL + '/' + TYPE + '/test/'
     ## load data: sequence
@@ -441,6 +452,12 @@ def evaluate(CELL, TYPE, NUM_ENSEMBL=1, ngram=6, batch_size=128, num_parallel_ca
     region2_seq, _ = load_all_data(test_promoter_files, ngram=ngram, only_one_slice=True,
                                    ngram_index=1)
 
+    # Sort by enhancer length so that neighbouring samples in a batch have similar lengths,
+    # the predictions are restored to the original order with unsort
+    order = None
+    if length_batching:
+        order, region1_seq, region2_seq, label = sort_by_length(region1_seq, region2_seq, label)
+
     bag_pred = np.zeros((NUM_ENSEMBL, label.shape[0]))
     bag_score = np.zeros((NUM_ENSEMBL, label.shape[0]))
 
@@ -474,7 +491,10 @@ def evaluate(CELL, TYPE, NUM_ENSEMBL=1, ngram=6, batch_size=128, num_parallel_ca
                                                             masked=False,
                                                             )
         # valid_dataset = valid_dataset.shuffle(len(label), reshuffle_each_iteration=True)
-        valid_dataset = valid_dataset.batch(batch_size)
+        if length_batching:
+            valid_dataset = batch_by_length(valid_dataset, batch_size, sequence_groups=((0, 1), (2, 3)))
+        else:
+            valid_dataset = valid_dataset.batch(batch_size)
         valid_dataset = valid_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -482,11 +502,15 @@ def evaluate(CELL, TYPE, NUM_ENSEMBL=1, ngram=6, batch_size=128, num_parallel_ca
         eval = model.evaluate(valid_dataset, steps=steps_per_epoch, verbose=2)
         print("eval: ", eval)
 
-        score = model.predict(valid_dataset, steps=steps_per_epoch)
+        score = InferenceModel(model).predict(valid_dataset)
         score = score[:len(label)]
         bag_pred[t, :] = (score > 0.5).astype(int).reshape(-1)
         bag_score[t, :] = score.reshape(-1)
 
+    if order is not None:
+        label = unsort(label, order)
+        bag_pred = unsort(bag_pred.T, order).T
+        bag_score = unsort(bag_score.T, order).T
 
     f1, auprc = bagging_predict(label, bag_pred, bag_score)
     print(f1, auprc)
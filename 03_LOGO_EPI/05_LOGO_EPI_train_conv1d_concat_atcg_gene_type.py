@@ -21,6 +21,8 @@ sys.path.append("../")
 from bgi.bert4keras.models import build_transformer_model
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.bucket_utils import get_bucket_boundaries, bucket_by_length
 
 include_types = ['enhancer',
                  'promoter',
@@ -104,13 +106,9 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
             if ngram_index is not None and ii != ngram_index:
                 continue
             kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-            x_data_slice = x_data[:, slice_indexes]
+            x_data_slice = get_ngram_frame(x_data, kk, ngram)
             x_data_all.append(x_data_slice)
-            x_annotation_slice = x_annotation[:, :, slice_indexes]
+            x_annotation_slice = get_ngram_frame(x_annotation, kk, ngram)
             anno_data_all.append(x_annotation_slice)
 
             y_data_all.append(y_data)
@@ -432,7 +430,8 @@ def train_kfold(CELL, TYPE,
                 NUM_SEQ=4,
                 vocab_size=10000,
                 ENHANCER_RESIZED_LEN=2000,
-                PROMOTER_RESIZED_LEN=1000):
+                PROMOTER_RESIZED_LEN=1000,
+                num_buckets=None):
     # Distributed Training
     num_gpu = 1
     strategy = tf.distribute.MirroredStrategy()
@@ -481,6 +480,18 @@ def train_kfold(CELL, TYPE,
     enhancer_seq_len = ENHANCER_RESIZED_LEN // ngram // ngram * ngram
     promoter_seq_len = PROMOTER_RESIZED_LEN // ngram // ngram * ngram
 
+    # Length-bucketed batching on the enhancer length: each batch is only padded to its longest enhancer/promoter,
+    # the annotation tracks are trimmed together with their tokens
+    bucket_boundaries = None
+    if num_buckets is not None and num_buckets > 1:
+        bucket_boundaries = get_bucket_boundaries(enhancer_seq_len, num_buckets=num_buckets)
+        print("bucket_boundaries: ", bucket_boundaries)
+
+    def batch_dataset(dataset):
+        if bucket_boundaries is None:
+            return dataset.batch(batch_size)
+        return bucket_by_length(dataset, batch_size, bucket_boundaries, sequence_groups=((0, 1, 2), (3, 4, 5)))
+
     k_fold = 0
     for train, test in kfold.split(X, Y):
         early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_acc', patience=3)
@@ -539,7 +550,7 @@ def train_kfold(CELL, TYPE,
                                                             )
 
         # train_dataset = train_dataset.shuffle(train_total_size, reshuffle_each_iteration=True)
-        train_dataset = train_dataset.batch(batch_size)
+        train_dataset = batch_dataset(train_dataset)
         train_dataset = train_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -560,7 +571,7 @@ def train_kfold(CELL, TYPE,
                                                             masked=False,
                                                             annotation_size=annotation_size,
                                                             )
-        valid_dataset = valid_dataset.batch(batch_size)
+        valid_dataset = batch_dataset(valid_dataset)
         valid_dataset = valid_dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
         valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -13,7 +13,7 @@ from tqdm import tqdm
 import threading
 
 sys.path.append("../../")
-from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_kmer_lookup_table, number_codes_to_kmer_ids
 
 
 def preccess_data(slice,
@@ -22,7 +22,7 @@ def preccess_data(slice,
                   step,
                   n_gram,
                   n_gram_value,
-                  num_word_dict,
+                  kmer_lut,
                   train_counter,
                   train_path,
                   output_path,
@@ -36,7 +36,7 @@ def preccess_data(slice,
     :param step:
     :param n_gram:
     :param n_gram_value:
-    :param num_word_dict:
+    :param kmer_lut: k-mer lookup table, same ids as get_word_dict_for_n_gram_number
     :param train_counter:
     :param train_path:
     :return:
@@ -57,20 +57,7 @@ def preccess_data(slice,
     for jj in range(slice):
         actg = np.matmul(slice_data[:, :, jj], actg_value)
         # for ss in range(n_gram):
-        gene = []
-        for kk in range(0, len(actg), step):
-            actg_temp_value = 0
-            if kk + n_gram <= len(actg):
-                actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                actg_temp_value = int(actg_temp_value)
-            else:
-                for gg in range(kk, len(actg)):
-                    actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-
-                # print("10 ** (kk % n_gram): ", 10 ** (kk % n_gram))
-                actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-            gene.append(num_word_dict.get(actg_temp_value, 0))
+        gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step)
 
         x_train.append(np.array(gene))
         y_train.append(slice_label[:, jj])
@@ -131,7 +118,8 @@ def load_data_from_mat_file(train_path='train.mat',
         n_gram_value[ii] = int(n_gram_value[ii] * (10 ** (n_gram - ii - 1)))
     print("n_gram_value: ", n_gram_value)
 
-    num_word_dict = get_word_dict_for_n_gram_number(n_gram=n_gram)
+    # Same ids as get_word_dict_for_n_gram_number(n_gram=n_gram)
+    kmer_lut = get_kmer_lookup_table(n_gram, number_keys=True)
 
     # Train set
     if train_path is not None:
@@ -153,7 +141,7 @@ def load_data_from_mat_file(train_path='train.mat',
             slice_label = labels[:, ii * slice:min((ii + 1) * slice, data.shape[2])]
 
             pool.apply_async(preccess_data, args=(
-            slice, ii, actg_value, step, n_gram, n_gram_value, num_word_dict, ii, train_path, output_path, slice_data,
+            slice, ii, actg_value, step, n_gram, n_gram_value, kmer_lut, ii, train_path, output_path, slice_data,
             slice_label))
 
         pool.close()
@@ -178,17 +166,7 @@ def load_data_from_mat_file(train_path='train.mat',
         index = 0
         for ii in tqdm(range(data.shape[0])):
             actg = np.matmul(actg_value, data[ii, :, :])
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step)
 
             x_test.append(np.array(gene))
             y_test.append(labels[ii])
@@ -255,17 +233,7 @@ def load_data_from_mat_file(train_path='train.mat',
         index = 0
         for ii in range(data.shape[0]):
             actg = np.matmul(actg_value, data[ii, :, :])
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step)
 
             x_valid.append(np.array(gene))
             y_valid.append(labels[ii])
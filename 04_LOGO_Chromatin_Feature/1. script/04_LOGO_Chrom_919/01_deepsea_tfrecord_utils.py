@@ -1,5 +1,4 @@
 import os
-import random
 from multiprocessing import Pool
 import argparse
 import sys
@@ -10,6 +9,10 @@ import tensorflow.keras.backend as K
 
 sys.path.append("../../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
+from bgi.common.tfrecord_utils import write_to_tfrecord, create_token_feature, int64_feature
+from bgi.common.mlm_utils import add_cls_sep, mask_tokens
+from bgi.common.pool_utils import apply_async_bounded
+from bgi.common.kmer_utils import get_ngram_frame
 
 
 def generate_pretrain_samples(train_data,
@@ -23,7 +26,9 @@ def generate_pretrain_samples(train_data,
                               shuffle=True,
                               batch_size: int = 32,
                               output_path: str = '',
-                              file_name: str = ''
+                              file_name: str = '',
+                              seed: int = None,
+                              token_schema: str = 'int64'
                               ):
     """
     Generate mask string
@@ -35,75 +40,40 @@ def generate_pretrain_samples(train_data,
         mask_token_id:
         sep_token_id:
         word_from_index:
+        seed: Seed of the masking Generator, a fresh one by default
+        token_schema: 'int64' one int64 per token; 'bytes' the whole sequence as little-endian uint16 bytes
 
     Returns:
 
     """
 
-    batch_len = len(train_data)  # int(len(train_data) // batch_size) * batch_size
+    batch_len = len(train_data)
+
+    # One seeded Generator draws all mask positions and 80/10/10 decisions of the slice at once
+    rng = np.random.default_rng(seed)
+    indexes = np.arange(batch_len)
+    if shuffle is True:
+        indexes = rng.permutation(batch_len)
 
     if is_sep_mask:
-        sequence = np.zeros((batch_len, train_data.shape[1] + 2), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1] + 2), dtype=np.int32)
-        # segment_id = np.zeros_like(sequence, dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle == True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-
-            sequence[ii, 0] = cls_token_id
-            sequence[ii, 1:-1] = train_data[index, :]
-            sequence[ii, -1] = sep_token_id
-            masked_sequence[ii] = sequence[ii]
-
-            for word_pos in range(1, len(sequence[ii]) - 1):
-                if random.random() < 0.15:
-                    dice = random.random()
-                    if dice < 0.8:
-                        masked_sequence[ii, word_pos + 1] = mask_token_id
-                    elif dice < 0.9:
-                        masked_sequence[ii, word_pos + 1] = random.randint(first_token_id, last_token_id)
-                    # else: 10% of the time we just leave the word as is
-                    # output_mask[ii, word_pos] = 1
-        # return segment_id, sequence, masked_sequence
+        sequence = add_cls_sep(train_data[indexes], cls_token_id, sep_token_id)
+        # Every position is selected with 15% probability, [CLS] and [SEP] are never replaced
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='bernoulli', rng=rng)
 
     else:
-        sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-        # segment_id = np.zeros_like(sequence, dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle == True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-            sequence[ii] = train_data[index]
-            masked_sequence[ii] = train_data[index]
-
-            choice_index = np.random.choice(len(sequence[ii]), int(len(sequence[ii]) * 0.15))
-            for word_pos in choice_index:
-                if sequence[ii, word_pos] < word_from_index:
-                    continue
-
-                dice = random.random()
-                if dice < 0.8:
-                    masked_sequence[ii, word_pos] = mask_token_id
-                elif dice < 0.9:
-                    masked_sequence[ii, word_pos] = random.randint(first_token_id, last_token_id)
-                # else: 10% of the time we just leave the word as is
-                # output_mask[ii, word_pos] = 1
-        # return segment_id, sequence, masked_sequence
+        sequence = np.asarray(train_data[indexes], dtype=np.int32)
+        # Mask 15% tokens, positions are drawn with replacement as np.random.choice did
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='choice', rng=rng)
 
     # sequence = np.reshape(sequence, (sequence.shape[0], sequence.shape[1], 1))
     print("masked_sequence: ", masked_sequence.shape)
     print("sequence: ", sequence.shape)
 
     # Save to system file
-    serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'])
+    serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'],
+                                              token_schema=token_schema)
 
     if os.path.exists(output_path) is False:
         os.makedirs(output_path)
@@ -124,7 +94,8 @@ def generate_samples(x_data,
                      shuffle=True,
                      batch_size: int = 32,
                      output_path: str = '',
-                     file_name: str = ''
+                     file_name: str = '',
+                     token_schema: str = 'int64'
                      ):
     """
     Generate mask string
@@ -136,6 +107,7 @@ def generate_samples(x_data,
         mask_token_id:
         sep_token_id:
         word_from_index:
+        token_schema: Schema of the token sequence 'x', the labels 'y' are always int64
 
     Returns:
 
@@ -144,44 +116,81 @@ def generate_samples(x_data,
     print("x_data: ", x_data.shape)
     print("y_data: ", y_data.shape)
     # Save to system file
-    serialized_instances = tfrecord_serialize([x_data, y_data], ['x', 'y'])
+    serialized_instances = tfrecord_serialize([x_data, y_data], ['x', 'y'], token_schema=token_schema, token_keys=['x'])
     if os.path.exists(output_path) is False:
         os.makedirs(output_path)
     write_to_tfrecord(os.path.join(output_path, file_name), serialized_instances)
     print("Save: ", os.path.join(output_path, file_name))
 
 
-def tfrecord_serialize(instances, instance_keys):
-    """Converted to tfrecord string, waiting to be written to the file
+def tfrecord_serialize(instances, instance_keys, token_schema='int64', token_keys=None):
+    """Converted to tfrecord string, yielded one by one and written as they are produced
+    token_keys: Features stored with token_schema, all by default; the others are stored as int64
     """
+    if token_keys is None:
+        token_keys = instance_keys
 
-    def create_feature(x):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=x))
+    def create_feature(k, x):
+        if k in token_keys:
+            return create_token_feature(x, token_schema)
+        return int64_feature(x)
 
-    serialized_instances = []
     for instance in zip(*instances):
         if len(instance) != len(instance_keys):
             continue
 
         features = {
-            k: create_feature(v)
+            k: create_feature(k, v)
             for k, v in zip(instance_keys, instance)
         }
         tf_features = tf.train.Features(feature=features)
         tf_example = tf.train.Example(features=tf_features)
         serialized_instance = tf_example.SerializeToString()
-        serialized_instances.append(serialized_instance)
+        yield serialized_instance
 
-    return serialized_instances
 
+def generate_samples_from_file(train_file, frame, ngram, task, token_schema, *args):
+    """
+    Read one .npz (or its frame-th frame) in the worker and generate the samples, the parent only passes the file path
+    :param train_file:
+    :param frame: Index of the frame, None for the whole sequence
+    :param ngram:
+    :param task: 'pretrain' or classification
+    :param token_schema:
+    :param args: The other arguments of generate_pretrain_samples / generate_samples
+    :return: train_file, frame, number of samples
+    """
+    with np.load(train_file) as loaded:
+        x_data = loaded['x']
+        y_data = loaded['y']
+    if frame is not None:
+        x_data = get_ngram_frame(x_data, frame, ngram)
 
-def write_to_tfrecord(record_name, serialized_instances):
-    options = tf.io.TFRecordOptions(
-        compression_type=tf.io.TFRecordOptions.compression_type_map.get('ZLIB'))
+    if task == 'pretrain':
+        generate_pretrain_samples(x_data, *args, token_schema=token_schema)
+    else:
+        generate_samples(x_data, y_data, *args, token_schema=token_schema)
+    return train_file, frame, len(x_data)
 
-    writer = tf.io.TFRecordWriter(record_name, options)
-    for serialized_instance in serialized_instances:
-        writer.write(serialized_instance)
+
+def get_tasks(train_data_path: str, ngram: int, only_one_slice: bool, task: str, token_schema: str,
+              sample_args: tuple):
+    """
+    One task per frame of each file, only the file path and the frame are sent, workers read the data themselves
+    """
+    for file_name in sorted(os.listdir(train_data_path)):
+        if str(file_name).endswith('.npz') is False:
+            continue
+        train_file = os.path.join(train_data_path, file_name)
+        base_name = file_name[:-len('.npz')]
+
+        frames = range(ngram) if only_one_slice is True else [None]
+        for frame in frames:
+            if frame is None:
+                tf_file_name = base_name + '.tfrecord'
+            else:
+                tf_file_name = base_name + '_{}.tfrecord'.format(str(frame))
+            yield (train_file, frame, ngram, task, token_schema) + sample_args + (tf_file_name,)
 
 
 def prepare_pretrain_data(train_data_path: str,
@@ -199,113 +208,36 @@ def prepare_pretrain_data(train_data_path: str,
                           shuffle=True,
                           batch_size: int = 32,
                           only_one_slice: bool = True,
-                          task: str = 'task'
+                          task: str = 'task',
+                          token_schema: str = 'int64'
                           ):
-    files = os.listdir(train_data_path)
-
-    # Generate data in parallel
+    sample_args = (first_token_id,
+                   last_token_id,
+                   CLS_ID,
+                   MASK_ID,
+                   PAD_ID,
+                   word_from_index,
+                   is_sep_mask,
+                   shuffle,
+                   batch_size,
+                   output_path,
+                   )
+
+    # Generate data in parallel, at most pool_size * 2 tasks are submitted at a time
     pool = Pool(processes=pool_size)
-    results = []
-    for file_name in files:
-
-        if str(file_name).endswith('.npz') is False:
-            continue
-        train_file = os.path.join(train_data_path, file_name)
-        print("File: ", train_file)
-        loaded = np.load(train_file)
-        x_data = loaded['x']
-        y_data = loaded['y']
-
-        print("x_data: ", x_data.shape)
-        print("y_data: ", y_data.shape)
-
-        tf_file_name = file_name.replace('.npz', '.tfrecord')
-        # Read all data
-        if only_one_slice is True:
-            # kk = random.randint(0, int(ngram) - 1)
-            for kk in range(ngram):
-                slice_indexes = []
-                max_slice_seq_len = x_data.shape[1] // ngram * ngram
-                for gg in range(kk, max_slice_seq_len, ngram):
-                    slice_indexes.append(gg)
-
-                print("max_slice_seq_len: ", max_slice_seq_len, kk)
-                print("slice_indexes: ", len(slice_indexes))
-                suffix = '_{}.tfrecord'.format(str(kk))
-                tf_file_name = tf_file_name.replace('.tfrecord', suffix)
-
-                print(task, 'pretrain', (task == 'pretrain'))
-
-                if task == 'pretrain':
-                    print("generate_pretrain_samples")
-                    pool.apply_async(generate_pretrain_samples,
-                                     args=(x_data[:, slice_indexes],
-                                           # y_data,
-                                           first_token_id,
-                                           last_token_id,
-                                           CLS_ID,
-                                           MASK_ID,
-                                           PAD_ID,
-                                           word_from_index,
-                                           is_sep_mask,
-                                           shuffle,
-                                           batch_size,
-                                           output_path,
-                                           tf_file_name,
-                                           ))
-                else:
-                    pool.apply_async(generate_samples,
-                                     args=(x_data[:, slice_indexes],
-                                           y_data,
-                                           first_token_id,
-                                           last_token_id,
-                                           CLS_ID,
-                                           MASK_ID,
-                                           PAD_ID,
-                                           word_from_index,
-                                           is_sep_mask,
-                                           shuffle,
-                                           batch_size,
-                                           output_path,
-                                           tf_file_name,
-                                           ))
-
-        else:
-            if task == 'pretrain':
-                pool.apply_async(generate_pretrain_samples,
-                                 args=(x_data,
-                                       # y_data,
-                                       first_token_id,
-                                       last_token_id,
-                                       CLS_ID,
-                                       MASK_ID,
-                                       PAD_ID,
-                                       word_from_index,
-                                       is_sep_mask,
-                                       shuffle,
-                                       batch_size,
-                                       output_path,
-                                       tf_file_name,
-                                       ))
-            else:
-                pool.apply_async(generate_samples,
-                                 args=(x_data,
-                                       y_data,
-                                       first_token_id,
-                                       last_token_id,
-                                       CLS_ID,
-                                       MASK_ID,
-                                       PAD_ID,
-                                       word_from_index,
-                                       is_sep_mask,
-                                       shuffle,
-                                       batch_size,
-                                       output_path,
-                                       tf_file_name,
-                                       ))
+    tasks = get_tasks(train_data_path, ngram, only_one_slice, task, token_schema, sample_args)
+    results, errors = apply_async_bounded(pool, generate_samples_from_file, tasks, max_in_flight=pool_size * 2)
     pool.close()
     pool.join()
 
+    for _, (train_file, frame, num_samples) in results:
+        print("Done: ", train_file, frame, num_samples)
+    for args, message in errors:
+        print("Failed: ", args[0], args[1])
+        print(message)
+    if len(errors) > 0:
+        raise RuntimeError("{} of {} tasks failed".format(len(errors), len(results) + len(errors)))
+
 
 if __name__ == '__main__':
     _argparser = argparse.ArgumentParser(
@@ -345,6 +277,9 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--task', type=str, default='pretain', metavar='NAME',
         help='Task name')
+    _argparser.add_argument(
+        '--token-schema', type=str, default='int64', choices=['int64', 'bytes'],
+        help='Store each token as an int64, or each sequence as one little-endian uint16 bytes feature (~4x smaller)')
 
     _args = _argparser.parse_args()
 
@@ -359,6 +294,7 @@ if __name__ == '__main__':
     # hg_name = _args.hg_name
     pool_size = _args.pool_size
     task = _args.task
+    token_schema = _args.token_schema
 
     word_index_from = 10
     word_dict_alphabet = get_word_dict_for_n_gram_alphabet(n_gram=ngram, word_index_from=10)
@@ -380,4 +316,5 @@ if __name__ == '__main__':
                           word_from_index=word_index_from,
                           batch_size=global_batch_size,
                           task=task,
+                          token_schema=token_schema,
                           )
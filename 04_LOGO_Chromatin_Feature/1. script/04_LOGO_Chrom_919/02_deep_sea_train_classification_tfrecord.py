@@ -9,22 +9,24 @@ import sys
 import numpy as np
 
 import tensorflow as tf
-from tensorflow.keras.callbacks import ModelCheckpoint
-from sklearn.metrics import roc_auc_score
-from tensorflow.keras.layers import Lambda, Dense
-from multiprocessing import Pool
 import tensorflow.keras.backend as K
 
 sys.path.append("../../")
-from bgi.bert4keras.models import build_transformer_model
-from bgi.common.callbacks import LRSchedulerPerStep
+from bgi.bert4keras.backend import MIXED_PRECISION_POLICIES, check_mixed_precision
+from bgi.bert4keras.models import build_transformer_model, load_weights_by_layer, add_cls_head, InferenceModel
+from bgi.common.callbacks import LRSchedulerPerStep, AsyncCheckpoint, get_profiling_callbacks
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.metrics import roc_auc_and_average_precision
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
 
 from bgi.bert4keras.optimizers import Adam
 from bgi.bert4keras.optimizers import extend_with_weight_decay
 from bgi.bert4keras.optimizers import extend_with_layer_adaptation
 from bgi.bert4keras.optimizers import extend_with_piecewise_linear_lr
 from bgi.bert4keras.optimizers import extend_with_gradient_accumulation
+from bgi.bert4keras.optimizers import get_optimizer, OPTIMIZERS
 
 from bgi.bert4keras.lamb import LAMB
 
@@ -73,19 +75,27 @@ def load_dictionary(config_path, encoding="utf-8"):
 
 
 def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parallel_calls=tf.data.experimental.AUTOTUNE,
-                  batch_size=32):
+                  batch_size=32, token_schema=None, shuffle_size=0, repeat=False, deterministic=True, cache=None,
+                  prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
     """
-    parse_function
+    Batched dataset of the DeepSEA tfrecords, each batch is parsed at once by tf.io.parse_example
+    token_schema: 'int64' or 'bytes' (uint16 bytes decoded by tf.io.decode_raw), detected from the first record by default
+    shuffle_size, repeat, deterministic, cache, prefetch_buffer_size: See bgi.common.tfrecord_utils.load_tfrecord_dataset
     """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'x')
 
     def parse_function(serialized):
         features = {
-            'x': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'x': get_token_feature_spec(sequence_length, token_schema),
             # 'segmentId': tf.io.FixedLenFeature([sequence_length], tf.int64),
             'y': tf.io.FixedLenFeature([num_classes], tf.int64),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['x']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['x'], sequence_length, token_schema)
+        # One zero segment tensor per batch
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
         sequence = features['y']
         x = {
@@ -98,11 +108,15 @@ def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parall
 
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
-
-    dataset = tf.data.TFRecordDataset(record_names)
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+    dataset = load_tfrecord_dataset(record_names,
+                                    parse_function,
+                                    batch_size,
+                                    shuffle_size=shuffle_size,
+                                    repeat=repeat,
+                                    deterministic=deterministic,
+                                    num_parallel_calls=num_parallel_calls,
+                                    cache=cache,
+                                    prefetch_buffer_size=prefetch_buffer_size)
     return dataset
 
 
@@ -129,77 +143,40 @@ def load_npz_record(x_data, y_data):
     return dataset
 
 
+def print_median_scores(aucs, auprcs):
+    """
+    Median ROC-AUC / AUPRC of the TF, DNase and histone mark classes, classes with a single label (nan) are skipped
+    """
+    for name, scores in [('AUCs', aucs), ('AUPRCs', auprcs)]:
+        print('Median ' + name)
+        print('- Transcription factors: %.3f' % np.nanmedian(scores[124:124 + 690]))
+        print('- DNase I-hypersensitive sites: %.3f' % np.nanmedian(scores[:124]))
+        print('- Histone marks: %.3f' % np.nanmedian(scores[124 + 690:124 + 690 + 104]))
+
+
 def pred_result_auc_BiPath(y_pred, y_label):
     print("y_pred: ", y_pred.shape)
     print("y_label: ", y_label.shape)
 
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
-    min_len = min(len(y_label), len(y_pred_val))
-
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-    for ii in range(y_pred_val.shape[1]):
-        try:
-            auc = roc_auc_score(y_label[:, ii][:min_len], y_pred_val[:, ii][:min_len])
-            aucs[ii] = auc
-        except ValueError:
-            a = 1
-
-    print('Median AUCs')
-    print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
-    print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
-    print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
+    aucs, auprcs = roc_auc_and_average_precision(y_label, y_pred_val)
+    print_median_scores(aucs, auprcs)
 
 
-# Parallel computing ROC_AUC
-def calc_roc_auc_score(index, y_label_slice, y_pred_slice):
-    auc = 0
-    try:
-        auc = roc_auc_score(y_label_slice, y_pred_slice)
-    except ValueError:
-        auc = 0
-    return index, auc
-
-
-def pred_result_auc_BiPath_list(y_preds, y_label, pool_size=8):
-    all_y_pred = None
-
+def pred_result_auc_BiPath_list(y_preds, y_label):
+    """
+    Average the predictions of the ngram frames, then score all classes at once (each column is sorted once)
+    """
     print("y_pred: ", len(y_preds))
     print("y_label: ", y_label.shape)
-    for jj in range(len(y_preds)):
-        y_pred = y_preds[jj]
-        if all_y_pred is None:
-            all_y_pred = y_pred
-        else:
-            all_y_pred += y_pred
-
-    y_pred = all_y_pred / len(y_preds)
+
+    y_pred = sum(y_preds) / len(y_preds)
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
     y_pred_val = y_pred_val[:, 0:919]
 
-    min_len = min(len(y_label), len(y_pred_val))
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-
-    pool = Pool(processes=pool_size)
-    results = []
-    for index in range(y_pred_val.shape[1]):
-        result = pool.apply_async(calc_roc_auc_score,
-                                  args=(index,
-                                        y_label[:, index][:min_len],
-                                        y_pred_val[:, index][:min_len]
-                                        ))
-        results.append(result)
-    pool.close()
-    pool.join()
-
-    # Summary results
-    for result in results:
-        index, auc = result.get()
-        # print(index, auc)
-        aucs[index] = auc
-    print('Median AUCs')
-    print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
-    print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
-    print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
+    aucs, auprcs = roc_auc_and_average_precision(y_label[:, 0:919], y_pred_val)
+    print_median_scores(aucs, auprcs)
+    return aucs, auprcs
 
 
 if __name__ == '__main__':
@@ -309,12 +286,52 @@ if __name__ == '__main__':
         '--prefetch-buffer-size', type=int, default=4, metavar='INTEGER',
         help='Prefetch buffer size')
     _argparser.add_argument(
-        '--pool-size', type=int, default=16, metavar='INTEGER',
-        help='Pool size of multi-thread')
+        '--non-deterministic', action='store_true',
+        help='Let tf.data return records out of order for higher throughput')
+    _argparser.add_argument(
+        '--cache', type=str, default=None, metavar='PATH',
+        help='Cache the serialized records, "memory" or a cache file path')
     _argparser.add_argument(
         '--optimizer', type=str, default='adam', metavar='NAME',
-        choices=['adam', 'lamb'],
-        help='The type of the task')
+        choices=OPTIMIZERS,
+        help='The type of the optimizer')
+    _argparser.add_argument(
+        '--mixed-precision', type=str, default='float32', metavar='NAME',
+        choices=MIXED_PRECISION_POLICIES,
+        help='Mixed precision policy, mixed_float16 for GPU (with loss scaling), mixed_bfloat16 for TPU/CPU; both need tf >= 2.1')
+    _argparser.add_argument(
+        '--grad-accum-steps', type=int, default=1, metavar='INTEGER',
+        help='Accumulate gradients over this many batches before each update')
+    _argparser.add_argument(
+        '--fused-qkv', action='store_true',
+        help='Compute the attention q/k/v projections with a single matmul, separate q/k/v weights still load')
+    _argparser.add_argument(
+        '--attention-window', type=int, default=None, metavar='INTEGER',
+        help='Use local attention: each token attends to this many tokens on either side (memory O(L * window))')
+    _argparser.add_argument(
+        '--attention-global-tokens', type=int, default=1, metavar='INTEGER',
+        help='With --attention-window, the number of leading tokens (e.g. CLS) that attend to and are attended by all')
+    _argparser.add_argument(
+        '--fused-conv-embedding', action='store_true',
+        help='With --use-conv, run the 2/3/5-wide embedding convolutions as one fused Conv1D')
+    _argparser.add_argument(
+        '--profile-log', type=str, default=None, metavar='PATH',
+        help='Log step time, throughput and peak RSS per step to this .csv (or JSON lines) file')
+    _argparser.add_argument(
+        '--benchmark-input-steps', type=int, default=50, metavar='INTEGER',
+        help='With --profile-log, time the input pipeline alone over this many batches first (0 to skip)')
+    _argparser.add_argument(
+        '--trace-steps', type=str, default=None, metavar='START,END',
+        help='Record a tf.profiler trace of the steps [START, END) into <save>/profile')
+    _argparser.add_argument(
+        '--save-steps', type=int, default=None, metavar='INTEGER',
+        help='Also save a checkpoint every this many steps')
+    _argparser.add_argument(
+        '--keep-checkpoints', type=int, default=None, metavar='INTEGER',
+        help='Keep only the latest N checkpoints (plus --keep-best-checkpoints), default keeps all')
+    _argparser.add_argument(
+        '--keep-best-checkpoints', type=int, default=1, metavar='INTEGER',
+        help='With --keep-checkpoints, also keep the best N checkpoints by the monitored loss')
     _argparser.add_argument(
         '--use-position', action='store_true',
         help='Using position ids')
@@ -375,8 +392,17 @@ if __name__ == '__main__':
     shuffle_size = _args.shuffle_size
     num_parallel_calls = _args.num_parallel_calls
     prefetch_buffer_size = _args.prefetch_buffer_size
+    deterministic = not _args.non_deterministic
+    cache = _args.cache
     steps_per_epoch = _args.steps_per_epoch
     train_optimizer = _args.optimizer
+    # Fail before loading data if this tensorflow does not support the policy (mixed_* needs tf >= 2.1)
+    mixed_precision = check_mixed_precision(_args.mixed_precision)
+    grad_accum_steps = _args.grad_accum_steps
+    fused_qkv = _args.fused_qkv
+    attention_window = _args.attention_window
+    attention_global_tokens = _args.attention_global_tokens
+    fused_conv_embedding = _args.fused_conv_embedding
 
     word_seq_len = max_seq_len // ngram
     print("max_seq_len: ", max_seq_len, " word_seq_len: ", word_seq_len)
@@ -397,7 +423,7 @@ if __name__ == '__main__':
             "hidden_size": model_dim,
             "initializer_range": 0.02,
             "intermediate_size": model_dim * 4,
-            "max_position_embeddings": 512,
+            "max_position_embeddings": max(512, word_seq_len),
             "num_attention_heads": num_heads,
             "num_hidden_layers": max_depth,
             "num_hidden_groups": 1,
@@ -418,29 +444,32 @@ if __name__ == '__main__':
             # checkpoint_path=checkpoint_path,
             model='bert',
             return_keras_model=False,
+            mixed_precision=mixed_precision,
+            fused_qkv=fused_qkv,
+            attention_window=attention_window,
+            attention_global_tokens=attention_global_tokens,
+            fused_conv_embedding=fused_conv_embedding,
         )
 
-        output = Lambda(lambda x: x[:, 0], name='CLS-token')(bert.model.output)
         # output = tf.keras.layers.GlobalMaxPool1D()(bert.model.output)
-        output = Dense(
-            name='CLS-Activation',
-            units=num_classes,
-            activation='sigmoid',
-            kernel_initializer=bert.initializer
-        )(output)
-
-        albert = tf.keras.models.Model(bert.model.input, output)
+        albert = add_cls_head(bert, num_classes, activation='sigmoid')
         albert.summary()
 
         # Optimizer
-        optimizer = 'adam'
+        optimizer = get_optimizer(train_optimizer,
+                                  grad_accum_steps=grad_accum_steps,
+                                  mixed_precision=mixed_precision)
         albert.compile(optimizer=optimizer, loss=[tf.keras.losses.BinaryCrossentropy()],
                        metrics=['accuracy', tf.keras.metrics.AUC()])
 
     with strategy.scope():
         pretrain_weight_path = _args.weight_path
         if pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
-            albert.load_weights(pretrain_weight_path, by_name=True)
+            if fused_qkv or fused_conv_embedding:
+                # Weights saved with separate q/k/v projections or embedding convolutions are fused layer by layer
+                load_weights_by_layer(albert, pretrain_weight_path)
+            else:
+                albert.load_weights(pretrain_weight_path, by_name=True)
             print("Load weights: ", pretrain_weight_path)
 
     lr_scheduler = LRSchedulerPerStep(model_dim,
@@ -451,12 +480,24 @@ if __name__ == '__main__':
     loss_name = "val_loss"
     # LOG_FILE_PATH = LoG_PATH + '_checkpoint-{}.hdf5'.format(epoch)
     filepath = os.path.join(save_path, model_name + "_weights_{epoch:02d}-{accuracy:.6f}-{val_accuracy:.6f}.hdf5")
+    if _args.save_steps is not None:
+        # Step checkpoints have no validation metrics, they show up as nan in the name
+        filepath = os.path.join(save_path,
+                                model_name + "_weights_{epoch:02d}-{step}-{accuracy:.6f}-{val_accuracy:.6f}.hdf5")
 
     GLOBAL_BATCH_SIZE = batch_size * num_gpu
     print("GLOBAL_BATCH_SIZE: ", GLOBAL_BATCH_SIZE)
+    print("effective batch size: ", GLOBAL_BATCH_SIZE * grad_accum_steps)
     print("shuffle_size: ", shuffle_size)
 
-    mc = ModelCheckpoint(filepath, monitor=loss_name, save_best_only=False, verbose=1)
+    # Weights are written on a background thread, only the latest --keep-checkpoints and the best
+    # --keep-best-checkpoints files are kept
+    mc = AsyncCheckpoint(filepath,
+                         monitor=loss_name,
+                         keep_last=_args.keep_checkpoints,
+                         keep_best=_args.keep_best_checkpoints,
+                         save_steps=_args.save_steps,
+                         verbose=1)
 
     is_training = False
     task = _args.task
@@ -478,16 +519,26 @@ if __name__ == '__main__':
                 valid_slice_files.append(os.path.join(valid_data_path, file_name))
 
         train_dataset = load_tfrecord(train_slice_files, sequence_length=word_seq_len, num_classes=num_classes,
-                                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        train_dataset = train_dataset.shuffle(GLOBAL_BATCH_SIZE * shuffle_size, reshuffle_each_iteration=True).batch(
-            GLOBAL_BATCH_SIZE)
-        train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
-        train_dataset = train_dataset.repeat()
+                                      num_parallel_calls=num_parallel_calls,
+                                      batch_size=GLOBAL_BATCH_SIZE,
+                                      shuffle_size=GLOBAL_BATCH_SIZE * shuffle_size,
+                                      repeat=True,
+                                      deterministic=deterministic,
+                                      cache=cache,
+                                      prefetch_buffer_size=prefetch_buffer_size)
 
         valid_dataset = load_tfrecord(valid_slice_files, sequence_length=word_seq_len, num_classes=num_classes,
-                                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        valid_dataset = valid_dataset.batch(GLOBAL_BATCH_SIZE)
-        valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+                                      num_parallel_calls=num_parallel_calls,
+                                      batch_size=GLOBAL_BATCH_SIZE,
+                                      prefetch_buffer_size=prefetch_buffer_size)
+
+        profiling_callbacks = get_profiling_callbacks(train_dataset,
+                                                      GLOBAL_BATCH_SIZE,
+                                                      tokens_per_example=word_seq_len,
+                                                      profile_log=_args.profile_log,
+                                                      benchmark_input_steps=_args.benchmark_input_steps,
+                                                      trace_steps=_args.trace_steps,
+                                                      trace_dir=os.path.join(save_path, 'profile'))
 
         print("Training")
         print("batch size: ", GLOBAL_BATCH_SIZE)
@@ -496,7 +547,7 @@ if __name__ == '__main__':
                                          epochs=epochs,
                                          validation_data=valid_dataset,
                                          validation_steps=math.ceil(8000 / (GLOBAL_BATCH_SIZE)),
-                                         callbacks=[mc],
+                                         callbacks=[mc] + profiling_callbacks,
                                          verbose=verbose)
 
 
@@ -522,26 +573,21 @@ if __name__ == '__main__':
             for ii in range(ngram):
                 if only_one_slice is True:
                     kk = ii  # random.randint(0, stride - 1)
-                    slice_indexes = []
-                    max_slice_seq_len = x_valid.shape[1] // ngram * ngram
-
-                    print("max_slice_seq_len: ", max_slice_seq_len)
-                    for gg in range(kk, max_slice_seq_len, ngram):
-                        slice_indexes.append(gg)
-                    x_valid_slice = x_valid[:, slice_indexes]
-                    # print("slice_indexes: ", slice_indexes)
+                    x_valid_slice = get_ngram_frame(x_valid, kk, ngram)
                     # print("x_valid_slice: ", x_valid_slice.shape)
                     valid_data.append(x_valid_slice)
                 else:
                     valid_data.append(x_valid)
 
+        # Forward pass only, one traced graph for all batches
+        inference_model = InferenceModel(albert)
         y_preds = []
         print("__1__")
         for ii in range(len(valid_data)):
             valid_dataset = load_npz_record(valid_data[ii], y_valid)
             valid_dataset = valid_dataset.batch(GLOBAL_BATCH_SIZE)
             valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
-            y_pred = albert.predict(valid_dataset, steps=math.ceil(len(valid_data[0]) / (GLOBAL_BATCH_SIZE)))
+            y_pred = inference_model.predict(valid_dataset)
             y_preds.append(y_pred)
 
         print("__2__")
@@ -568,21 +614,17 @@ if __name__ == '__main__':
             for ii in range(ngram):
                 if only_one_slice is True:
                     kk = ii  # random.randint(0, stride - 1)
-                    slice_indexes = []
-                    max_slice_seq_len = x_test.shape[1] // ngram * ngram
-                    for gg in range(kk, max_slice_seq_len, ngram):
-                        slice_indexes.append(gg)
-                    x_test_slice = x_test[:, slice_indexes]
+                    x_test_slice = get_ngram_frame(x_test, kk, ngram)
                     test_data.append(x_test_slice)
                 else:
                     test_data.append(x_test)
+        inference_model = InferenceModel(albert)
         y_preds = []
         for ii in range(ngram):
             valid_dataset = load_npz_record(test_data[ii], y_test)
             valid_dataset = valid_dataset.batch(GLOBAL_BATCH_SIZE)
             valid_dataset = valid_dataset.prefetch(tf.data.experimental.AUTOTUNE)
-            y_pred = albert.predict(valid_dataset, steps=math.ceil(len(test_data[0]) / (GLOBAL_BATCH_SIZE)), verbose=1)
+            y_pred = inference_model.predict(valid_dataset)
             y_preds.append(y_pred)
 
-        pool_size = _args.pool_size
-        pred_result_auc_BiPath_list(y_preds, y_test, pool_size=pool_size)
+        pred_result_auc_BiPath_list(y_preds, y_test)
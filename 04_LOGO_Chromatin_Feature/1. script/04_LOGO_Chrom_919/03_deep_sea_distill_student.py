@@ -0,0 +1,412 @@
+# -*- coding:utf-8 -*-
+
+import argparse
+import math
+import os
+import sys
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.layers import Concatenate
+import tensorflow.keras.backend as K
+
+sys.path.append("../../")
+from bgi.bert4keras.models import build_transformer_model, add_cls_head, load_weights_by_layer
+from bgi.common.callbacks import AsyncCheckpoint
+from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.kmer_utils import get_ngram_frame
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
+from bgi.common.distill_utils import probability_to_logit, load_teacher_npz, soft_binary_crossentropy, \
+    distillation_loss, build_cnn_student, build_pair_student
+from bgi.bert4keras.optimizers import get_optimizer, OPTIMIZERS
+
+
+def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                  batch_size=32, token_schema=None, shuffle_size=0, repeat=False, deterministic=True, cache=None,
+                  prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
+    """
+    Batched dataset of the DeepSEA tfrecords, the labels are fed to the 'Distill-Logits' output
+    See load_tfrecord in 02_deep_sea_train_classification_tfrecord.py
+    """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'x')
+
+    def parse_function(serialized):
+        features = {
+            'x': get_token_feature_spec(sequence_length, token_schema),
+            'y': tf.io.FixedLenFeature([num_classes], tf.int64),
+        }
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['x'], sequence_length, token_schema)
+        segment_id = K.zeros_like(masked_sequence, dtype='int64')
+        x = {
+            'Input-Token': masked_sequence,
+            'Input-Segment': segment_id,
+        }
+        y = {
+            'Distill-Logits': features['y']
+        }
+        return x, y
+
+    return load_tfrecord_dataset(record_names,
+                                 parse_function,
+                                 batch_size,
+                                 shuffle_size=shuffle_size,
+                                 repeat=repeat,
+                                 deterministic=deterministic,
+                                 num_parallel_calls=num_parallel_calls,
+                                 cache=cache,
+                                 prefetch_buffer_size=prefetch_buffer_size)
+
+
+def load_teacher_dataset(teacher, ngram, batch_size, shuffle_size=0, repeat=False):
+    """
+    Dataset of ref/alt token pairs and the teacher logits saved by the predictor (--save-teacher).
+    The teacher scores are averaged over the ngram frames, every frame is one training example with the same target
+    """
+    ref_logits = probability_to_logit(teacher['p_ref'])
+    alt_logits = probability_to_logit(teacher['p_alt'])
+    diff_logits = alt_logits - ref_logits
+
+    x_ref = np.concatenate([get_ngram_frame(teacher['x_ref'], ii, ngram) for ii in range(ngram)])
+    x_alt = np.concatenate([get_ngram_frame(teacher['x_alt'], ii, ngram) for ii in range(ngram)])
+    x = {
+        'Input-Ref-Token': x_ref,
+        'Input-Alt-Token': x_alt,
+    }
+    y = {
+        'Ref-Logits': np.tile(ref_logits, (ngram, 1)),
+        'Alt-Logits': np.tile(alt_logits, (ngram, 1)),
+        'Logit-Diff': np.tile(diff_logits, (ngram, 1)),
+    }
+
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shuffle_size > 0:
+        dataset = dataset.shuffle(shuffle_size)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset, len(x_ref)
+
+
+def build_transformer_logits(model, num_classes, vocab_size, embedding_size, model_dim, num_heads, depth,
+                             max_position_embeddings, use_position=True, use_segment=True, use_conv=False, **kwargs):
+    """
+    Transformer with the same CLS head as the predictor, but a linear 'CLS-Activation' that outputs logits.
+    Activations have no weights, so the saved weights load into the sigmoid head of the predictor.
+    use_position/use_segment/use_conv and kwargs (fused_qkv, attention_window, ...) must match the model
+    the weights were trained with, see --use-position etc. of 02_deep_sea_train_classification_tfrecord.py
+    """
+    config = {
+        "attention_probs_dropout_prob": 0,
+        "hidden_act": "gelu",
+        "hidden_dropout_prob": 0,
+        "embedding_size": embedding_size,
+        "hidden_size": model_dim,
+        "initializer_range": 0.02,
+        "intermediate_size": model_dim * 4,
+        "max_position_embeddings": max_position_embeddings,
+        "num_attention_heads": num_heads,
+        "num_hidden_layers": depth,
+        "num_hidden_groups": 1,
+        "net_structure_type": 0,
+        "gap_size": 0,
+        "num_memory_blocks": 0,
+        "inner_group_num": 1,
+        "down_scale_factor": 1,
+        "type_vocab_size": 0,
+        "vocab_size": vocab_size,
+        "custom_masked_sequence": False,
+        "use_position_ids": use_position,
+        "custom_conv_layer": use_conv,
+        "use_segment_ids": use_segment
+    }
+    bert = build_transformer_model(
+        configs=config,
+        model=model,
+        return_keras_model=False,
+        **kwargs
+    )
+    return add_cls_head(bert, num_classes, activation=None)
+
+
+def list_files(data_path, suffix):
+    if os.path.isfile(data_path):
+        return [data_path]
+    return sorted(os.path.join(data_path, file_name) for file_name in os.listdir(data_path)
+                  if str(file_name).endswith(suffix))
+
+
+if __name__ == '__main__':
+
+    _argparser = argparse.ArgumentParser(
+        description='Distill a chromatin feature model into a small ALBERT or CNN student for variant pre-screening',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    _argparser.add_argument(
+        '--save', type=str, required=True, metavar='PATH',
+        help='A path where the student weights should be saved')
+    _argparser.add_argument(
+        '--model-name', type=str, default='student', metavar='NAME',
+        help='The name of the saving model')
+    _argparser.add_argument(
+        '--teacher-npz', type=str, metavar='PATH', default=None,
+        help='Teacher scores saved by GeneBert_predict_vcf_slice_e8.py --save-teacher (a file or a directory)')
+    _argparser.add_argument(
+        '--valid-teacher-npz', type=str, metavar='PATH', default=None,
+        help='Validation teacher scores (a file or a directory)')
+    _argparser.add_argument(
+        '--train-data', type=str, metavar='PATH', default=None,
+        help='Directory of the DeepSEA train tfrecords, used with --teacher-weight-path instead of --teacher-npz')
+    _argparser.add_argument(
+        '--valid-data', type=str, metavar='PATH', default=None,
+        help='Directory of the DeepSEA valid tfrecords')
+    _argparser.add_argument(
+        '--teacher-weight-path', type=str, metavar='PATH', default=None,
+        help='Weights of the teacher, scored on the fly for the tfrecords')
+    _argparser.add_argument(
+        '--teacher-model', type=str, default='bert', metavar='NAME',
+        choices=['bert', 'albert'],
+        help='The type of the teacher, "bert" for 02_deep_sea_train_classification_tfrecord.py weights')
+    _argparser.add_argument(
+        '--teacher-model-dim', type=int, default=256, metavar='INTEGER',
+        help='Hidden size of the teacher')
+    _argparser.add_argument(
+        '--teacher-transformer-depth', type=int, default=2, metavar='INTEGER',
+        help='Layers of the teacher')
+    _argparser.add_argument(
+        '--teacher-num-heads', type=int, default=8, metavar='INTEGER',
+        help='Heads of self attention of the teacher')
+    _argparser.add_argument(
+        '--teacher-use-position', action='store_true',
+        help='The teacher uses position ids (--use-position of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-use-segment', action='store_true',
+        help='The teacher uses segment ids (--use-segment of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-use-conv', action='store_true',
+        help='The teacher uses the Conv1D embedding layer (--use-conv of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-fused-qkv', action='store_true',
+        help='The teacher computes q/k/v with a single matmul (--fused-qkv of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-attention-window', type=int, default=None, metavar='INTEGER',
+        help='Local attention window of the teacher (--attention-window of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-attention-global-tokens', type=int, default=1, metavar='INTEGER',
+        help='Global tokens of the teacher local attention (--attention-global-tokens of the 02 trainer)')
+    _argparser.add_argument(
+        '--teacher-fused-conv-embedding', action='store_true',
+        help='The teacher runs the embedding convolutions as one Conv1D (--fused-conv-embedding of the 02 trainer)')
+    _argparser.add_argument(
+        '--student', type=str, default='albert', metavar='NAME',
+        choices=['albert', 'cnn'],
+        help='The type of the student')
+    _argparser.add_argument(
+        '--model-dim', type=int, default=128, metavar='INTEGER',
+        help='Hidden size of the ALBERT student')
+    _argparser.add_argument(
+        '--transformer-depth', type=int, default=1, metavar='INTEGER',
+        help='Layers of the ALBERT student')
+    _argparser.add_argument(
+        '--num-heads', type=int, default=4, metavar='INTEGER',
+        help='Heads of self attention of the ALBERT student')
+    _argparser.add_argument(
+        '--we-size', type=int, default=128, metavar='INTEGER',
+        help='Word embedding size')
+    _argparser.add_argument(
+        '--cnn-filters', type=int, default=128, metavar='INTEGER',
+        help='Filters of each CNN student convolution')
+    _argparser.add_argument(
+        '--cnn-kernel-size', type=int, default=8, metavar='INTEGER',
+        help='Kernel size of the CNN student convolutions')
+    _argparser.add_argument(
+        '--cnn-layers', type=int, default=3, metavar='INTEGER',
+        help='Number of CNN student convolutions')
+    _argparser.add_argument(
+        '--temperature', type=float, default=2.0, metavar='FLOAT',
+        help='Distillation temperature of the soft targets')
+    _argparser.add_argument(
+        '--diff-weight', type=float, default=1.0, metavar='FLOAT',
+        help='With --teacher-npz, weight of the MSE between the alt - ref logits of the student and the teacher')
+    _argparser.add_argument(
+        '--hard-weight', type=float, default=0.0, metavar='FLOAT',
+        help='With --train-data, weight of the cross entropy on the DeepSEA labels')
+    _argparser.add_argument(
+        '--epochs', type=int, default=20, metavar='INTEGER',
+        help='The number of epochs to train')
+    _argparser.add_argument(
+        '--lr', type=float, default=1e-3, metavar='FLOAT',
+        help='Learning rate')
+    _argparser.add_argument(
+        '--optimizer', type=str, default='adam', metavar='NAME',
+        choices=OPTIMIZERS,
+        help='The type of the optimizer')
+    _argparser.add_argument(
+        '--batch-size', type=int, default=128, metavar='INTEGER',
+        help='Training batch size')
+    _argparser.add_argument(
+        '--seq-len', type=int, default=1000, metavar='INTEGER',
+        help='Max sequence length')
+    _argparser.add_argument(
+        '--num-classes', type=int, default=919, metavar='INTEGER',
+        help='Number of total classes')
+    _argparser.add_argument(
+        '--vocab-size', type=int, default=None, metavar='INTEGER',
+        help='Number of vocab, must match the teacher and the predictor (default: the 02 trainer vocab)')
+    _argparser.add_argument(
+        '--max-position-embeddings', type=int, default=512, metavar='INTEGER',
+        help='Max position embeddings')
+    _argparser.add_argument(
+        '--ngram', type=int, default=5, metavar='INTEGER',
+        help='length of char ngram')
+    _argparser.add_argument(
+        '--steps-per-epoch', type=int, default=None, metavar='INTEGER',
+        help='steps per epoch (default: one pass over the teacher npz)')
+    _argparser.add_argument(
+        '--shuffle-size', type=int, default=1000, metavar='INTEGER',
+        help='Buffer shuffle size')
+    _argparser.add_argument(
+        '--num-parallel-calls', type=int, default=16, metavar='INTEGER',
+        help='Num parallel calls')
+    _argparser.add_argument(
+        '--verbose', type=int, default=2, metavar='INTEGER',
+        help='Verbose')
+
+    _args = _argparser.parse_args()
+
+    save_path = _args.save
+    model_name = _args.model_name
+    batch_size = _args.batch_size
+    epochs = _args.epochs
+    ngram = _args.ngram
+    num_classes = _args.num_classes
+    temperature = _args.temperature
+    word_seq_len = _args.seq_len // ngram
+    print("max_seq_len: ", _args.seq_len, " word_seq_len: ", word_seq_len)
+
+    if (_args.teacher_npz is None) == (_args.train_data is None):
+        raise ValueError("Use either --teacher-npz or --train-data with --teacher-weight-path")
+    if _args.train_data is not None and _args.teacher_weight_path is None:
+        raise ValueError("--train-data needs --teacher-weight-path")
+
+    vocab_size = _args.vocab_size
+    if vocab_size is None:
+        # Same vocab as 02_deep_sea_train_classification_tfrecord.py
+        word_dict = get_word_dict_for_n_gram_number(word_index_from=10, n_gram=ngram)
+        vocab_size = len(word_dict) + 10 + 3
+    max_position_embeddings = max(_args.max_position_embeddings, word_seq_len)
+
+    gpus = tf.config.experimental.list_physical_devices(device_type='GPU')
+    for gpu in gpus:
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    strategy = tf.distribute.MirroredStrategy()
+    print('Number of devices: {}'.format(strategy.num_replicas_in_sync))
+    GLOBAL_BATCH_SIZE = batch_size * strategy.num_replicas_in_sync
+    print("GLOBAL_BATCH_SIZE: ", GLOBAL_BATCH_SIZE)
+
+    with strategy.scope():
+        # The student outputs logits; the predictor loads the same weights under a sigmoid head
+        if _args.student == 'cnn':
+            student = build_cnn_student(vocab_size,
+                                        num_classes,
+                                        embedding_size=_args.we_size,
+                                        filters=_args.cnn_filters,
+                                        kernel_size=_args.cnn_kernel_size,
+                                        num_layers=_args.cnn_layers,
+                                        output_logits=True)
+        else:
+            student = build_transformer_logits('albert', num_classes, vocab_size, _args.we_size,
+                                               _args.model_dim, _args.num_heads,
+                                               _args.transformer_depth, max_position_embeddings)
+        student.summary()
+
+        optimizer = get_optimizer(_args.optimizer, learning_rate=_args.lr)
+        if _args.teacher_npz is not None:
+            model = build_pair_student(student)
+            model.compile(optimizer=optimizer,
+                          loss={
+                              'Ref-Logits': soft_binary_crossentropy(temperature),
+                              'Alt-Logits': soft_binary_crossentropy(temperature),
+                              'Logit-Diff': tf.keras.losses.MeanSquaredError(),
+                          },
+                          loss_weights={
+                              'Ref-Logits': 1.0,
+                              'Alt-Logits': 1.0,
+                              'Logit-Diff': _args.diff_weight,
+                          })
+        else:
+            # Frozen teacher in the same graph, its layers live in a nested model so the names do not clash.
+            # The architecture flags must match the 02 trainer run, every teacher layer has to be in the weights file
+            teacher = build_transformer_logits(_args.teacher_model, num_classes, vocab_size, _args.we_size,
+                                               _args.teacher_model_dim, _args.teacher_num_heads,
+                                               _args.teacher_transformer_depth, max_position_embeddings,
+                                               use_position=_args.teacher_use_position,
+                                               use_segment=_args.teacher_use_segment,
+                                               use_conv=_args.teacher_use_conv,
+                                               fused_qkv=_args.teacher_fused_qkv,
+                                               attention_window=_args.teacher_attention_window,
+                                               attention_global_tokens=_args.teacher_attention_global_tokens,
+                                               fused_conv_embedding=_args.teacher_fused_conv_embedding)
+            load_weights_by_layer(teacher, _args.teacher_weight_path, strict=True)
+            print("Load teacher weights: ", _args.teacher_weight_path)
+            teacher.trainable = False
+            teacher._name = 'Teacher'
+
+            teacher_logits = teacher(student.inputs)
+            output = Concatenate(name='Distill-Logits')([student.output, teacher_logits])
+            model = tf.keras.models.Model(student.inputs, output)
+            model.compile(optimizer=optimizer,
+                          loss={'Distill-Logits': distillation_loss(num_classes, temperature, _args.hard_weight)})
+        model.summary()
+
+    if _args.teacher_npz is not None:
+        train_dataset, num_examples = load_teacher_dataset(load_teacher_npz(list_files(_args.teacher_npz, '.npz')),
+                                                           ngram,
+                                                           GLOBAL_BATCH_SIZE,
+                                                           shuffle_size=_args.shuffle_size * GLOBAL_BATCH_SIZE,
+                                                           repeat=True)
+        steps_per_epoch = _args.steps_per_epoch or math.ceil(num_examples / GLOBAL_BATCH_SIZE)
+        valid_dataset, validation_steps = None, None
+        if _args.valid_teacher_npz is not None:
+            valid_dataset, num_valid = load_teacher_dataset(
+                load_teacher_npz(list_files(_args.valid_teacher_npz, '.npz')), ngram, GLOBAL_BATCH_SIZE)
+            validation_steps = math.ceil(num_valid / GLOBAL_BATCH_SIZE)
+    else:
+        train_dataset = load_tfrecord(list_files(_args.train_data, '.tfrecord'),
+                                      sequence_length=word_seq_len,
+                                      num_classes=num_classes,
+                                      num_parallel_calls=_args.num_parallel_calls,
+                                      batch_size=GLOBAL_BATCH_SIZE,
+                                      shuffle_size=GLOBAL_BATCH_SIZE * _args.shuffle_size,
+                                      repeat=True)
+        steps_per_epoch = _args.steps_per_epoch or 10000
+        valid_dataset, validation_steps = None, None
+        if _args.valid_data is not None:
+            valid_dataset = load_tfrecord(list_files(_args.valid_data, '.tfrecord'),
+                                          sequence_length=word_seq_len,
+                                          num_classes=num_classes,
+                                          num_parallel_calls=_args.num_parallel_calls,
+                                          batch_size=GLOBAL_BATCH_SIZE)
+            validation_steps = math.ceil(8000 / GLOBAL_BATCH_SIZE)
+
+    # Only the student weights are saved, under the flat layer names the predictor loads by name
+    monitor = 'val_loss' if valid_dataset is not None else 'loss'
+    filepath = os.path.join(save_path, model_name + "_weights_{epoch:02d}-{" + monitor + ":.6f}.hdf5")
+    mc = AsyncCheckpoint(filepath, monitor=monitor, model=student, verbose=1)
+
+    print("Distilling")
+    model.fit(train_dataset,
+              steps_per_epoch=steps_per_epoch,
+              epochs=epochs,
+              validation_data=valid_dataset,
+              validation_steps=validation_steps,
+              callbacks=[mc],
+              verbose=_args.verbose)
+
+    student.save_weights(os.path.join(save_path, model_name + "_weights_final.hdf5"))
+    print("Saved student weights: ", os.path.join(save_path, model_name + "_weights_final.hdf5"))
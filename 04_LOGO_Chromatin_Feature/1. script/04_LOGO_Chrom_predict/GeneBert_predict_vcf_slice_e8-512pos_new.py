@@ -11,14 +11,17 @@ import pandas as pd
 
 import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint
-from sklearn.metrics import roc_auc_score
-from tensorflow.keras.layers import Lambda, Dense
 from multiprocessing import Pool
 
 sys.path.append("../../")
-from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.models import build_transformer_model, load_inference_weights, save_inference_weights
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, number_codes_to_kmer_ids, \
+    number_codes_to_kmer_ids_both_strands, get_ngram_frame
+from bgi.common.metrics import roc_auc_and_average_precision
 from bgi.bert4keras.backend import K
 
 if tf.__version__.startswith('1.'):  # tensorflow 1
@@ -44,18 +47,27 @@ def load_dictionary(config_path, encoding="utf-8"):
 
 
 def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parallel_calls=tf.data.experimental.AUTOTUNE,
-                  batch_size=32):
-    """给原方法补上parse_function
+                  batch_size=32, token_schema=None, shuffle_size=0, repeat=False, deterministic=True, cache=None,
+                  prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
     """
+    按 batch 读取 tfrecord, 每个 batch 由 tf.io.parse_example 一次解析
+    token_schema: 'int64' 或 'bytes' (小端 uint16, 由 tf.io.decode_raw 解码), 默认由第一条记录判断
+    shuffle_size, repeat, deterministic, cache, prefetch_buffer_size: 见 bgi.common.tfrecord_utils.load_tfrecord_dataset
+    """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'x')
 
     def parse_function(serialized):
         features = {
-            'x': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'x': get_token_feature_spec(sequence_length, token_schema),
             # 'segmentId': tf.io.FixedLenFeature([sequence_length], tf.int64),
             'y': tf.io.FixedLenFeature([num_classes], tf.int64),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['x']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['x'], sequence_length, token_schema)
+        # 每个 batch 生成一次全零的 segment
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
         sequence = features['y']
         x = {
@@ -68,11 +80,15 @@ def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parall
 
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
-
-    dataset = tf.data.TFRecordDataset(record_names)
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+    dataset = load_tfrecord_dataset(record_names,
+                                    parse_function,
+                                    batch_size,
+                                    shuffle_size=shuffle_size,
+                                    repeat=repeat,
+                                    deterministic=deterministic,
+                                    num_parallel_calls=num_parallel_calls,
+                                    cache=cache,
+                                    prefetch_buffer_size=prefetch_buffer_size)
     return dataset
 
 
@@ -147,11 +163,7 @@ def load_npz_record(record_names,
 
                 if only_one_slice is True:
                     kk = ii
-                    slice_indexes = []
-                    max_slice_seq_len = x_data.shape[1] // ngram * ngram
-                    for gg in range(kk, max_slice_seq_len, ngram):
-                        slice_indexes.append(gg)
-                    x_data_slice = x_data[:, slice_indexes]
+                    x_data_slice = get_ngram_frame(x_data, kk, ngram)
                     x_data_all.append(x_data_slice)
                     y_data_all.append(y_data)
                 else:
@@ -192,62 +204,23 @@ def pred_result_auc_BiPath(y_pred, y_label):
     print("y_label: ", y_label.shape)
 
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
-    min_len = min(len(y_label), len(y_pred_val))
-
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-    for ii in range(y_pred_val.shape[1]):
-        try:
-            auc = roc_auc_score(y_label[:, ii][:min_len], y_pred_val[:, ii][:min_len])
-            aucs[ii] = auc
-        except ValueError:
-            a = 1
+    aucs, _ = roc_auc_and_average_precision(y_label, y_pred_val)
 
     print('Median AUCs')
-    print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
-    print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
-    print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
-
-
-# 并行计算 ROC_AUC
-def calc_roc_auc_score(index, y_label_slice, y_pred_slice):
-    auc = 0
-    try:
-        auc = roc_auc_score(y_label_slice, y_pred_slice)
-    except ValueError:
-        auc = 0
-    return index, auc
+    print('- Transcription factors: %.3f' % np.nanmedian(aucs[124:124 + 690]))
+    print('- DNase I-hypersensitive sites: %.3f' % np.nanmedian(aucs[:124]))
+    print('- Histone marks: %.3f' % np.nanmedian(aucs[124 + 690:124 + 690 + 104]))
 
 
-def pred_result_auc_BiPath_list(y_preds, y_label, pool_size=8):
-    all_y_pred = None
-
+def pred_result_auc_BiPath_list(y_preds, y_label):
     print("y_pred: ", len(y_preds))
     print("y_label: ", y_label.shape)
-    for jj in range(len(y_preds)):
-        y_pred = y_preds[jj]
-        if all_y_pred is None:
-            all_y_pred = y_pred
-        else:
-            all_y_pred += y_pred
 
-    y_pred = all_y_pred / len(y_preds)
+    # 多个模型的平均预测, 所有类别一次计算 AUROC / AUPRC
+    y_pred = sum(y_preds) / len(y_preds)
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
     y_pred_val = y_pred_val[:, 0:num_classes]
-
-    min_len = min(len(y_label), len(y_pred_val))
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-
-    pool = Pool(processes=pool_size)
-    results = []
-    for index in range(y_pred_val.shape[1]):
-        result = pool.apply_async(calc_roc_auc_score,
-                                  args=(index,
-                                        y_label[:, index][:min_len],
-                                        y_pred_val[:, index][:min_len]
-                                        ))
-        results.append(result)
-    pool.close()
-    pool.join()
+    aucs, auprcs = roc_auc_and_average_precision(y_label[:, 0:num_classes], y_pred_val)
 
     #  2002 feature TF/DHS/HM index
     TF_index = [125, 126, 127, 128, 129, 130, 131, 132, 133, 134, 135, 136, 137, 138, 139, 140, 141, 142, 143, 144, 145,
@@ -358,20 +331,22 @@ def pred_result_auc_BiPath_list(y_preds, y_label, pool_size=8):
                 1970, 1971, 1972, 1973, 1974, 1975, 1976, 1977, 1978, 1979, 1981, 1982, 1983, 1984, 1985, 1986, 1987,
                 1988, 1989, 1990, 1991, 1992, 1993, 1994, 1995, 1996, 1997, 1998, 1999, 2000, 2001]
 
-    # 汇总结果
-    for result in results:
-        index, auc = result.get()
-        aucs[index] = auc
     #     print('Median AUCs')
     #     print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
     #     print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
     #     print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
     #     print('- All auc: %.3f' % np.median(aucs[:]))
     print('Median AUCs')
-    print('- Transcription factors: %.4f' % np.median(aucs[TF_index]))
-    print('- DNase I-hypersensitive sites: %.4f' % np.median(aucs[DHS_index]))
-    print('- Histone marks: %.4f' % np.median(aucs[HM_index]))
-    print('- All auc: %.4f' % np.median(aucs[:]))
+    print('- Transcription factors: %.4f' % np.nanmedian(aucs[TF_index]))
+    print('- DNase I-hypersensitive sites: %.4f' % np.nanmedian(aucs[DHS_index]))
+    print('- Histone marks: %.4f' % np.nanmedian(aucs[HM_index]))
+    print('- All auc: %.4f' % np.nanmedian(aucs[:]))
+    print('Median AUPRCs')
+    print('- Transcription factors: %.4f' % np.nanmedian(auprcs[TF_index]))
+    print('- DNase I-hypersensitive sites: %.4f' % np.nanmedian(auprcs[DHS_index]))
+    print('- Histone marks: %.4f' % np.nanmedian(auprcs[HM_index]))
+    print('- All auprc: %.4f' % np.nanmedian(auprcs[:]))
+    return aucs, auprcs
 
 
 def encodeSeqs_ngram(seqs, kernel=5, inputsize=1000, word_dict=None):
@@ -496,7 +471,7 @@ def fetchSeqs_fromdeepC(chr, pos_start, pos_end, inputsize=1000):
                 mutpos + len(ref))].upper() == ref.upper()  # 原版
 
 
-def encodeSeqs(seqs, inputsize=2000):
+def encodeSeqs(seqs, inputsize=2000, with_reverse=True):
     """Convert sequences to 0-1 encoding and truncate to the input size.
     The output concatenates the forward and reverse complement sequence
     encodings.
@@ -505,6 +480,8 @@ def encodeSeqs(seqs, inputsize=2000):
     Args:
         seqs: list of sequences (e.g. produced by fetchSeqs)
         inputsize: the number of basepairs to encode in the output
+        with_reverse: if False, only the forward encodings are returned and the
+            reverse complement tokens are derived later by onehot_to_ngram
 
     Returns:
         numpy array of dimension: (2 x number of sequence) x 4 x inputsize
@@ -529,6 +506,9 @@ def encodeSeqs(seqs, inputsize=2000):
             seqsnp[n, :, i] = mydict[c]
         n = n + 1
 
+    if with_reverse is False:
+        return seqsnp
+
     # get the complementary sequences
     dataflip = seqsnp[:, ::-1, ::-1]  # 补了互补链，变成（2n，4，2000）
     seqsnp = np.concatenate([seqsnp, dataflip], axis=0)  # 补了互补链，变成（2n，4，2000）
@@ -540,30 +520,30 @@ def onehot_to_ngram(data=None,
                     step=1,
                     num_word_dict=None,
                     actg_value=np.array([1, 2, 3, 4]),
-                    n_gram_value=None):
+                    n_gram_value=None,
+                    with_reverse=False):
     """
     将encode后的onthot进行ngram化
     data : (n, 4, seqsize), example:(8000,4,2000)
     n_gram_value : base on ngram, example: ngram=3, n_gram_value=[100,10,1]
+    with_reverse : data only holds the forward strand, reverse complement rows are derived from the
+                   forward k-mers and appended, same as encodeSeqs(..., with_reverse=True)
     return ngram array
     """
 
     index = 0
     x_data = []
+    x_data_rev = []
 
+    kmer_lut = get_kmer_lookup_table_from_dict(num_word_dict, n_gram)
     for ii in range(data.shape[0]):
         actg = np.matmul(actg_value, data[ii, :, :])
-        gene = []
-        for kk in range(0, len(actg), step):
-            actg_temp_value = 0
-            if kk + n_gram <= len(actg):
-                actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                actg_temp_value = int(actg_temp_value)
-            else:
-                for gg in range(kk, len(actg)):
-                    actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-            gene.append(num_word_dict.get(actg_temp_value, 0))
+        if with_reverse is True:
+            gene, gene_rev = number_codes_to_kmer_ids_both_strands(actg, kmer_lut, n_gram, step,
+                                                                   word_dict=num_word_dict)
+            x_data_rev.append(gene_rev)
+        else:
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_dict=num_word_dict)
 
         x_data.append(np.array(gene))
         # y_test.append(labels[ii])
@@ -572,6 +552,8 @@ def onehot_to_ngram(data=None,
             print("Index : {}, Gene len : {}".format(index, len(gene)))
         index += 1
         _ngram_array = np.array(x_data)
+    if with_reverse is True:
+        _ngram_array = np.array(x_data + x_data_rev)
     return _ngram_array
 
 
@@ -624,11 +606,7 @@ def npz2record(x_data_,
 
             if only_one_slice is True:
                 kk = ii
-                slice_indexes = []
-                max_slice_seq_len = x_data.shape[1] // ngram * ngram
-                for gg in range(kk, max_slice_seq_len, ngram):
-                    slice_indexes.append(gg)
-                x_data_slice = x_data[:, slice_indexes]
+                x_data_slice = get_ngram_frame(x_data, kk, ngram)
                 x_data_all.append(x_data_slice)
                 y_data_all.append(y_data)
             else:
@@ -683,9 +661,7 @@ def predict_avg(ngram_input=None,
                              slice_index=ii, shuffle=False, seq_len=seq_len, num_classes=num_classes)
         dataset = dataset.batch(TEM_BATCH_SIZE)
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
-        y_pred = albert.predict(dataset,
-                                steps=math.ceil(ngram_input.shape[0] / (TEM_BATCH_SIZE)),
-                                verbose=1)
+        y_pred = inference_model.predict(dataset)
         print()
         print("Predict epoch:{}, y_pred_shape : {}".format(ii, y_pred.shape))
         y_preds.append(y_pred)
@@ -713,12 +689,13 @@ def preccess_data(seqslist,
                   actg_value,
                   n_gram_value
                   ):
-    tem_encoded = encodeSeqs(seqslist, inputsize=inputsize).astype(np.float32)  # shape是(20, 4, 2000),因为包含了正和反两条链
+    tem_encoded = encodeSeqs(seqslist, inputsize=inputsize, with_reverse=False).astype(np.float32)  # 只编码正链, 反向互补链的 token 由 onehot_to_ngram 得到
     print('seqslist length : {}, \ntem_encoded shape : {}'.format(len(seqslist), tem_encoded.shape))
     tem_ngram_input = onehot_to_ngram(data=tem_encoded, n_gram=ngram, step=step,
                                       num_word_dict=word_dict,
                                       actg_value=actg_value,
-                                      n_gram_value=n_gram_value)
+                                      n_gram_value=n_gram_value,
+                                      with_reverse=True)
     tem_ngram_input_lenth = tem_ngram_input.shape[0]
     print(tem_ngram_input_lenth)
     if tem_ngram_input_lenth / 2 == len(seqslist):
@@ -840,6 +817,12 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--pool-size', type=int, default=16, metavar='INTEGER',
         help='Pool size of multi-thread')
+    _argparser.add_argument(
+        '--slim-weights', type=str, default=None, metavar='PATH',
+        help='Weights saved by --save-slim-weights, loaded strictly into the inference model instead of --weight-path')
+    _argparser.add_argument(
+        '--save-slim-weights', type=str, default=None, metavar='PATH',
+        help='Save the weights of the inference model (no optimizer/MLM/unused layers) to this .hdf5 and exit')
 
     _args = _argparser.parse_args()
 
@@ -909,32 +892,35 @@ if __name__ == '__main__':
             "type_vocab_size": 0,
             "vocab_size": vocab_size,
             "custom_masked_sequence": False,
+            "sequence_length": word_seq_len,
         }
-        bert = build_transformer_model(
+        # 推理模型: 没有 Dropout 节点, 分类头与训练脚本相同, 前向计算的图只建一次
+        inference_model = build_transformer_model(
             configs=config,
-            # checkpoint_path=checkpoint_path,
             model='albert',
-            return_keras_model=False,
+            inference=True,
+            num_classes=num_classes,
         )
 
-        output = Lambda(lambda x: x[:, 0], name='CLS-token')(bert.model.output)
-        output = Dense(
-            name='CLS-Activation',
-            units=num_classes,
-            activation='sigmoid',
-            kernel_initializer=bert.initializer
-        )(output)
-
-        albert = tf.keras.models.Model(bert.model.input, output)
+        albert = inference_model.model
         albert.summary()
-        albert.compile(optimizer='adam', loss=[tf.keras.losses.BinaryCrossentropy()], metrics=['accuracy'])
 
     with strategy.scope():
         pretrain_weight_path = _args.weight_path
-        if pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
+        slim_weight_path = _args.slim_weights
+        if slim_weight_path is not None:
+            # 精简后的权重与推理模型的层一一对应, 严格加载, 不匹配时报错
+            load_inference_weights(albert, slim_weight_path)
+            print("Load slim weights: ", slim_weight_path)
+        elif pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
             albert.load_weights(pretrain_weight_path, by_name=True)
             print("Load weights: ", pretrain_weight_path)
 
+    if _args.save_slim_weights is not None:
+        save_inference_weights(albert, _args.save_slim_weights)
+        print("Save slim weights: ", _args.save_slim_weights)
+        sys.exit(0)
+
     steps_per_epoch = _args.steps_per_epoch
 
     lr_scheduler = LRSchedulerPerStep(model_dim,
@@ -12,14 +12,19 @@ import pandas as pd
 
 import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint
-from sklearn.metrics import roc_auc_score
-from tensorflow.keras.layers import Lambda, Dense
 from multiprocessing import Pool
 
 sys.path.append("../../")
-from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.models import build_transformer_model, InferenceModel, load_inference_weights, \
+    save_inference_weights
 from bgi.common.callbacks import LRSchedulerPerStep
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, number_codes_to_kmer_ids, \
+    number_codes_to_kmer_ids_both_strands, get_ngram_frame
+from bgi.common.distill_utils import save_teacher_npz, build_cnn_student
+from bgi.common.metrics import roc_auc_and_average_precision
 from bgi.bert4keras.backend import K
 
 if tf.__version__.startswith('1.'):  # tensorflow 1
@@ -42,17 +47,28 @@ def load_dictionary(config_path, encoding="utf-8"):
         config = json.loads(str)
         return config
 
-def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parallel_calls=tf.data.experimental.AUTOTUNE, batch_size=32):
-    """给原方法补上parse_function
+def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                  batch_size=32, token_schema=None, shuffle_size=0, repeat=False, deterministic=True, cache=None,
+                  prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
     """
+    按 batch 读取 tfrecord, 每个 batch 由 tf.io.parse_example 一次解析
+    token_schema: 'int64' 或 'bytes' (小端 uint16, 由 tf.io.decode_raw 解码), 默认由第一条记录判断
+    shuffle_size, repeat, deterministic, cache, prefetch_buffer_size: 见 bgi.common.tfrecord_utils.load_tfrecord_dataset
+    """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'x')
+
     def parse_function(serialized):
         features = {
-            'x': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'x': get_token_feature_spec(sequence_length, token_schema),
             # 'segmentId': tf.io.FixedLenFeature([sequence_length], tf.int64),
             'y': tf.io.FixedLenFeature([num_classes], tf.int64),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['x']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['x'], sequence_length, token_schema)
+        # 每个 batch 生成一次全零的 segment
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
         sequence = features['y']
         x = {
@@ -65,11 +81,15 @@ def load_tfrecord(record_names, sequence_length=100, num_classes=919, num_parall
 
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
-
-    dataset = tf.data.TFRecordDataset(record_names)
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=num_parallel_calls)
+    dataset = load_tfrecord_dataset(record_names,
+                                    parse_function,
+                                    batch_size,
+                                    shuffle_size=shuffle_size,
+                                    repeat=repeat,
+                                    deterministic=deterministic,
+                                    num_parallel_calls=num_parallel_calls,
+                                    cache=cache,
+                                    prefetch_buffer_size=prefetch_buffer_size)
     return dataset
 
 
@@ -145,11 +165,7 @@ def load_npz_record(record_names,
 
                 if only_one_slice is True:
                     kk = ii
-                    slice_indexes = []
-                    max_slice_seq_len = x_data.shape[1] // ngram * ngram
-                    for gg in range(kk, max_slice_seq_len, ngram):
-                        slice_indexes.append(gg)
-                    x_data_slice = x_data[:, slice_indexes]
+                    x_data_slice = get_ngram_frame(x_data, kk, ngram)
                     x_data_all.append(x_data_slice)
                     y_data_all.append(y_data)
                 else:
@@ -190,80 +206,44 @@ def pred_result_auc_BiPath(y_pred, y_label):
     print("y_label: ", y_label.shape)
 
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
-    min_len = min(len(y_label), len(y_pred_val))
-
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-    for ii in range(y_pred_val.shape[1]):
-        try:
-            auc = roc_auc_score(y_label[:, ii][:min_len], y_pred_val[:, ii][:min_len])
-            aucs[ii] = auc
-        except ValueError:
-            a = 1
+    aucs, _ = roc_auc_and_average_precision(y_label, y_pred_val)
 
     print('Median AUCs')
-    print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
-    print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
-    print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
-
-# 并行计算 ROC_AUC
-def calc_roc_auc_score(index, y_label_slice, y_pred_slice):
-    auc = 0
-    try:
-        auc = roc_auc_score(y_label_slice, y_pred_slice)
-    except ValueError:
-        auc = 0
-    return index, auc
-
-def pred_result_auc_BiPath_list(y_preds, y_label, pool_size=8):
-    all_y_pred = None
+    print('- Transcription factors: %.3f' % np.nanmedian(aucs[124:124 + 690]))
+    print('- DNase I-hypersensitive sites: %.3f' % np.nanmedian(aucs[:124]))
+    print('- Histone marks: %.3f' % np.nanmedian(aucs[124 + 690:124 + 690 + 104]))
 
+def pred_result_auc_BiPath_list(y_preds, y_label):
     print("y_pred: ", len(y_preds))
     print("y_label: ", y_label.shape)
-    for jj in range(len(y_preds)):
-        y_pred = y_preds[jj]
-        if all_y_pred is None:
-            all_y_pred = y_pred
-        else:
-            all_y_pred += y_pred
 
-    y_pred = all_y_pred / len(y_preds)
+    # 多个模型的平均预测, 所有类别一次计算 AUROC / AUPRC
+    y_pred = sum(y_preds) / len(y_preds)
     y_pred_val = np.reshape(y_pred, (y_pred.shape[0], y_pred.shape[1]))
     y_pred_val = y_pred_val[:, 0:num_classes]
-
-    min_len = min(len(y_label), len(y_pred_val))
-    aucs = np.zeros(y_pred_val.shape[1], dtype=np.float)
-
-    pool = Pool(processes=pool_size)
-    results = []
-    for index in range(y_pred_val.shape[1]):
-        result = pool.apply_async(calc_roc_auc_score,
-                                  args=(index,
-                                        y_label[:, index][:min_len],
-                                        y_pred_val[:, index][:min_len]
-                                        ))
-        results.append(result)
-    pool.close()
-    pool.join()
+    aucs, auprcs = roc_auc_and_average_precision(y_label[:, 0:num_classes], y_pred_val)
 
     #  2002 feature TF/DHS/HM index
     TF_index = [125, 126, 127, 128, 129, 130, 131, 132, 133, 134, 135, 136, 137, 138, 139, 140, 141, 142, 143, 144, 145, 146, 147, 148, 149, 150, 151, 152, 153, 154, 155, 156, 157, 158, 159, 160, 161, 162, 163, 164, 165, 166, 167, 168, 169, 170, 171, 172, 173, 174, 175, 176, 177, 178, 179, 180, 181, 182, 183, 184, 185, 186, 187, 188, 189, 190, 191, 192, 193, 194, 195, 196, 197, 198, 199, 200, 201, 202, 203, 204, 205, 206, 207, 208, 209, 210, 211, 212, 213, 214, 215, 216, 217, 218, 219, 220, 221, 222, 223, 224, 225, 226, 227, 228, 229, 230, 231, 232, 233, 234, 235, 236, 237, 238, 239, 240, 241, 242, 243, 244, 245, 246, 247, 248, 249, 250, 251, 252, 253, 254, 255, 256, 257, 258, 259, 260, 261, 262, 263, 264, 265, 266, 267, 268, 269, 270, 271, 272, 273, 274, 275, 276, 277, 278, 279, 280, 281, 282, 283, 284, 285, 286, 287, 288, 289, 290, 291, 292, 293, 294, 295, 296, 297, 298, 299, 300, 301, 302, 303, 304, 305, 306, 307, 308, 309, 310, 311, 312, 313, 314, 315, 316, 317, 318, 319, 320, 321, 322, 323, 324, 325, 326, 327, 328, 329, 330, 331, 332, 333, 334, 335, 336, 337, 338, 339, 340, 341, 342, 343, 344, 345, 346, 347, 348, 349, 350, 351, 352, 353, 354, 355, 356, 357, 358, 359, 360, 361, 362, 363, 364, 365, 366, 367, 368, 369, 370, 371, 372, 373, 374, 375, 376, 377, 378, 379, 380, 381, 382, 383, 384, 385, 386, 387, 388, 389, 390, 391, 392, 393, 394, 395, 396, 397, 398, 399, 400, 401, 402, 403, 404, 405, 406, 407, 408, 409, 410, 411, 412, 413, 414, 415, 416, 417, 418, 419, 420, 421, 422, 423, 424, 425, 426, 427, 428, 429, 430, 431, 432, 433, 434, 435, 436, 437, 438, 439, 440, 441, 442, 443, 444, 445, 446, 447, 448, 449, 450, 451, 452, 453, 454, 455, 456, 457, 458, 459, 460, 461, 462, 463, 464, 465, 466, 467, 468, 469, 470, 471, 472, 473, 474, 475, 476, 477, 478, 479, 480, 481, 482, 483, 484, 485, 486, 487, 488, 489, 490, 491, 492, 493, 494, 495, 496, 497, 498, 499, 500, 501, 502, 503, 504, 505, 506, 507, 508, 509, 510, 511, 512, 513, 514, 515, 516, 517, 518, 519, 520, 521, 522, 523, 524, 525, 526, 527, 528, 529, 530, 531, 532, 533, 534, 535, 536, 537, 538, 539, 540, 541, 542, 543, 544, 545, 546, 547, 548, 549, 550, 551, 552, 553, 554, 555, 556, 557, 558, 559, 560, 561, 562, 563, 564, 565, 566, 567, 568, 569, 570, 571, 572, 573, 574, 575, 576, 577, 578, 579, 580, 581, 582, 583, 584, 585, 586, 587, 588, 589, 590, 591, 592, 593, 594, 595, 596, 597, 598, 599, 600, 601, 602, 603, 604, 605, 606, 607, 608, 609, 610, 611, 612, 613, 614, 615, 616, 617, 618, 619, 620, 621, 622, 623, 624, 625, 626, 627, 628, 629, 630, 631, 632, 633, 634, 635, 636, 637, 638, 639, 640, 641, 642, 643, 644, 645, 646, 647, 648, 649, 650, 651, 652, 653, 654, 655, 656, 657, 658, 659, 660, 661, 662, 663, 664, 665, 666, 667, 668, 669, 670, 671, 672, 673, 674, 675, 676, 677, 678, 679, 680, 681, 682, 683, 684, 685, 686, 687, 688, 689, 690, 691, 692, 693, 694, 695, 696, 697, 698, 699, 700, 701, 702, 703, 704, 705, 706, 707, 708, 709, 710, 711, 712, 713, 714, 715, 716, 717, 718, 719, 720, 721, 722, 723, 724, 725, 726, 727, 728, 729, 730, 731, 732, 733, 734, 735, 736, 737, 738, 739, 740, 741, 742, 743, 744, 745, 746, 747, 748, 749, 750, 751, 752, 753, 754, 755, 756, 757, 758, 759, 760, 761, 762, 763, 764, 765, 766, 767, 768, 769, 770, 771, 772, 773, 774, 775, 776, 777, 778, 779, 780, 781, 782, 783, 784, 785, 786, 787, 788, 789, 790, 791, 792, 793, 794, 795, 796, 797, 798, 799, 800, 801, 802, 803, 804, 805, 806, 807, 808, 809, 810, 811, 812, 813, 814]
     DHS_index = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117, 118, 119, 120, 121, 122, 123, 124, 827, 828, 829, 830, 831, 859, 860, 861, 862, 863, 882, 883, 884, 885, 886, 909, 910, 911, 912, 913, 934, 935, 936, 937, 938, 959, 960, 961, 962, 963, 1044, 1045, 1046, 1047, 1048, 1097, 1098, 1099, 1100, 1101, 1108, 1109, 1110, 1111, 1112, 1149, 1150, 1151, 1152, 1153, 1159, 1160, 1161, 1162, 1163, 1180, 1181, 1182, 1183, 1184, 1191, 1192, 1193, 1194, 1195, 1201, 1202, 1203, 1204, 1205, 1277, 1278, 1279, 1280, 1281, 1307, 1308, 1309, 1310, 1311, 1318, 1319, 1320, 1321, 1322, 1345, 1346, 1347, 1348, 1349, 1356, 1357, 1358, 1359, 1360, 1367, 1368, 1369, 1370, 1371, 1383, 1384, 1385, 1386, 1387, 1512, 1513, 1514, 1515, 1516, 1523, 1524, 1525, 1526, 1527, 1533, 1534, 1535, 1536, 1537, 1543, 1544, 1545, 1546, 1547, 1554, 1555, 1556, 1557, 1558, 1565, 1566, 1567, 1568, 1569, 1576, 1577, 1578, 1579, 1580, 1594, 1595, 1596, 1597, 1598, 1605, 1606, 1607, 1608, 1609, 1616, 1617, 1618, 1619, 1620, 1627, 1628, 1629, 1630, 1631, 1638, 1639, 1640, 1641, 1642, 1649, 1650, 1651, 1652, 1653, 1660, 1661, 1662, 1663, 1664, 1683, 1684, 1685, 1686, 1687, 1694, 1695, 1696, 1697, 1698, 1711, 1712, 1713, 1714, 1715, 1774, 1775, 1776, 1777, 1778, 1810, 1833, 1845, 1857, 1869, 1881, 1893, 1905, 1918, 1931, 1943, 1955, 1967, 1980]
     HM_index = [815, 816, 817, 818, 819, 820, 821, 822, 823, 824, 825, 826, 832, 833, 834, 835, 836, 837, 838, 839, 840, 841, 842, 843, 844, 845, 846, 847, 848, 849, 850, 851, 852, 853, 854, 855, 856, 857, 858, 864, 865, 866, 867, 868, 869, 870, 871, 872, 873, 874, 875, 876, 877, 878, 879, 880, 881, 887, 888, 889, 890, 891, 892, 893, 894, 895, 896, 897, 898, 899, 900, 901, 902, 903, 904, 905, 906, 907, 908, 914, 915, 916, 917, 918, 919, 920, 921, 922, 923, 924, 925, 926, 927, 928, 929, 930, 931, 932, 933, 939, 940, 941, 942, 943, 944, 945, 946, 947, 948, 949, 950, 951, 952, 953, 954, 955, 956, 957, 958, 964, 965, 966, 967, 968, 969, 970, 971, 972, 973, 974, 975, 976, 977, 978, 979, 980, 981, 982, 983, 984, 985, 986, 987, 988, 989, 990, 991, 992, 993, 994, 995, 996, 997, 998, 999, 1000, 1001, 1002, 1003, 1004, 1005, 1006, 1007, 1008, 1009, 1010, 1011, 1012, 1013, 1014, 1015, 1016, 1017, 1018, 1019, 1020, 1021, 1022, 1023, 1024, 1025, 1026, 1027, 1028, 1029, 1030, 1031, 1032, 1033, 1034, 1035, 1036, 1037, 1038, 1039, 1040, 1041, 1042, 1043, 1049, 1050, 1051, 1052, 1053, 1054, 1055, 1056, 1057, 1058, 1059, 1060, 1061, 1062, 1063, 1064, 1065, 1066, 1067, 1068, 1069, 1070, 1071, 1072, 1073, 1074, 1075, 1076, 1077, 1078, 1079, 1080, 1081, 1082, 1083, 1084, 1085, 1086, 1087, 1088, 1089, 1090, 1091, 1092, 1093, 1094, 1095, 1096, 1102, 1103, 1104, 1105, 1106, 1107, 1113, 1114, 1115, 1116, 1117, 1118, 1119, 1120, 1121, 1122, 1123, 1124, 1125, 1126, 1127, 1128, 1129, 1130, 1131, 1132, 1133, 1134, 1135, 1136, 1137, 1138, 1139, 1140, 1141, 1142, 1143, 1144, 1145, 1146, 1147, 1148, 1154, 1155, 1156, 1157, 1158, 1164, 1165, 1166, 1167, 1168, 1169, 1170, 1171, 1172, 1173, 1174, 1175, 1176, 1177, 1178, 1179, 1185, 1186, 1187, 1188, 1189, 1190, 1196, 1197, 1198, 1199, 1200, 1206, 1207, 1208, 1209, 1210, 1211, 1212, 1213, 1214, 1215, 1216, 1217, 1218, 1219, 1220, 1221, 1222, 1223, 1224, 1225, 1226, 1227, 1228, 1229, 1230, 1231, 1232, 1233, 1234, 1235, 1236, 1237, 1238, 1239, 1240, 1241, 1242, 1243, 1244, 1245, 1246, 1247, 1248, 1249, 1250, 1251, 1252, 1253, 1254, 1255, 1256, 1257, 1258, 1259, 1260, 1261, 1262, 1263, 1264, 1265, 1266, 1267, 1268, 1269, 1270, 1271, 1272, 1273, 1274, 1275, 1276, 1282, 1283, 1284, 1285, 1286, 1287, 1288, 1289, 1290, 1291, 1292, 1293, 1294, 1295, 1296, 1297, 1298, 1299, 1300, 1301, 1302, 1303, 1304, 1305, 1306, 1312, 1313, 1314, 1315, 1316, 1317, 1323, 1324, 1325, 1326, 1327, 1328, 1329, 1330, 1331, 1332, 1333, 1334, 1335, 1336, 1337, 1338, 1339, 1340, 1341, 1342, 1343, 1344, 1350, 1351, 1352, 1353, 1354, 1355, 1361, 1362, 1363, 1364, 1365, 1366, 1372, 1373, 1374, 1375, 1376, 1377, 1378, 1379, 1380, 1381, 1382, 1388, 1389, 1390, 1391, 1392, 1393, 1394, 1395, 1396, 1397, 1398, 1399, 1400, 1401, 1402, 1403, 1404, 1405, 1406, 1407, 1408, 1409, 1410, 1411, 1412, 1413, 1414, 1415, 1416, 1417, 1418, 1419, 1420, 1421, 1422, 1423, 1424, 1425, 1426, 1427, 1428, 1429, 1430, 1431, 1432, 1433, 1434, 1435, 1436, 1437, 1438, 1439, 1440, 1441, 1442, 1443, 1444, 1445, 1446, 1447, 1448, 1449, 1450, 1451, 1452, 1453, 1454, 1455, 1456, 1457, 1458, 1459, 1460, 1461, 1462, 1463, 1464, 1465, 1466, 1467, 1468, 1469, 1470, 1471, 1472, 1473, 1474, 1475, 1476, 1477, 1478, 1479, 1480, 1481, 1482, 1483, 1484, 1485, 1486, 1487, 1488, 1489, 1490, 1491, 1492, 1493, 1494, 1495, 1496, 1497, 1498, 1499, 1500, 1501, 1502, 1503, 1504, 1505, 1506, 1507, 1508, 1509, 1510, 1511, 1517, 1518, 1519, 1520, 1521, 1522, 1528, 1529, 1530, 1531, 1532, 1538, 1539, 1540, 1541, 1542, 1548, 1549, 1550, 1551, 1552, 1553, 1559, 1560, 1561, 1562, 1563, 1564, 1570, 1571, 1572, 1573, 1574, 1575, 1581, 1582, 1583, 1584, 1585, 1586, 1587, 1588, 1589, 1590, 1591, 1592, 1593, 1599, 1600, 1601, 1602, 1603, 1604, 1610, 1611, 1612, 1613, 1614, 1615, 1621, 1622, 1623, 1624, 1625, 1626, 1632, 1633, 1634, 1635, 1636, 1637, 1643, 1644, 1645, 1646, 1647, 1648, 1654, 1655, 1656, 1657, 1658, 1659, 1665, 1666, 1667, 1668, 1669, 1670, 1671, 1672, 1673, 1674, 1675, 1676, 1677, 1678, 1679, 1680, 1681, 1682, 1688, 1689, 1690, 1691, 1692, 1693, 1699, 1700, 1701, 1702, 1703, 1704, 1705, 1706, 1707, 1708, 1709, 1710, 1716, 1717, 1718, 1719, 1720, 1721, 1722, 1723, 1724, 1725, 1726, 1727, 1728, 1729, 1730, 1731, 1732, 1733, 1734, 1735, 1736, 1737, 1738, 1739, 1740, 1741, 1742, 1743, 1744, 1745, 1746, 1747, 1748, 1749, 1750, 1751, 1752, 1753, 1754, 1755, 1756, 1757, 1758, 1759, 1760, 1761, 1762, 1763, 1764, 1765, 1766, 1767, 1768, 1769, 1770, 1771, 1772, 1773, 1779, 1780, 1781, 1782, 1783, 1784, 1785, 1786, 1787, 1788, 1789, 1790, 1791, 1792, 1793, 1794, 1795, 1796, 1797, 1798, 1799, 1800, 1801, 1802, 1803, 1804, 1805, 1806, 1807, 1808, 1809, 1811, 1812, 1813, 1814, 1815, 1816, 1817, 1818, 1819, 1820, 1821, 1822, 1823, 1824, 1825, 1826, 1827, 1828, 1829, 1830, 1831, 1832, 1834, 1835, 1836, 1837, 1838, 1839, 1840, 1841, 1842, 1843, 1844, 1846, 1847, 1848, 1849, 1850, 1851, 1852, 1853, 1854, 1855, 1856, 1858, 1859, 1860, 1861, 1862, 1863, 1864, 1865, 1866, 1867, 1868, 1870, 1871, 1872, 1873, 1874, 1875, 1876, 1877, 1878, 1879, 1880, 1882, 1883, 1884, 1885, 1886, 1887, 1888, 1889, 1890, 1891, 1892, 1894, 1895, 1896, 1897, 1898, 1899, 1900, 1901, 1902, 1903, 1904, 1906, 1907, 1908, 1909, 1910, 1911, 1912, 1913, 1914, 1915, 1916, 1917, 1919, 1920, 1921, 1922, 1923, 1924, 1925, 1926, 1927, 1928, 1929, 1930, 1932, 1933, 1934, 1935, 1936, 1937, 1938, 1939, 1940, 1941, 1942, 1944, 1945, 1946, 1947, 1948, 1949, 1950, 1951, 1952, 1953, 1954, 1956, 1957, 1958, 1959, 1960, 1961, 1962, 1963, 1964, 1965, 1966, 1968, 1969, 1970, 1971, 1972, 1973, 1974, 1975, 1976, 1977, 1978, 1979, 1981, 1982, 1983, 1984, 1985, 1986, 1987, 1988, 1989, 1990, 1991, 1992, 1993, 1994, 1995, 1996, 1997, 1998, 1999, 2000, 2001]
     
-    # 汇总结果
-    for result in results:
-        index, auc = result.get()
-        aucs[index] = auc
 #     print('Median AUCs')
 #     print('- Transcription factors: %.3f' % np.median(aucs[124:124 + 690]))
 #     print('- DNase I-hypersensitive sites: %.3f' % np.median(aucs[:124]))
 #     print('- Histone marks: %.3f' % np.median(aucs[124 + 690:124 + 690 + 104]))
 #     print('- All auc: %.3f' % np.median(aucs[:]))
     print('Median AUCs')
-    print('- Transcription factors: %.4f' % np.median(aucs[TF_index]))
-    print('- DNase I-hypersensitive sites: %.4f' % np.median(aucs[DHS_index]))
-    print('- Histone marks: %.4f' % np.median(aucs[HM_index]))
-    print('- All auc: %.4f' % np.median(aucs[:]))
+    print('- Transcription factors: %.4f' % np.nanmedian(aucs[TF_index]))
+    print('- DNase I-hypersensitive sites: %.4f' % np.nanmedian(aucs[DHS_index]))
+    print('- Histone marks: %.4f' % np.nanmedian(aucs[HM_index]))
+    print('- All auc: %.4f' % np.nanmedian(aucs[:]))
+    print('Median AUPRCs')
+    print('- Transcription factors: %.4f' % np.nanmedian(auprcs[TF_index]))
+    print('- DNase I-hypersensitive sites: %.4f' % np.nanmedian(auprcs[DHS_index]))
+    print('- Histone marks: %.4f' % np.nanmedian(auprcs[HM_index]))
+    print('- All auprc: %.4f' % np.nanmedian(auprcs[:]))
+    return aucs, auprcs
 
 
 def encodeSeqs_ngram(seqs, kernel = 5, inputsize=1000, word_dict = None):
@@ -365,7 +345,7 @@ def fetchSeqs(chr, pos, ref, alt, shift=0, inputsize=1000):
     #seq2 = seq.copy()
     return seq[:mutpos] + ref + seq[(mutpos + len(ref)):], seq[:mutpos] + alt + seq[(mutpos + len(ref)):], seq[mutpos:(mutpos + len(ref))].upper() == ref.upper()  # 原版
 
-def encodeSeqs(seqs, inputsize=2000):
+def encodeSeqs(seqs, inputsize=2000, with_reverse=True):
     """Convert sequences to 0-1 encoding and truncate to the input size.
     The output concatenates the forward and reverse complement sequence
     encodings.
@@ -374,6 +354,8 @@ def encodeSeqs(seqs, inputsize=2000):
     Args:
         seqs: list of sequences (e.g. produced by fetchSeqs)
         inputsize: the number of basepairs to encode in the output
+        with_reverse: if False, only the forward encodings are returned and the
+            reverse complement tokens are derived later by onehot_to_ngram
 
     Returns:
         numpy array of dimension: (2 x number of sequence) x 4 x inputsize
@@ -397,6 +379,9 @@ def encodeSeqs(seqs, inputsize=2000):
             seqsnp[n, :, i] = mydict[c]
         n = n + 1
 
+    if with_reverse is False:
+        return seqsnp
+
     # get the complementary sequences
     dataflip = seqsnp[:, ::-1, ::-1]                     #补了互补链，变成（2n，4，2000）
     seqsnp = np.concatenate([seqsnp, dataflip], axis=0)  #补了互补链，变成（2n，4，2000）
@@ -407,30 +392,30 @@ def onehot_to_ngram(data=None,
                     step = 1,
                     num_word_dict = None,
                     actg_value = np.array([1, 2, 3, 4]),
-                    n_gram_value = None):
+                    n_gram_value = None,
+                    with_reverse=False):
     """
     将encode后的onthot进行ngram化
     data : (n, 4, seqsize), example:(8000,4,2000)
     n_gram_value : base on ngram, example: ngram=3, n_gram_value=[100,10,1]
+    with_reverse : data only holds the forward strand, reverse complement rows are derived from the
+                   forward k-mers and appended, same as encodeSeqs(..., with_reverse=True)
     return ngram array
     """
 
     index = 0
     x_data = []
+    x_data_rev = []
 
+    kmer_lut = get_kmer_lookup_table_from_dict(num_word_dict, n_gram)
     for ii in range(data.shape[0]):
         actg = np.matmul(actg_value, data[ii, :, :])
-        gene = []
-        for kk in range(0, len(actg), step):
-            actg_temp_value = 0
-            if kk + n_gram <= len(actg):
-                actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                actg_temp_value = int(actg_temp_value)
-            else:
-                for gg in range(kk, len(actg)):
-                    actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-            gene.append(num_word_dict.get(actg_temp_value, 0))
+        if with_reverse is True:
+            gene, gene_rev = number_codes_to_kmer_ids_both_strands(actg, kmer_lut, n_gram, step,
+                                                                   word_dict=num_word_dict)
+            x_data_rev.append(gene_rev)
+        else:
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_dict=num_word_dict)
 
         x_data.append(np.array(gene))
         #y_test.append(labels[ii])
@@ -439,6 +424,8 @@ def onehot_to_ngram(data=None,
             print("Index : {}, Gene len : {}".format(index, len(gene)))
         index += 1
         _ngram_array = np.array(x_data)
+    if with_reverse is True:
+        _ngram_array = np.array(x_data + x_data_rev)
     return _ngram_array
 
 def npz2record(x_data_,
@@ -491,11 +478,7 @@ def npz2record(x_data_,
 
             if only_one_slice is True:
                 kk = ii
-                slice_indexes = []
-                max_slice_seq_len = x_data.shape[1] // ngram * ngram
-                for gg in range(kk, max_slice_seq_len, ngram):
-                    slice_indexes.append(gg)
-                x_data_slice = x_data[:, slice_indexes]
+                x_data_slice = get_ngram_frame(x_data, kk, ngram)
                 x_data_all.append(x_data_slice)
                 y_data_all.append(y_data)
             else:
@@ -549,9 +532,7 @@ def predict_avg(ngram_input=None,
                                  slice_index=ii, shuffle=False, seq_len=seq_len, num_classes=num_classes)
         dataset = dataset.batch(TEM_BATCH_SIZE)
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
-        y_pred = albert.predict(dataset, 
-                                steps=math.ceil(ngram_input.shape[0] /(TEM_BATCH_SIZE)), 
-                                verbose=1)
+        y_pred = inference_model.predict(dataset)
         print()
         print("Predict epoch:{}, y_pred_shape : {}".format(ii, y_pred.shape))
         y_preds.append(y_pred)
@@ -578,12 +559,13 @@ def preccess_data(seqslist,
                   actg_value,
                   n_gram_value
                  ):
-    tem_encoded = encodeSeqs(seqslist, inputsize=inputsize).astype(np.float32)    #shape是(20, 4, 2000),因为包含了正和反两条链
+    tem_encoded = encodeSeqs(seqslist, inputsize=inputsize, with_reverse=False).astype(np.float32)  # 只编码正链, 反向互补链的 token 由 onehot_to_ngram 得到
     print('seqslist length : {}, \ntem_encoded shape : {}'.format(len(seqslist),tem_encoded.shape))
     tem_ngram_input = onehot_to_ngram(data=tem_encoded, n_gram = ngram, step = step, 
                                       num_word_dict = word_dict,
                                       actg_value = actg_value,
-                                      n_gram_value = n_gram_value)
+                                      n_gram_value = n_gram_value,
+                                      with_reverse=True)
     tem_ngram_input_lenth = tem_ngram_input.shape[0]
     print(tem_ngram_input_lenth)
     if tem_ngram_input_lenth/2 == len(seqslist):
@@ -715,6 +697,29 @@ if __name__ == '__main__':
     _argparser.add_argument(
         '--max-position', type=int, default=None, metavar='INTEGER',
         help='Filter variants by max position')
+    _argparser.add_argument(
+        '--save-teacher', type=str, default=None, metavar='PATH',
+        help='Save the ref/alt tokens and scores to this .npz as distillation targets (03_deep_sea_distill_student.py)')
+    _argparser.add_argument(
+        '--student-model', type=str, default='albert', metavar='NAME',
+        choices=['albert', 'cnn'],
+        help='"cnn" to score with a CNN student from 03_deep_sea_distill_student.py, a distilled ALBERT is "albert"')
+    _argparser.add_argument(
+        '--cnn-filters', type=int, default=128, metavar='INTEGER',
+        help='Filters of each CNN student convolution')
+    _argparser.add_argument(
+        '--cnn-kernel-size', type=int, default=8, metavar='INTEGER',
+        help='Kernel size of the CNN student convolutions')
+    _argparser.add_argument(
+        '--cnn-layers', type=int, default=3, metavar='INTEGER',
+        help='Number of CNN student convolutions')
+
+    _argparser.add_argument(
+        '--slim-weights', type=str, default=None, metavar='PATH',
+        help='Weights saved by --save-slim-weights, loaded strictly into the inference model instead of --weight-path')
+    _argparser.add_argument(
+        '--save-slim-weights', type=str, default=None, metavar='PATH',
+        help='Save the weights of the inference model (no optimizer/MLM/unused layers) to this .hdf5 and exit')
 
     _args = _argparser.parse_args()
 
@@ -774,55 +779,70 @@ if __name__ == '__main__':
         num_gpu = strategy.num_replicas_in_sync
 
     with strategy.scope():
-        # 模型配置
-        config = {
-            "attention_probs_dropout_prob": 0,
-            "hidden_act": "gelu",
-            "hidden_dropout_prob": 0,
-            "embedding_size": embedding_size,
-            "hidden_size": model_dim,
-            "initializer_range": 0.02,
-            "intermediate_size": model_dim * 4,
-            "max_position_embeddings": max_position_embeddings,
-            "num_attention_heads": num_heads,
-            "num_hidden_layers": max_depth,
-            "num_hidden_groups": 1,
-            "net_structure_type": 0,
-            "gap_size": 0,
-            "num_memory_blocks": 0,
-            "inner_group_num": 1,
-            "down_scale_factor": 1,
-            "type_vocab_size": 0,
-            "vocab_size": vocab_size,
-            "custom_masked_sequence": False,
-        }
-        bert = build_transformer_model(
-            configs=config,
-            # checkpoint_path=checkpoint_path,
-            model='albert',
-            return_keras_model=False,
-        )
-        print("max_position_embeddings:", max_position_embeddings)
-
-        output = Lambda(lambda x: x[:, 0], name='CLS-token')(bert.model.output)
-        output = Dense(
-            name = 'CLS-Activation',
-            units=num_classes,
-            activation='sigmoid',
-            kernel_initializer=bert.initializer
-        )(output)
-
-        albert = tf.keras.models.Model(bert.model.input, output)
-        albert.summary()
-        albert.compile(optimizer='adam', loss=[tf.keras.losses.BinaryCrossentropy()], metrics=['accuracy'])
+        if _args.student_model == 'cnn':
+            # 03_deep_sea_distill_student.py 蒸馏得到的 CNN 学生模型, 输入和输出层的名字与 ALBERT 相同
+            albert = build_cnn_student(vocab_size,
+                                       num_classes,
+                                       embedding_size=embedding_size,
+                                       filters=_args.cnn_filters,
+                                       kernel_size=_args.cnn_kernel_size,
+                                       num_layers=_args.cnn_layers,
+                                       dropout_rate=0)
+            albert.summary()
+            inference_model = InferenceModel(albert, sequence_length=word_seq_len)
+        else:
+            # 模型配置
+            config = {
+                "attention_probs_dropout_prob": 0,
+                "hidden_act": "gelu",
+                "hidden_dropout_prob": 0,
+                "embedding_size": embedding_size,
+                "hidden_size": model_dim,
+                "initializer_range": 0.02,
+                "intermediate_size": model_dim * 4,
+                "max_position_embeddings": max_position_embeddings,
+                "num_attention_heads": num_heads,
+                "num_hidden_layers": max_depth,
+                "num_hidden_groups": 1,
+                "net_structure_type": 0,
+                "gap_size": 0,
+                "num_memory_blocks": 0,
+                "inner_group_num": 1,
+                "down_scale_factor": 1,
+                "type_vocab_size": 0,
+                "vocab_size": vocab_size,
+                "custom_masked_sequence": False,
+                "sequence_length": word_seq_len,
+            }
+            # 推理模型: 没有 Dropout 节点, 分类头与训练脚本相同, 前向计算的图只建一次
+            inference_model = build_transformer_model(
+                configs=config,
+                model='albert',
+                inference=True,
+                num_classes=num_classes,
+            )
+            print("max_position_embeddings:", max_position_embeddings)
+
+            albert = inference_model.model
+            albert.summary()
 
 
     with strategy.scope():
         pretrain_weight_path = _args.weight_path
-        if pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
+        slim_weight_path = _args.slim_weights
+        if slim_weight_path is not None:
+            # 精简后的权重与推理模型的层一一对应, 严格加载, 不匹配时报错
+            load_inference_weights(albert, slim_weight_path)
+            print("Load slim weights: ", slim_weight_path)
+        elif pretrain_weight_path is not None and len(pretrain_weight_path) > 0:
             albert.load_weights(pretrain_weight_path, by_name=True, skip_mismatch=True)
             print("Load weights: ", pretrain_weight_path)
 
+    if _args.save_slim_weights is not None:
+        save_inference_weights(albert, _args.save_slim_weights)
+        print("Save slim weights: ", _args.save_slim_weights)
+        sys.exit(0)
+
 
 
 
@@ -1047,6 +1067,14 @@ if __name__ == '__main__':
             y_pred_alt = np.where(y_pred_alt_ori>0.0000001, y_pred_alt_ori, 0.0000001)
             print("y_pred_alt shape",y_pred_alt.shape)
 
+            if _args.save_teacher is not None:
+                # 正链和反向互补链的 token 及其 ngram 帧平均后的预测值, 作为学生模型的蒸馏目标
+                teacher_path = _args.save_teacher
+                if shift != 0:
+                    teacher_path = teacher_path.replace('.npz', '') + '_shift{}.npz'.format(shift)
+                save_teacher_npz(teacher_path, data_all_list[0], data_all_list[1], y_pred_ref_ori, y_pred_alt_ori)
+                print("Saving teacher scores: ", teacher_path)
+
         except Exception as e:
             print(e)
 
@@ -12,6 +12,9 @@ from multiprocessing import Process
 sys.path.append("../../")
 from bgi.common.genebank_utils import get_refseq_gff, get_gene_feature_array
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, sequence_to_kmer_ids
+from bgi.common.sequence_utils import is_atcg_sequence
+from bgi.common.tfrecord_utils import TFRecordShardWriter, create_token_feature
 
 fasta = '/alldata/Hphuang_data/Genomics/CADD/GRCh37/GCF_000001405.25_GRCh37.p13_genomic.fna'
 # fasta = 'E:\\Research\\Data\\Genomic\\humen\\GCF_000001405.25_GRCh37.p13_genomic.fna'
@@ -103,9 +106,10 @@ def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
     return tf.train.Feature(int64_list=tf.train.Int64List(value=list(value)))
 
-def serialize_seq_example(seq, alt_seq, alt_type, y_label):
+def serialize_seq_example(seq, alt_seq, alt_type, y_label, token_schema='int64'):
     """
     Creates a tf.Example message ready to be written to a file.
+    token_schema: 'int64' 每个 token 为一个 int64; 'bytes' 每条序列为一个小端 uint16 的 bytes
     """
     # Create a dictionary mapping the feature name to the tf.Example-compatible
     # data type.
@@ -113,19 +117,23 @@ def serialize_seq_example(seq, alt_seq, alt_type, y_label):
         # 'feature': _int64_feature(x_feature),
         # 'weight': _float_feature(x_weight),
         'label': _int64_feature(y_label),
-        'seq': _int64_feature(seq),
-        'alt_seq': _int64_feature(alt_seq),
-        'alt_type': _int64_feature(alt_type),
+        'seq': create_token_feature(seq, token_schema),
+        'alt_seq': create_token_feature(alt_seq, token_schema),
+        'alt_type': create_token_feature(alt_type, token_schema),
     }
 
     example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
     return example_proto.SerializeToString()
 
-def create_tfrecord_with_sequence(seq_data, alt_seq_data, alt_type_data, label_data, tfrecord_file, batch_no = 1):
+def create_tfrecord_with_sequence(seq_data, alt_seq_data, alt_type_data, label_data, tfrecord_file, batch_no = 1,
+                                  compression_type='NONE', max_shard_bytes=None, token_schema='int64'):
     """
-    创建TF Record
+    创建TF Record, 每条记录生成后直接写入 train/valid/test 文件
     :param data_file:
     :param tfrecord_file:
+    :param compression_type: 'GZIP', 'ZLIB' 或 'NONE'
+    :param max_shard_bytes: 每个分片的目标大小, 默认不分片
+    :param token_schema: 'int64' 或 'bytes', seq/alt_seq/alt_type 的格式, label 总是 int64
     :return:
     """
 
@@ -148,32 +156,19 @@ def create_tfrecord_with_sequence(seq_data, alt_seq_data, alt_type_data, label_d
     valid_file = tfrecord_file + '_{}_valid.tfrecord'.format(batch_no)
     test_file = tfrecord_file + '_{}_test.tfrecord'.format(batch_no)
 
-    train_writer = tf.io.TFRecordWriter(train_file)
-    valid_writer = tf.io.TFRecordWriter(valid_file)
-    test_writer = tf.io.TFRecordWriter(test_file)
-    train_samples = []
-    valid_samples = []
-    test_samples = []
+    train_writer = TFRecordShardWriter(train_file, compression_type=compression_type, max_shard_bytes=max_shard_bytes)
+    valid_writer = TFRecordShardWriter(valid_file, compression_type=compression_type, max_shard_bytes=max_shard_bytes)
+    test_writer = TFRecordShardWriter(test_file, compression_type=compression_type, max_shard_bytes=max_shard_bytes)
     # with gzip.open(data_file, 'r') as pf:
     for seq, alt, type, y in zip(seq_data, alt_seq_data, alt_type_data, label_data ):
-        feature = {
-            'seq': tf.train.Feature(int64_list=tf.train.Int64List(value=list(seq))),
-            'alt_seq': tf.train.Feature(int64_list=tf.train.Int64List(value=list(alt))),
-            'alt_type': tf.train.Feature(int64_list=tf.train.Int64List(value=list(type))),
-            'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[y])),
-        }
-
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        serialized = serialize_seq_example(seq, alt, type, [y], token_schema=token_schema)
         dice = random.random()
         if dice < 0.9:
-            train_samples.append(example.SerializeToString())
-            # train_writer.write(example)
+            train_writer.write(serialized)
         elif dice < 0.95:
-            valid_samples.append(example.SerializeToString())
-            # valid_writer.write(example)
+            valid_writer.write(serialized)
         else:
-            test_samples.append(example.SerializeToString())
-            # test_writer.write(example)
+            test_writer.write(serialized)
 
         counter += 1
         if counter % 100000 == 0:
@@ -181,16 +176,9 @@ def create_tfrecord_with_sequence(seq_data, alt_seq_data, alt_type_data, label_d
 
         row_index += 1
 
-    for example in train_samples:
-        train_writer.write(example)
-
-    for example in valid_samples:
-        valid_writer.write(example)
-
-    for example in test_samples:
-        test_writer.write(example)
-            # if counter > 200000:
-            #     break
+    train_writer.close()
+    valid_writer.close()
+    test_writer.close()
 
 
 def process_raw_text(records: list,
@@ -207,7 +195,8 @@ def process_raw_text(records: list,
                      padding_seq_len=500,
                      alt_shift_seq_len=10,
                      y_label=None,
-                     samples=0):
+                     samples=0,
+                     token_schema: str = 'int64'):
 
     """
     SNP突变信息转换为序列信息
@@ -224,6 +213,7 @@ def process_raw_text(records: list,
     :param gene_type_dict:
     :param padding_seq_len:
     :param alt_shift_seq_len:
+    :param token_schema: tfrecord 中序列的格式, 'int64' 或 'bytes'
     :return:
     """
     slice_index = 0
@@ -232,12 +222,13 @@ def process_raw_text(records: list,
     slice_alt_type_data = []
     slice_anno_data = []
     slice_label_data = []
-    set_atcg = set(list('ATCG'))
 
     print("seq_size: ", seq_size)
     print("alt_shift_seq_len: ", alt_shift_seq_len)
     print("padding_seq_len: ", padding_seq_len)
 
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
+
     alphabet = {
         'N': 0,
         'A': 1,
@@ -312,23 +303,18 @@ def process_raw_text(records: list,
                     # continue
 
             # 检查是否不是 ‘ATCG’的字符
-            set_seq = set(list(seq))
-            is_atcg = True
-            for atcg in set_seq:
-                if atcg not in set_atcg:
-                    is_atcg = False
-            if is_atcg is False:
+            if is_atcg_sequence(seq) is False:
                 print(seq)
                 # continue
 
-            seq_number = []
-            alt_seq_number = []
-
-            for jj in range(0, seq_size, stride):
-                if jj + ngram <= len(seq):
-                    if word_dict is not None:
-                        seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
-                        alt_seq_number.append(word_dict.get(alt_seq[jj:jj + ngram], 0))
+            # token 的起始位置小于 seq_size, 且以 ref 序列的长度为准
+            seq_number = sequence_to_kmer_ids(seq[:seq_size + ngram - 1], kmer_lut, ngram, stride).tolist()
+            alt_seq_number = sequence_to_kmer_ids(alt_seq[:seq_size + ngram - 1], kmer_lut, ngram, stride).tolist()
+            alt_seq_number = alt_seq_number[:len(seq_number)]
+            if word_dict is not None:
+                # alt 比 ref 短时, 末尾不足 ngram 的部分按较短的 k-mer 查字典
+                for jj in range(len(alt_seq_number) * stride, len(seq_number) * stride, stride):
+                    alt_seq_number.append(word_dict.get(alt_seq[jj:jj + ngram], 0))
 
             if seq_number == alt_seq_number:
                 same_counter = same_counter + 1
@@ -434,7 +420,7 @@ def process_raw_text(records: list,
         tfrecord_file = os.path.join(output_path, '{}_gram_{}_stride_{}_slice_{}'.format(task_name, str(ngram),
                                                                                          str(stride), str(slice_index)))
         create_tfrecord_with_sequence(slice_seq_data, slice_alt_seq_data, alt_type, slice_label_data, tfrecord_file,
-                                      batch_no=slice_index)
+                                      batch_no=slice_index, token_schema=token_schema)
 
 
 def read_vcf_file(data_file, label='Benign'):
@@ -30,36 +30,57 @@ from tensorflow.keras.layers import Lambda, Dense
 
 sys.path.append("../../")
 from bgi.bert4keras.models import build_transformer_model
+from bgi.bert4keras.backend import check_mixed_precision
+from bgi.bert4keras.optimizers import get_optimizer
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
-
-
-def single_file_dataset(input_file, seq_len=50):
-    d = tf.data.TFRecordDataset(input_file)
-
-    def single_example_parser(serialized_example):
+from bgi.common.tfrecord_utils import get_token_feature_spec, decode_token_feature, detect_token_schema, \
+    load_tfrecord_dataset
+
+
+def single_file_dataset(input_file, seq_len=50, token_schema=None, batch_size=32, shuffle_size=0, repeat=False,
+                        deterministic=True, cache=None, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                        prefetch_buffer_size=tf.data.experimental.AUTOTUNE):
+    """
+    按 batch 读取记录, 每个 batch 由 tf.io.parse_example 一次解析
+    :param token_schema: 'int64' 或 'bytes' (小端 uint16), 默认由第一条记录判断
+    :param shuffle_size, repeat, deterministic, cache, prefetch_buffer_size: 见 bgi.common.tfrecord_utils.load_tfrecord_dataset
+    :return: (ref_seq, alt_seq, alt_type, label) 的 batch
+    """
+    if token_schema is None:
+        token_schema = detect_token_schema(input_file, 'seq')
+
+    def batch_example_parser(serialized_examples):
         name_to_features = {
             # 'feature': tf.io.VarLenFeature(tf.int64),
             # 'weight': tf.io.VarLenFeature(tf.float32),
             'label': tf.io.FixedLenFeature([], tf.int64),
-            'seq': tf.io.FixedLenFeature([seq_len], tf.int64),
-            'alt_seq': tf.io.FixedLenFeature([seq_len], tf.int64),
-            'alt_type': tf.io.FixedLenFeature([seq_len], tf.int64),
+            'seq': get_token_feature_spec(seq_len, token_schema),
+            'alt_seq': get_token_feature_spec(seq_len, token_schema),
+            'alt_type': get_token_feature_spec(seq_len, token_schema),
         }
-        example = tf.io.parse_single_example(serialized_example, name_to_features)
+        example = tf.io.parse_example(serialized_examples, name_to_features)
 
         # feature = example['feature']
         # weight = example['weight']
         label = example['label']
-        ref_seq = example['seq']
-        alt_seq = example['alt_seq']
-        alt_type = example['alt_type']
+        ref_seq = decode_token_feature(example['seq'], seq_len, token_schema)
+        alt_seq = decode_token_feature(example['alt_seq'], seq_len, token_schema)
+        alt_type = decode_token_feature(example['alt_type'], seq_len, token_schema)
 
         # feature = tf.sparse.to_dense(feature, default_value=0)
         # weight = tf.sparse.to_dense(weight, default_value=0)
 
         return ref_seq, alt_seq, alt_type, label
 
-    d = d.map(single_example_parser)
+    d = load_tfrecord_dataset(input_file,
+                              batch_example_parser,
+                              batch_size,
+                              shuffle_size=shuffle_size,
+                              repeat=repeat,
+                              deterministic=deterministic,
+                              num_parallel_calls=num_parallel_calls,
+                              cache=cache,
+                              prefetch_buffer_size=prefetch_buffer_size)
 
     return d
 
@@ -69,9 +90,18 @@ def create_classifier_dataset(file_names,
                               epochs=10,
                               seq_len=50,
                               is_training=True,
-                              shuffle_size=100):
-    # 读取记录
-    dataset = single_file_dataset(file_names)
+                              shuffle_size=100,
+                              token_schema=None,
+                              deterministic=True,
+                              cache=None):
+    # 读取记录, 先 batch 再解析
+    dataset = single_file_dataset(file_names,
+                                  seq_len=seq_len,
+                                  token_schema=token_schema,
+                                  batch_size=batch_size,
+                                  shuffle_size=int(shuffle_size) if is_training else 0,
+                                  deterministic=deterministic,
+                                  cache=cache)
 
     def _select_data_from_record(ref_seq, alt_seq, alt_type, label):
         x = {
@@ -85,10 +115,6 @@ def create_classifier_dataset(file_names,
         return x, y
 
     dataset = dataset.map(_select_data_from_record, num_parallel_calls=16)
-    if is_training:
-        dataset = dataset.shuffle(shuffle_size)
-
-    dataset = dataset.batch(batch_size)
 
     return dataset
 
@@ -101,6 +127,7 @@ def get_model(max_features=1000,
               num_classes=1,
               activation='sigmoid',
               vocab_size=10000,
+              mixed_precision=None,
               ):
     x_in = Input(shape=(None,), name='Input-Token')
     x_weight = Input(shape=(None,), name='Input-Weight', dtype='float')
@@ -162,6 +189,7 @@ def get_model(max_features=1000,
         # checkpoint_path=checkpoint_path,
         model='multi_inputs_alt_bert',
         return_keras_model=False,
+        mixed_precision=mixed_precision,
     )
     seq_feature = Lambda(lambda x: x[:, 0], name='CLS-token-Seq')(seq_bert.model.output)
     # seq_feature = tf.reduce_mean(seq_bert.model.output, axis=-1)
@@ -174,7 +202,7 @@ def get_model(max_features=1000,
     inputs.extend(seq_bert.model.input)
     # Concatenate
     feature = seq_feature  # concatenate([first_order, seq_feature])
-    output = Dense(num_classes, activation=activation, use_bias=True, name='CLS-Activation')(feature)
+    output = Dense(num_classes, activation=activation, use_bias=True, name='CLS-Activation', dtype='float32')(feature)
     model = Model(inputs, output)
 
     return model
@@ -195,6 +223,10 @@ if __name__ == '__main__':
 
     epochs = 100
 
+    # 混合精度策略 (float32 / mixed_float16 / mixed_bfloat16, 后两者需要 tf >= 2.1) 与梯度累积的步数
+    mixed_precision = check_mixed_precision('float32')
+    grad_accum_steps = 1
+
     ngram = 3
     seq_size = 50
     word_index_from = 10
@@ -219,10 +251,14 @@ if __name__ == '__main__':
                               embedding_dims=128,
                               hidden_layers=1,
                               vocab_size=vocab_size,
-                              activation='sigmoid')
+                              activation='sigmoid',
+                              mixed_precision=mixed_precision)
             model.summary()
             model.compile(loss=tf.keras.losses.BinaryCrossentropy(),
-                          optimizer=Adam(2e-6),
+                          optimizer=get_optimizer('adam',
+                                                  learning_rate=2e-6,
+                                                  grad_accum_steps=grad_accum_steps,
+                                                  mixed_precision=mixed_precision),
                           metrics=['accuracy', tf.keras.metrics.AUC()])
 
             train_slice_files = [
@@ -288,7 +324,8 @@ if __name__ == '__main__':
                                    embedding_dims=128,
                                    hidden_layers=1,
                                    vocab_size=vocab_size,
-                                   activation='sigmoid')
+                                   activation='sigmoid',
+                                   mixed_precision=mixed_precision)
             eval_model.compile(loss=tf.keras.losses.BinaryCrossentropy(),
                           optimizer=Adam(2e-6),
                           metrics=['accuracy', tf.keras.metrics.AUC()])
@@ -311,7 +348,8 @@ if __name__ == '__main__':
                               embedding_dims=128,
                               hidden_layers=1,
                               vocab_size=vocab_size,
-                              activation='sigmoid')
+                              activation='sigmoid',
+                              mixed_precision=mixed_precision)
             model.summary()
             model.compile(loss=tf.keras.losses.BinaryCrossentropy(),
                           optimizer=Adam(2e-6),
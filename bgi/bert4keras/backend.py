@@ -34,6 +34,12 @@ if tf.__version__.startswith('2.') and is_tf_keras:
         tf.compat.v1.disable_eager_execution()
         tf.compat.v1.experimental.output_all_intermediates(True)
 
+# 混合精度策略: float32 不使用混合精度; mixed_float16 用于 GPU, 需要 loss scaling;
+# mixed_bfloat16 用于 TPU 和支持 bf16 的 CPU, 指数范围与 float32 相同, 不需要 loss scaling
+MIXED_PRECISION_POLICIES = ('float32', 'mixed_float16', 'mixed_bfloat16')
+# mixed_float16/mixed_bfloat16 策略和 keras 的 LossScaleOptimizer 从 tf 2.1 开始才有, tf 2.0 只能使用 float32
+MIXED_PRECISION_MIN_TF_VERSION = (2, 1)
+
 
 def gelu_erf(x):
     """基于Erf直接计算的gelu函数
@@ -124,6 +130,52 @@ def search_layer(inputs, name, exclude_from=None):
                     return layer
 
 
+def mixed_precision_supported():
+    """当前的tf版本是否支持float32以外的混合精度策略
+    """
+    version = tuple(int(v) for v in tf.__version__.split('.')[:2])
+    return version >= MIXED_PRECISION_MIN_TF_VERSION
+
+
+def check_mixed_precision(policy=None):
+    """检查混合精度策略，未知的策略或当前tf版本不支持时抛出ValueError，
+    训练脚本在读取数据、构建模型之前调用，尽早报错。
+    """
+    policy = policy or 'float32'
+    if policy not in MIXED_PRECISION_POLICIES:
+        raise ValueError("Unknown mixed precision policy '{}', expected one of {}".format(
+            policy, MIXED_PRECISION_POLICIES))
+    if policy != 'float32' and not mixed_precision_supported():
+        raise ValueError("Mixed precision policy '{}' needs tensorflow >= {}, got {}; use float32".format(
+            policy, '.'.join(map(str, MIXED_PRECISION_MIN_TF_VERSION)), tf.__version__))
+    return policy
+
+
+def set_mixed_precision(policy=None):
+    """设置全局的混合精度策略，需要在构建模型之前调用，
+    层的计算以 float16/bfloat16 进行，变量仍保存为 float32。
+    tf < 2.1 只支持 float32（即不设置策略）。
+    """
+    policy = check_mixed_precision(policy)
+    if not mixed_precision_supported():
+        return policy
+    mixed_precision = keras.mixed_precision
+    if hasattr(mixed_precision, 'set_global_policy'):
+        mixed_precision.set_global_policy(policy)
+    else:
+        mixed_precision.experimental.set_policy(policy)
+    return policy
+
+
+def infinity(x):
+    """与x的dtype相适应的“大正数”，
+    float16下1e12会溢出为inf，而inf * 0 = nan。
+    """
+    if K.dtype(x) == 'float16':
+        return 1e4
+    return 1e12
+
+
 def sequence_masking(x, mask, mode=0, axis=None):
     """为序列条件mask的函数
     mask: 形如(batch_size, seq_len)的0-1矩阵；
@@ -134,6 +186,7 @@ def sequence_masking(x, mask, mode=0, axis=None):
     if mask is None or mode not in [0, 1]:
         return x
     else:
+        mask = K.cast(mask, K.dtype(x))
         if axis is None:
             axis = 1
         if axis == -1:
@@ -146,7 +199,7 @@ def sequence_masking(x, mask, mode=0, axis=None):
         if mode == 0:
             return x * mask
         else:
-            return x - (1 - mask) * 1e12
+            return x - (1 - mask) * infinity(x)
 
 
 def batch_gather(params, indices):
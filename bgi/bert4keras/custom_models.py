@@ -159,11 +159,12 @@ class Variable_Length_ALBERT(Transformer):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -3,7 +3,7 @@
 
 import numpy as np
 import tensorflow as tf
-from bgi.bert4keras.backend import sequence_masking
+from bgi.bert4keras.backend import sequence_masking, infinity
 
 import tensorflow.keras as keras
 import tensorflow.keras.backend as K
@@ -130,8 +130,53 @@ class BiasAdd(Layer):
         return K.bias_add(inputs, self.bias)
 
 
+def fuse_qkv_weights(weights, use_bias=True):
+    """把q、k、v三个投影的权重按输出维度拼接为融合投影的权重，其余权重不变
+    weights: [q_kernel, q_bias, k_kernel, k_bias, v_kernel, v_bias, ...]
+    （use_bias=False时为[q_kernel, k_kernel, v_kernel, ...]）
+    """
+    n = 2 if use_bias else 1
+    fused = [
+        np.concatenate([weights[i + j * n] for j in range(3)], axis=-1)
+        for i in range(n)
+    ]
+    return fused + list(weights[3 * n:])
+
+
+def split_qkv_weights(weights, sizes, use_bias=True):
+    """fuse_qkv_weights的逆操作，sizes为q、k、v的输出维度
+    """
+    n = 2 if use_bias else 1
+    indices = np.cumsum(sizes)[:-1]
+    parts = [np.split(weights[i], indices, axis=-1) for i in range(n)]
+    separate = [parts[i][j] for j in range(3) for i in range(n)]
+    return separate + list(weights[n:])
+
+
+def fuse_conv1d_weights(weights, kernel_size=None):
+    """把若干个padding='same'、stride为1的Conv1D的权重合并为一个Conv1D的权重，
+    合并后的输出等于各个卷积输出之和。
+    weights: [[kernel, bias], ...]，kernel形如(kernel_size, input_dim, filters)
+    kernel_size: 合并后的kernel_size，默认为各卷积的最大值
+    """
+    kernel_size = kernel_size or max(kernel.shape[0] for kernel, _ in weights)
+    fused_kernel = np.zeros((kernel_size,) + weights[0][0].shape[1:], dtype=weights[0][0].dtype)
+    fused_bias = np.zeros_like(weights[0][1])
+    for kernel, bias in weights:
+        size = kernel.shape[0]
+        # padding='same'时左侧补(size - 1) // 2个0，对齐各卷积的中心
+        start = (kernel_size - 1) // 2 - (size - 1) // 2
+        if start < 0 or start + size > kernel_size:
+            raise ValueError('Cannot fuse a kernel of size %d into size %d' % (size, kernel_size))
+        fused_kernel[start:start + size] += kernel
+        fused_bias += bias
+    return [fused_kernel, fused_bias]
+
+
 class MultiHeadAttention(Layer):
     """多头注意力机制
+    fused_qkv: 用一个矩阵乘法同时完成q、k、v的线性变换（仅Dense投影），
+               可通过set_weights或load_weights_from_checkpoint加载分开的q、k、v权重
     """
 
     def __init__(
@@ -143,6 +188,7 @@ class MultiHeadAttention(Layer):
             scaled_dot_product=True,
             kernel_initializer='glorot_uniform',
             custom_conv_layer=False,
+            fused_qkv=False,
             **kwargs
     ):
         super(MultiHeadAttention, self).__init__(**kwargs)
@@ -153,11 +199,33 @@ class MultiHeadAttention(Layer):
         self.use_bias = use_bias
         self.scaled_dot_product = scaled_dot_product
         self.custom_conv_layer = custom_conv_layer
+        self.fused_qkv = fused_qkv
         self.kernel_initializer = keras.initializers.get(kernel_initializer)
+        if self.fused_qkv and self.custom_conv_layer:
+            raise ValueError('fused_qkv does not support custom_conv_layer')
 
+    @property
+    def qkv_sizes(self):
+        """q、k、v投影的输出维度
+        """
+        return [self.key_size * self.heads, self.key_size * self.heads, self.out_dim]
+
+    @integerize_shape
     def build(self, input_shape):
         super(MultiHeadAttention, self).build(input_shape)
-        if self.custom_conv_layer is True:
+        if self.fused_qkv is True:
+            self.qkv_kernel = self.add_weight(
+                name='qkv_kernel',
+                shape=(input_shape[0][-1], sum(self.qkv_sizes)),
+                initializer=self.kernel_initializer
+            )
+            if self.use_bias:
+                self.qkv_bias = self.add_weight(
+                    name='qkv_bias',
+                    shape=(sum(self.qkv_sizes),),
+                    initializer='zeros'
+                )
+        elif self.custom_conv_layer is True:
             self.q_dense = keras.layers.Conv1D(
                 filters=self.key_size * self.heads,
                 kernel_size=3,
@@ -220,24 +288,14 @@ class MultiHeadAttention(Layer):
             a_mask = inputs[n]
             n += 1
 
-        print("Q: ", q, self.heads, self.key_size)
         # 线性变换
-        qw = self.q_dense(q)
-        kw = self.k_dense(k)
-        vw = self.v_dense(v)
-
-        print("QW: ", qw, self.heads, self.key_size)
-
-        # 形状变换
-        qw = K.reshape(qw, (-1, K.shape(q)[1], self.heads, self.key_size))
-        kw = K.reshape(kw, (-1, K.shape(k)[1], self.heads, self.key_size))
-        vw = K.reshape(vw, (-1, K.shape(v)[1], self.heads, self.head_size))
+        qw, kw, vw = self.compute_qkv(q, k, v)
         # Attention
-        a = tf.einsum('bjhd,bkhd->bhjk', qw, kw)
+        a = tf.matmul(qw, kw, transpose_b=True)
         # 处理位置编码
         if p_bias == 'typical_relative':
             pos_embeddings = inputs[n]
-            a = a + tf.einsum('bjhd,jkd->bhjk', qw, pos_embeddings)
+            a = a + tf.einsum('bhjd,jkd->bhjk', qw, pos_embeddings)
         elif p_bias == 't5_relative':
             pos_embeddings = K.permute_dimensions(inputs[n], (2, 0, 1))
             a = a + K.expand_dims(pos_embeddings, 0)
@@ -246,17 +304,71 @@ class MultiHeadAttention(Layer):
             a = a / self.key_size ** 0.5
         a = sequence_masking(a, v_mask, 1, -1)
         if a_mask is not None:
-            a = a - (1 - a_mask) * 1e12
+            a = a - (1 - K.cast(a_mask, K.dtype(a))) * infinity(a)
         a = K.softmax(a)
         # 完成输出
-        o = tf.einsum('bhjk,bkhd->bjhd', a, vw)
+        o = tf.matmul(a, vw)
         if p_bias == 'typical_relative':
-            o = o + tf.einsum('bhjk,jkd->bjhd', a, pos_embeddings)
+            o = o + tf.einsum('bhjk,jkd->bhjd', a, pos_embeddings)
+        # 返回结果
+        return self.merge_heads(o, q_mask)
+
+    def compute_qkv(self, q, k, v):
+        """线性变换，并变换为(batch_size, heads, seq_len, size)，之后都是连续的批量矩阵乘法
+        """
+        if self.fused_qkv:
+            qw, kw, vw = self.qkv_projection(q, k, v)
+        else:
+            qw = self.q_dense(q)
+            kw = self.k_dense(k)
+            vw = self.v_dense(v)
+        qw = self.split_heads(qw, self.key_size)
+        kw = self.split_heads(kw, self.key_size)
+        vw = self.split_heads(vw, self.head_size)
+        return qw, kw, vw
+
+    def merge_heads(self, o, q_mask=None):
+        """(batch_size, heads, seq_len, head_size) -> 输出变换 -> (batch_size, seq_len, out_dim)
+        """
+        o = K.permute_dimensions(o, (0, 2, 1, 3))
         o = K.reshape(o, (-1, K.shape(o)[1], self.out_dim))
         o = self.o_dense(o)
-        # 返回结果
-        o = sequence_masking(o, q_mask, 0)
-        return o
+        return sequence_masking(o, q_mask, 0)
+
+    def qkv_projection(self, q, k, v):
+        """融合的q、k、v线性变换，自注意力（q、k、v为同一输入）时只做一次矩阵乘法
+        """
+        if q is k and k is v:
+            qkv = K.dot(q, self.qkv_kernel)
+            if self.use_bias:
+                qkv = K.bias_add(qkv, self.qkv_bias)
+            return tf.split(qkv, self.qkv_sizes, axis=-1)
+
+        kernels = tf.split(self.qkv_kernel, self.qkv_sizes, axis=-1)
+        if self.use_bias:
+            biases = tf.split(self.qkv_bias, self.qkv_sizes)
+        else:
+            biases = [None] * 3
+        outputs = []
+        for x, kernel, bias in zip([q, k, v], kernels, biases):
+            x = K.dot(x, kernel)
+            if bias is not None:
+                x = K.bias_add(x, bias)
+            outputs.append(x)
+        return outputs
+
+    def split_heads(self, x, size):
+        """(batch_size, seq_len, heads * size) -> (batch_size, heads, seq_len, size)
+        """
+        x = K.reshape(x, (-1, K.shape(x)[1], self.heads, size))
+        return K.permute_dimensions(x, (0, 2, 1, 3))
+
+    def set_weights(self, weights):
+        """fused_qkv时也可以传入分开的q、k、v权重
+        """
+        if self.fused_qkv and len(weights) == len(self.weights) + (4 if self.use_bias else 2):
+            weights = fuse_qkv_weights(weights, self.use_bias)
+        super(MultiHeadAttention, self).set_weights(weights)
 
     def compute_output_shape(self, input_shape):
         return (input_shape[0][0], input_shape[0][1], self.out_dim)
@@ -276,11 +388,111 @@ class MultiHeadAttention(Layer):
             'scaled_dot_product': self.scaled_dot_product,
             'kernel_initializer':
                 keras.initializers.serialize(self.kernel_initializer),
+            'fused_qkv': self.fused_qkv,
         }
         base_config = super(MultiHeadAttention, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
 
+class LocalMultiHeadAttention(MultiHeadAttention):
+    """滑动窗口的局部自注意力
+    每个token只关注前后window个token，以及序列开头的global_tokens个全局token（如[CLS]）；
+    全局token关注整个序列。按大小为window的块计算，每块只与前后相邻的块做矩阵乘法，
+    显存为O(L * (3 * window + global_tokens))而不是O(L^2)。
+    权重与MultiHeadAttention完全相同，可以直接加载完整注意力训练的权重。
+    """
+
+    def __init__(self, window=128, global_tokens=0, **kwargs):
+        super(LocalMultiHeadAttention, self).__init__(**kwargs)
+        self.window = window
+        self.global_tokens = global_tokens
+
+    def call(self, inputs, mask=None, a_mask=None, p_bias=None):
+        """只支持自注意力，不支持a_mask和位置偏置p_bias
+        """
+        if a_mask or p_bias:
+            raise ValueError('LocalMultiHeadAttention does not support a_mask or p_bias')
+        q, k, v = inputs[:3]
+        q_mask, v_mask = None, None
+        if mask is not None:
+            if mask[0] is not None:
+                q_mask = K.cast(mask[0], K.floatx())
+            if mask[2] is not None:
+                v_mask = K.cast(mask[2], K.floatx())
+
+        qw, kw, vw = self.compute_qkv(q, k, v)
+        w, g = self.window, self.global_tokens
+        seq_len = K.shape(qw)[2]
+        if v_mask is None:
+            v_mask = K.ones_like(k[..., 0])
+        v_mask = K.cast(v_mask, qw.dtype)
+
+        # 补齐为window的整数倍，并分块: (batch_size, heads, num_blocks, window, size)
+        padding = (w - seq_len % w) % w
+        num_blocks = (seq_len + padding) // w
+
+        def to_blocks(x):
+            x = tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]])
+            return K.reshape(x, (-1, self.heads, num_blocks, w, K.shape(x)[-1]))
+
+        def with_neighbours(x):
+            """每块拼接上前后相邻的块: (..., num_blocks, window, ...) -> (..., num_blocks, 3 * window, ...)
+            """
+            paddings = [[0, 0]] * len(x.shape)
+            paddings[2] = [1, 1]
+            x = tf.pad(x, paddings)
+            return K.concatenate([x[:, :, :-2], x[:, :, 1:-1], x[:, :, 2:]], axis=3)
+
+        qb, kb, vb = to_blocks(qw), to_blocks(kw), to_blocks(vw)
+        kb, vb = with_neighbours(kb), with_neighbours(vb)
+
+        # key的mask: padding、块外的位置、以及已作为全局token单独计算的开头g个位置
+        key_mask = tf.pad(v_mask, [[0, 0], [0, padding]])
+        if g > 0:
+            key_mask = key_mask * K.cast(K.arange(seq_len + padding) >= g, key_mask.dtype)
+        key_mask = K.reshape(key_mask, (-1, 1, num_blocks, w, 1))
+        key_mask = with_neighbours(key_mask)[..., 0]
+        positions = K.reshape(K.arange(num_blocks * w), (num_blocks, w))
+        key_positions = K.concatenate([positions - w, positions, positions + w], axis=1)
+        band = K.abs(K.expand_dims(positions, 2) - K.expand_dims(key_positions, 1)) <= w
+        a_mask = K.cast(band, qw.dtype)[None, None] * K.expand_dims(key_mask, 3)
+
+        a = tf.matmul(qb, kb, transpose_b=True)
+        if g > 0:
+            # 每个token都关注全局token
+            gk, gv = kw[:, :, :g], vw[:, :, :g]
+            ga = tf.einsum('bhnwd,bhgd->bhnwg', qb, gk)
+            a = K.concatenate([ga, a], axis=-1)
+            g_mask = K.reshape(v_mask[:, :g], (-1, 1, 1, 1, g))
+            a_mask = K.concatenate([g_mask * K.ones_like(a_mask[..., :1]), a_mask], axis=-1)
+            vb = K.concatenate([tf.tile(gv[:, :, None], [1, 1, num_blocks, 1, 1]), vb], axis=3)
+        if self.scaled_dot_product:
+            a = a / self.key_size ** 0.5
+        a = a - (1 - a_mask) * infinity(a)
+        a = K.softmax(a)
+        o = tf.matmul(a, vb)
+        o = K.reshape(o, (-1, self.heads, num_blocks * w, self.head_size))[:, :, :seq_len]
+
+        if g > 0:
+            # 全局token关注整个序列
+            ga = tf.matmul(qw[:, :, :g], kw, transpose_b=True)
+            if self.scaled_dot_product:
+                ga = ga / self.key_size ** 0.5
+            ga = sequence_masking(ga, v_mask, 1, -1)
+            ga = K.softmax(ga)
+            o = K.concatenate([tf.matmul(ga, vw), o[:, :, g:]], axis=2)
+
+        return self.merge_heads(o, q_mask)
+
+    def get_config(self):
+        config = {
+            'window': self.window,
+            'global_tokens': self.global_tokens,
+        }
+        base_config = super(LocalMultiHeadAttention, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 class LayerNormalization(Layer):
     """(Conditional) Layer Normalization
     hidden_*系列参数仅为有条件输入时(conditional=True)使用
@@ -361,7 +573,9 @@ class LayerNormalization(Layer):
             if self.scale:
                 gamma = self.gamma
 
-        outputs = inputs
+        # 混合精度下以float32计算均值和方差，float16下epsilon会下溢为0
+        dtype = K.dtype(inputs)
+        outputs = K.cast(inputs, 'float32')
         if self.center:
             mean = K.mean(outputs, axis=-1, keepdims=True)
             outputs = outputs - mean
@@ -369,11 +583,11 @@ class LayerNormalization(Layer):
             variance = K.mean(K.square(outputs), axis=-1, keepdims=True)
             std = K.sqrt(variance + self.epsilon)
             outputs = outputs / std
-            outputs = outputs * gamma
+            outputs = outputs * K.cast(gamma, 'float32')
         if self.center:
-            outputs = outputs + beta
+            outputs = outputs + K.cast(beta, 'float32')
 
-        return outputs
+        return K.cast(outputs, dtype)
 
     def compute_output_shape(self, input_shape):
         if self.conditional:
@@ -966,6 +1180,7 @@ custom_objects = {
     'Embedding': Embedding,
     'BiasAdd': BiasAdd,
     'MultiHeadAttention': MultiHeadAttention,
+    'LocalMultiHeadAttention': LocalMultiHeadAttention,
     'LayerNormalization': LayerNormalization,
     'PositionEmbedding': PositionEmbedding,
     'RelativePositionEmbedding': RelativePositionEmbedding,
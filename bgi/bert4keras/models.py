@@ -10,6 +10,12 @@ import tensorflow.keras.backend as K
 
 from bgi.bert4keras.layers import *
 from bgi.bert4keras.snippets import delete_arguments
+from bgi.bert4keras.backend import set_mixed_precision
+
+
+# custom_conv_layer时token embedding上的卷积，分开时各层名为'Embedding-Token-Conv1D-{kernel_size}'
+CONV_EMBEDDING_KERNEL_SIZES = (2, 3, 5)
+FUSED_CONV_EMBEDDING_NAME = 'Embedding-Token-Conv1D'
 
 
 class Transformer(object):
@@ -32,6 +38,10 @@ class Transformer(object):
             layers=None,  # 外部传入的Keras层
             name=None,  # 模型名称
             type_vocab_size=2, # Token的类型
+            fused_qkv=False,  # Attention中是否用一个矩阵乘法完成q、k、v的线性变换
+            attention_window=None,  # 局部注意力的窗口大小，None为完整的注意力
+            attention_global_tokens=0,  # 局部注意力中关注整个序列的开头token数，如[CLS]
+            fused_conv_embedding=False,  # custom_conv_layer的三个卷积是否合并为一个卷积
             **kwargs
     ):
         if keep_tokens is None:
@@ -55,6 +65,10 @@ class Transformer(object):
         self.name = name
         self.built = False
         self.type_vocab_size = type_vocab_size
+        self.fused_qkv = fused_qkv
+        self.attention_window = attention_window
+        self.attention_global_tokens = attention_global_tokens
+        self.fused_conv_embedding = fused_conv_embedding
 
     def build(
             self,
@@ -139,6 +153,47 @@ class Transformer(object):
         """
         return self.position_bias
 
+    def apply_conv_embeddings(self, x):
+        """custom_conv_layer时token embedding上的卷积，返回需要相加的各个输出；
+        fused_conv_embedding时只做一次kernel_size为5的卷积，与分开的三个卷积之和等价，
+        分开的卷积权重可以通过load_weights_by_layer加载
+        """
+        if self.fused_conv_embedding:
+            x = self.apply(
+                inputs=x,
+                layer=keras.layers.Conv1D,
+                filters=self.embedding_size,
+                kernel_size=max(CONV_EMBEDDING_KERNEL_SIZES),
+                strides=1,
+                padding='same',
+                name=FUSED_CONV_EMBEDDING_NAME
+            )
+            return [x]
+
+        outputs = []
+        for kernel_size in CONV_EMBEDDING_KERNEL_SIZES:
+            outputs.append(self.apply(
+                inputs=x,
+                layer=keras.layers.Conv1D,
+                filters=self.embedding_size,
+                kernel_size=kernel_size,
+                strides=1,
+                padding='same',
+                name='{}-{}'.format(FUSED_CONV_EMBEDDING_NAME, kernel_size)
+            ))
+        return outputs
+
+    def attention_arguments(self):
+        """自注意力层及其参数，设置了attention_window时为局部注意力
+        """
+        if self.attention_window is None:
+            return {'layer': MultiHeadAttention}
+        return {
+            'layer': LocalMultiHeadAttention,
+            'window': self.attention_window,
+            'global_tokens': self.attention_global_tokens,
+        }
+
     def set_inputs(self, inputs, additional_input_layers=None):
         """设置input和inputs属性
         """
@@ -228,14 +283,15 @@ class Transformer(object):
                 if layer.scaled_dot_product:
                     W = W * key_size ** 0.25 / head_size ** 0.25
                 for i in range(count):
-                    w, v = weights[i], values[i]
-                    w_shape, v_shape = K.int_shape(w), v.shape
-                    if w_shape[-1] != v_shape[-1]:
-                        pre_shape = w_shape[:-1]
+                    v = values[i]
+                    if v.shape[-1] != heads * key_size:
+                        pre_shape = v.shape[:-1]
                         v = v.reshape(pre_shape + (heads, head_size))
                         v = np.dot(v, W)
                         v = v.reshape(pre_shape + (heads * key_size,))
                         values[i] = v
+                if layer.fused_qkv:
+                    values = fuse_qkv_weights(values, layer.use_bias)
 
             weight_value_pairs.extend(zip(weights, values))
 
@@ -251,6 +307,8 @@ class Transformer(object):
             for layer, variables in mapping.items():
                 layer = self.layers[layer]
                 values = K.batch_get_value(layer.trainable_weights)
+                if isinstance(layer, MultiHeadAttention) and layer.fused_qkv:
+                    values = split_qkv_weights(values, layer.qkv_sizes, layer.use_bias)
                 for name, value in zip(variables, values):
                     self.create_variable(name, value)
             with tf.Session() as sess:
@@ -332,34 +390,7 @@ class BERT(Transformer):
             name='Embedding-Token'
         )
         if self.custom_conv_layer:
-            x1 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=2,
-                strides=1,
-                padding='same',
-                name='Embedding-Token-Conv1D-2'
-            )
-            x2 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=3,
-                strides=1,
-                # dilation_rate=2,
-                padding='same',
-                name='Embedding-Token-Conv1D-3'
-            )
-            x3 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=5,
-                strides=1,
-                padding='same',
-                name='Embedding-Token-Conv1D-5'
-            )
+            conv_outputs = self.apply_conv_embeddings(x)
 
         s = self.apply(
             inputs=s,
@@ -373,7 +404,7 @@ class BERT(Transformer):
         print("x: ", x)
         print("s: ", s)
         if self.custom_conv_layer:
-            embedding_inputs = [x1, x2, x3, s]
+            embedding_inputs = conv_outputs + [s]
         else:
             embedding_inputs = [x, s]
 
@@ -390,8 +421,10 @@ class BERT(Transformer):
 
         if self.use_segment_ids:
             x = self.apply(inputs=embedding_inputs, layer=keras.layers.Add, name='Embedding-Token-Segment')
+        elif len(conv_outputs) > 1:
+            x = self.apply(inputs=conv_outputs, layer=keras.layers.Add, name='Embedding-Token-Segment')
         else:
-            x = self.apply(inputs=[x1, x2, x3], layer=keras.layers.Add, name='Embedding-Token-Segment')
+            x = conv_outputs[0]
 
         if self.use_position_ids:
             x = self.apply(
@@ -449,11 +482,12 @@ class BERT(Transformer):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             # custom_conv_layer=self.custom_conv_layer,
             name=attention_name
@@ -588,6 +622,7 @@ class BERT(Transformer):
                 inputs=x,
                 layer=keras.layers.Activation,
                 activation=mlm_activation,
+                dtype='float32',  # 混合精度下输出仍为float32
                 name='MLM-Activation'
             )
             outputs.append(x)
@@ -714,11 +749,12 @@ class ALBERT(BERT):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -894,11 +930,12 @@ class ALBERT_Hierarchy(BERT):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -1070,6 +1107,7 @@ class NEZHA(BERT):
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -1275,6 +1313,7 @@ class GPT2_ML(Transformer):
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -1596,6 +1635,7 @@ class T5_Encoder(T5_Base):
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             use_bias=False,
             scaled_dot_product=False,
             kernel_initializer=self.initializer,
@@ -1779,6 +1819,7 @@ class T5_Decoder(Transformer):
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             use_bias=False,
             scaled_dot_product=False,
             kernel_initializer=self.initializer,
@@ -1817,6 +1858,7 @@ class T5_Decoder(Transformer):
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             use_bias=False,
             scaled_dot_product=False,
             kernel_initializer=self.initializer,
@@ -2150,34 +2192,9 @@ class Multi_Inputs_BERT(Transformer):
             name='Embedding-Token'
         )
         if self.custom_conv_layer:
-            x1 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=2,
-                strides=1,
-                padding='same',
-                name='Embedding-Token-Conv1D-2'
-            )
-            x2 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=3,
-                strides=1,
-                # dilation_rate=2,
-                padding='same',
-                name='Embedding-Token-Conv1D-3'
-            )
-            x3 = self.apply(
-                inputs=x,
-                layer=keras.layers.Conv1D,
-                filters=self.embedding_size,
-                kernel_size=5,
-                strides=1,
-                padding='same',
-                name='Embedding-Token-Conv1D-5'
-            )
+            conv_outputs = self.apply_conv_embeddings(x)
+        else:
+            conv_outputs = [x]
         s = self.apply(
             inputs=s,
             layer=Embedding,
@@ -2187,9 +2204,10 @@ class Multi_Inputs_BERT(Transformer):
             name='Embedding-Segment'
         )
 
-        embedding_inputs = [x1, x2, x3]
+        # 复制一份，后面的append不会修改conv_outputs
+        embedding_inputs = list(conv_outputs)
         if self.use_segment_ids:
-            embedding_inputs = [x1, x2, x3, s]
+            embedding_inputs.append(s)
 
         # if self.type_vocab_size > 0:
         #     t = self.apply(
@@ -2226,7 +2244,11 @@ class Multi_Inputs_BERT(Transformer):
                     #     )
                     embedding_inputs.append(type)
 
-        x = self.apply(inputs=embedding_inputs, layer=keras.layers.Add, name='Embedding-Token-Segment')
+        if len(embedding_inputs) > 1:
+            x = self.apply(inputs=embedding_inputs, layer=keras.layers.Add, name='Embedding-Token-Segment')
+        else:
+            # fused_conv_embedding且没有segment等其他输入时只有一项，Add至少需要两个输入
+            x = embedding_inputs[0]
         x = self.apply(
             inputs=self.simplify([x, p]),
             layer=PositionEmbedding,
@@ -2282,11 +2304,12 @@ class Multi_Inputs_BERT(Transformer):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -2420,6 +2443,7 @@ class Multi_Inputs_BERT(Transformer):
                 inputs=x,
                 layer=keras.layers.Activation,
                 activation=mlm_activation,
+                dtype='float32',  # 混合精度下输出仍为float32
                 name='MLM-Activation'
             )
             outputs.append(x)
@@ -2797,11 +2821,12 @@ class Multi_Inputs_Alt_BERT(Transformer):
 
         x = self.apply(
             inputs=x,
-            layer=MultiHeadAttention,
+            **self.attention_arguments(),
             arguments=arguments,
             heads=self.num_attention_heads,
             head_size=self.attention_head_size,
             key_size=self.attention_key_size,
+            fused_qkv=self.fused_qkv,
             kernel_initializer=self.initializer,
             name=attention_name
         )
@@ -2924,6 +2949,7 @@ class Multi_Inputs_Alt_BERT(Transformer):
                 inputs=x,
                 layer=keras.layers.Activation,
                 activation=mlm_activation,
+                dtype='float32',  # 混合精度下输出仍为float32
                 name='MLM-Activation-ALT'
             )
             outputs.append(x)
@@ -3036,9 +3062,31 @@ def build_transformer_model(
         model='bert',
         application='encoder',
         return_keras_model=True,
+        mixed_precision=None,
+        fused_qkv=None,
+        attention_window=None,
+        attention_global_tokens=None,
+        fused_conv_embedding=None,
+        inference=False,
+        num_classes=None,
+        head_activation='sigmoid',
+        weights_path=None,
         **kwargs
 ):
     """根据配置文件构建模型，可选加载checkpoint权重
+    mixed_precision: 混合精度策略，见backend.MIXED_PRECISION_POLICIES，
+                     None则沿用当前的全局策略。
+    fused_qkv: Attention中是否用一个矩阵乘法完成q、k、v的线性变换，
+               None则沿用configs中的设置（默认不融合）。
+    fused_conv_embedding: custom_conv_layer时token embedding上的三个卷积合并为一个，
+                          None则沿用configs中的设置（默认不合并）。
+    attention_window: BERT/ALBERT类模型使用窗口为attention_window的局部注意力，
+                      attention_global_tokens为关注整个序列的开头token数（如[CLS]为1），
+                      None则沿用configs中的设置（默认为完整的注意力）。
+    inference: 只用于预测的模型，不构建Dropout和MLM/NSP/Pool等训练时的输出；
+               num_classes不为None时加上add_cls_head的分类头（激活函数为head_activation），
+               weights_path不为None时用load_inference_weights严格加载权重，
+               返回InferenceModel，其model属性为keras模型。
     """
 
     if config_path is not None:
@@ -3053,6 +3101,19 @@ def build_transformer_model(
         configs['max_position'] = configs.get('max_position_embeddings')
     if 'dropout_rate' not in configs:
         configs['dropout_rate'] = configs.get('hidden_dropout_prob')
+    if fused_qkv is not None:
+        configs['fused_qkv'] = fused_qkv
+    if attention_window is not None:
+        configs['attention_window'] = attention_window
+    if attention_global_tokens is not None:
+        configs['attention_global_tokens'] = attention_global_tokens
+    if fused_conv_embedding is not None:
+        configs['fused_conv_embedding'] = fused_conv_embedding
+    if inference:
+        configs['dropout_rate'] = 0
+        configs['with_pool'] = False
+        configs['with_nsp'] = False
+        configs['with_mlm'] = False
 
     model, application = model.lower(), application.lower()
 
@@ -3076,13 +3137,254 @@ def build_transformer_model(
         elif application == 'unilm':
             MODEL = extend_with_unified_language_model(MODEL)
 
+    if mixed_precision is not None:
+        set_mixed_precision(mixed_precision)
+
     transformer = MODEL(**configs)
     transformer.build(**configs)
 
     if checkpoint_path is not None:
         transformer.load_weights_from_checkpoint(checkpoint_path)
 
+    if inference:
+        keras_model = transformer.model
+        if num_classes is not None:
+            keras_model = add_cls_head(transformer, num_classes, activation=head_activation)
+        if weights_path is not None:
+            load_inference_weights(keras_model, weights_path)
+        return InferenceModel(keras_model, sequence_length=configs.get('sequence_length'))
+
     if return_keras_model:
         return transformer.model
     else:
         return transformer
+
+
+def add_cls_head(transformer, num_classes, activation='sigmoid'):
+    """各个分类任务共用的输出：取[CLS]位置的向量接Dense，
+    层名为'CLS-token'和'CLS-Activation'，训练、预测和蒸馏的权重可以互相加载；
+    activation为None时输出logits。
+    """
+    output = keras.layers.Lambda(lambda x: x[:, 0], name='CLS-token')(transformer.model.output)
+    output = keras.layers.Dense(
+        name='CLS-Activation',
+        units=num_classes,
+        activation=activation,
+        kernel_initializer=transformer.initializer,
+        dtype='float32'
+    )(output)
+    return keras.models.Model(transformer.model.input, output)
+
+
+class InferenceModel(object):
+    """只用于预测的模型，没有keras.Model.predict的回调、进度条等开销。
+    eager下前向计算包装为输入签名固定的tf.function，不同batch（包括最后一个不完整的batch）
+    都复用同一个计算图；bert4keras.backend默认关闭了eager，此时在构造时以placeholder为输入
+    建一次计算图，之后每个batch都通过session运行这个图，不会在图中重复添加节点。
+    """
+
+    def __init__(self, model, sequence_length=None):
+        self.model = model
+        self.input_names = list(model.input_names)
+        self.input_signature = []
+        for name, x in zip(self.input_names, model.inputs):
+            shape = [None] + list(K.int_shape(x)[1:])
+            if sequence_length is not None and len(shape) > 1:
+                shape[1] = sequence_length
+            self.input_signature.append(tf.TensorSpec(shape, x.dtype, name=name))
+
+        if tf.executing_eagerly():
+            self.function = tf.function(
+                self.forward, input_signature=self.input_signature
+            )
+        else:
+            self.function = None
+            self.placeholders = [
+                tf.compat.v1.placeholder(spec.dtype, spec.shape, name=spec.name)
+                for spec in self.input_signature
+            ]
+            self.outputs = self.forward(*self.placeholders)
+
+    def forward(self, *inputs):
+        if len(inputs) == 1:
+            return self.model(inputs[0], training=False)
+        return self.model(list(inputs), training=False)
+
+    def __call__(self, inputs):
+        """inputs为按输入层名索引的dict，或与model.inputs顺序一致的list；
+        eager下返回Tensor，图模式下返回numpy数组。
+        """
+        if isinstance(inputs, dict):
+            inputs = [inputs[name] for name in self.input_names]
+        elif not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        if self.function is None:
+            feed_dict = {
+                p: np.asarray(x, dtype=spec.dtype.as_numpy_dtype)
+                for p, x, spec in
+                zip(self.placeholders, inputs, self.input_signature)
+            }
+            return tf.compat.v1.keras.backend.get_session().run(self.outputs, feed_dict=feed_dict)
+
+        inputs = [
+            tf.cast(x, spec.dtype)
+            for x, spec in zip(inputs, self.input_signature)
+        ]
+        return self.function(*inputs)
+
+    def iterate(self, dataset):
+        """逐个读取tf.data.Dataset的batch；图模式下不能直接迭代Dataset，
+        与callbacks.benchmark_dataset一样用initializable iterator在session中读取。
+        """
+        if tf.executing_eagerly():
+            for batch in dataset:
+                yield batch
+            return
+
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        next_element = iterator.get_next()
+        session = tf.compat.v1.keras.backend.get_session()
+        session.run(iterator.initializer)
+        while True:
+            try:
+                yield session.run(next_element)
+            except tf.errors.OutOfRangeError:
+                return
+
+    def predict(self, dataset):
+        """逐batch预测tf.data.Dataset，元素为inputs或(inputs, labels)，返回拼接后的numpy数组
+        """
+        outputs = []
+        for batch in self.iterate(dataset):
+            if isinstance(batch, tuple):
+                batch = batch[0]
+            output = self(batch)
+            if isinstance(output, (list, tuple)):
+                outputs.append([np.asarray(o) for o in output])
+            else:
+                outputs.append(np.asarray(output))
+        if len(outputs) > 0 and isinstance(outputs[0], list):
+            return [np.concatenate(o) for o in zip(*outputs)]
+        return np.concatenate(outputs)
+
+
+def read_weights_by_layer(filepath):
+    """读取keras的h5权重文件，返回{层名: 权重列表}，保持文件中层的顺序
+    """
+    import h5py
+
+    with h5py.File(filepath, mode='r') as f:
+        if 'model_weights' in f:
+            f = f['model_weights']
+        values = {}
+        for name in f.attrs['layer_names']:
+            name = name.decode('utf8') if isinstance(name, bytes) else name
+            g = f[name]
+            weight_names = [
+                n.decode('utf8') if isinstance(n, bytes) else n
+                for n in g.attrs['weight_names']
+            ]
+            values[name] = [np.asarray(g[n]) for n in weight_names]
+    return values
+
+
+def load_inference_weights(model, filepath, strict=True):
+    """按层名加载save_inference_weights保存的权重，一次batch_set_value完成赋值；
+    strict时模型中每个有权重的层都必须在文件中且形状一致，文件中也不能有多余的层，
+    否则抛出ValueError（而不是像load_weights(skip_mismatch=True)那样静默跳过）。
+    """
+    values = read_weights_by_layer(filepath)
+    layers = [layer for layer in model.layers if layer.weights]
+
+    if strict:
+        names = set(layer.name for layer in layers)
+        saved = set(name for name, weights in values.items() if weights)
+        if names != saved:
+            raise ValueError(
+                'Layers mismatch between the model and %s, missing: %s, unexpected: %s'
+                % (filepath, sorted(names - saved), sorted(saved - names))
+            )
+
+    weight_value_tuples = []
+    for layer in layers:
+        if layer.name not in values:
+            continue
+        weights, saved_values = layer.weights, values[layer.name]
+        if len(weights) != len(saved_values) or any(
+            K.int_shape(w) != v.shape for w, v in zip(weights, saved_values)
+        ):
+            if strict:
+                raise ValueError(
+                    'Weights mismatch for layer %s: %s in the model, %s in %s' % (
+                        layer.name,
+                        [K.int_shape(w) for w in weights],
+                        [v.shape for v in saved_values],
+                        filepath
+                    )
+                )
+            continue
+        weight_value_tuples.extend(zip(weights, saved_values))
+    K.batch_set_value(weight_value_tuples)
+
+
+def save_inference_weights(model, filepath):
+    """只保存模型中有权重的层，格式与model.save_weights相同，
+    训练或预训练的权重（含MLM等输出）先加载到推理模型，再保存为精简的权重文件。
+    """
+    import h5py
+
+    layers = [layer for layer in model.layers if layer.weights]
+    values = iter(K.batch_get_value([w for layer in layers for w in layer.weights]))
+    with h5py.File(filepath, mode='w') as f:
+        f.attrs['layer_names'] = [layer.name.encode('utf8') for layer in layers]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        for layer in layers:
+            g = f.create_group(layer.name)
+            weight_names = [w.name.encode('utf8') for w in layer.weights]
+            g.attrs['weight_names'] = weight_names
+            for name in weight_names:
+                g.create_dataset(name, data=next(values))
+
+
+def load_weights_by_layer(model, filepath, strict=False):
+    """按层名从keras的h5权重文件加载权重，逐层调用layer.set_weights，
+    可以把分开的q、k、v权重加载到fused_qkv的模型中，
+    以及把分开的卷积embedding权重加载到fused_conv_embedding的模型中（反之不行）。
+    strict时模型中每个有权重的层都必须能从文件中加载，否则在赋值前抛出ValueError，
+    文件中多余的层（如训练时的MLM输出）仍然忽略。
+    """
+    layers = {layer.name: layer for layer in model.layers}
+    values = read_weights_by_layer(filepath)
+
+    # 分开的卷积embedding合并后加载
+    conv_names = [
+        '{}-{}'.format(FUSED_CONV_EMBEDDING_NAME, kernel_size)
+        for kernel_size in CONV_EMBEDDING_KERNEL_SIZES
+    ]
+    fuse_conv = (
+        FUSED_CONV_EMBEDDING_NAME in layers and
+        FUSED_CONV_EMBEDDING_NAME not in values and
+        all(name in values for name in conv_names)
+    )
+
+    if strict:
+        missing = [
+            layer.name for layer in model.layers
+            if layer.weights and not values.get(layer.name) and
+            not (fuse_conv and layer.name == FUSED_CONV_EMBEDDING_NAME)
+        ]
+        if missing:
+            raise ValueError(
+                'Layers missing from %s: %s' % (filepath, sorted(missing))
+            )
+
+    for name, weights in values.items():
+        if name in layers and weights:
+            layers[name].set_weights(weights)
+
+    if fuse_conv:
+        layers[FUSED_CONV_EMBEDDING_NAME].set_weights(
+            fuse_conv1d_weights([values[name] for name in conv_names])
+        )
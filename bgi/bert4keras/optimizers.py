@@ -7,7 +7,8 @@ import tensorflow as tf
 from bgi.bert4keras.backend import is_tf_keras
 from bgi.bert4keras.snippets import is_string, string_matching
 from bgi.bert4keras.snippets import is_one_of, insert_arguments
-from bgi.bert4keras.backend import piecewise_linear
+from bgi.bert4keras.backend import piecewise_linear, check_mixed_precision
+from bgi.bert4keras.lamb import LAMB
 
 import re
 
@@ -991,3 +992,38 @@ custom_objects = {
 }
 
 keras.utils.get_custom_objects().update(custom_objects)
+
+
+OPTIMIZERS = ('adam', 'lamb')
+
+
+def get_optimizer(name='adam', learning_rate=1e-3, grad_accum_steps=1, mixed_precision=None, **kwargs):
+    """训练脚本共用的优化器构建函数
+    name: 'adam' 或 'lamb'；
+    grad_accum_steps: 大于1时每grad_accum_steps个batch更新一次参数，
+                      等效batch_size扩大相同的倍数，显存占用不变；
+    mixed_precision: 为'mixed_float16'时用动态loss scaling包装优化器，
+                     防止float16的梯度下溢，bfloat16不需要；需要 tf >= 2.1。
+    """
+    if name not in OPTIMIZERS:
+        raise ValueError("Unknown optimizer '{}', expected one of {}".format(name, OPTIMIZERS))
+    check_mixed_precision(mixed_precision)
+
+    if grad_accum_steps > 1:
+        # 梯度累积通过_resource_apply实现，只有这里的Adam支持
+        if name != 'adam':
+            raise ValueError("Gradient accumulation is only supported with 'adam', got '{}'".format(name))
+        AdamGA = extend_with_gradient_accumulation(Adam, name='AdamGA')
+        optimizer = AdamGA(learning_rate=learning_rate, grad_accum_steps=grad_accum_steps, **kwargs)
+    elif name == 'adam':
+        optimizer = keras.optimizers.Adam(learning_rate=learning_rate, **kwargs)
+    else:
+        optimizer = LAMB(learning_rate=learning_rate, **kwargs)
+
+    if mixed_precision == 'mixed_float16':
+        loss_scale = keras.mixed_precision
+        if hasattr(loss_scale, 'LossScaleOptimizer'):
+            optimizer = loss_scale.LossScaleOptimizer(optimizer)
+        else:
+            optimizer = loss_scale.experimental.LossScaleOptimizer(optimizer, loss_scale='dynamic')
+    return optimizer
@@ -0,0 +1,85 @@
+import numpy as np
+import tensorflow as tf
+
+
+def encode_annotation_intervals(annotations, gene_type_dict: dict, seq_size: int):
+    """
+    将每条序列的注释 [[gene_type, start, end], ...] 编码为稀疏区间，
+    替代 (len(gene_type_dict) + 2, seq_size) 的稠密 0/1 矩阵
+    :param annotations: 每条序列的注释列表
+    :param gene_type_dict: 注释类型 -> 行号，未知类型为 0
+    :param seq_size:
+    :return: intervals int32 (M, 3) 即 (type, start, end)；offsets int64 (N + 1)，
+             第 ii 条序列的区间为 intervals[offsets[ii]:offsets[ii + 1]]
+    """
+    intervals = []
+    offsets = np.zeros(len(annotations) + 1, dtype=np.int64)
+    for ii, anno in enumerate(annotations):
+        for jj in range(len(anno)):
+            gene_type = gene_type_dict.get(anno[jj][0], 0)
+            start = max(int(anno[jj][1]), 0)
+            end = min(int(anno[jj][2]), seq_size)
+            if start < end:
+                intervals.append((gene_type, start, end))
+        offsets[ii + 1] = len(intervals)
+
+    intervals = np.array(intervals, dtype=np.int32).reshape((-1, 3))
+    return intervals, offsets
+
+
+def pad_annotation_intervals(intervals: np.ndarray, offsets: np.ndarray, max_intervals: int = None):
+    """
+    按序列补齐为 (N, max_intervals, 3)，补齐的区间为 (0, 0, 0)，栅格化后为空
+    :param intervals:
+    :param offsets:
+    :param max_intervals: 默认为单条序列的最大区间数
+    :return:
+    """
+    counts = np.diff(offsets)
+    if max_intervals is None:
+        max_intervals = int(counts.max()) if len(counts) > 0 else 0
+    max_intervals = max(max_intervals, 1)
+
+    padded = np.zeros((len(counts), max_intervals, 3), dtype=np.int32)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(rows)) - np.repeat(offsets[:-1], counts)
+    keep = cols < max_intervals
+    padded[rows[keep], cols[keep]] = intervals[keep]
+    return padded
+
+
+def slice_annotation_intervals(padded: np.ndarray, frame: int = 0, ngram: int = 1):
+    """
+    与 anno_data[:, :, frame::ngram] 等价的区间变换：
+    切片后第 p 个位置对应原位置 frame + p * ngram
+    :param padded: (N, max_intervals, 3)
+    :param frame:
+    :param ngram:
+    :return:
+    """
+    sliced = padded.copy()
+    # ceil((x - frame) / ngram)
+    sliced[..., 1] = np.maximum(-((frame - padded[..., 1]) // ngram), 0)
+    sliced[..., 2] = np.maximum(-((frame - padded[..., 2]) // ngram), 0)
+    return sliced
+
+
+def rasterize_annotation_intervals(intervals, annotation_size: int, seq_len: int, dtype=tf.int16):
+    """
+    在 tf.data 的批处理阶段，将区间还原为稠密的注释轨道
+    :param intervals: (batch_size, max_intervals, 3)
+    :param annotation_size:
+    :param seq_len:
+    :param dtype:
+    :return: (batch_size, annotation_size, seq_len)
+    """
+    intervals = tf.cast(intervals, tf.int32)
+    positions = tf.range(seq_len, dtype=tf.int32)
+
+    starts = tf.expand_dims(intervals[..., 1], axis=-1)
+    ends = tf.expand_dims(intervals[..., 2], axis=-1)
+    covered = tf.cast((positions >= starts) & (positions < ends), tf.float32)
+    types = tf.one_hot(intervals[..., 0], annotation_size, dtype=tf.float32)
+
+    track = tf.einsum('bmt,bml->btl', types, covered)
+    return tf.cast(track > 0, dtype)
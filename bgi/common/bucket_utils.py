@@ -0,0 +1,134 @@
+import numpy as np
+import tensorflow as tf
+
+
+def get_bucket_boundaries(max_len: int, num_buckets: int = 4, multiple: int = 8):
+    """
+    把 (0, max_len] 均匀分为 num_buckets 个桶, 边界取 multiple 的倍数
+    :param max_len: 补齐后的序列长度, 如 1000, 2000
+    :param num_buckets:
+    :param multiple: 边界对齐的倍数, 便于 GPU 计算
+    :return: 升序的边界列表 (不含 max_len), 长度为 num_buckets - 1, 用于 bucket_by_sequence_length
+    """
+    if num_buckets < 1:
+        raise ValueError("num_buckets must be >= 1, got {}".format(num_buckets))
+    boundaries = set()
+    for ii in range(1, num_buckets):
+        boundary = int(np.ceil(max_len * ii / num_buckets / multiple)) * multiple
+        if 0 < boundary < max_len:
+            boundaries.add(boundary)
+    return sorted(boundaries)
+
+
+def get_token_length(tokens):
+    """
+    序列的实际长度: 最后一个非 0 token 的位置 + 1, 数据末尾以 0 补齐; 全为 0 时返回 1, 避免得到空序列
+    :param tokens: (L,) 或 (N, L)
+    :return: 标量或 (N,) int32
+    """
+    mask = tf.cast(tf.not_equal(tokens, 0), tf.int32)
+    positions = tf.range(1, tf.shape(tokens)[-1] + 1)
+    return tf.maximum(tf.reduce_max(mask * positions, axis=-1), 1)
+
+
+def get_token_lengths(x_data: np.ndarray):
+    """
+    get_token_length 的 numpy 版本
+    :param x_data: (N, L)
+    :return: (N,) int
+    """
+    x_data = np.asarray(x_data)
+    nonzero = x_data != 0
+    lengths = x_data.shape[-1] - np.argmax(nonzero[..., ::-1], axis=-1)
+    lengths[~nonzero.any(axis=-1)] = 1
+    return lengths
+
+
+def trim_padding(dataset, sequence_groups=((0,),)):
+    """
+    去掉每个样本末尾补齐的 0, 同一组的各个分量截取到组内第一个分量 (token) 的实际长度
+    :param dataset: 元素为 tuple 的 tf.data.Dataset, 如 (x, segment, y)
+    :param sequence_groups: 每组为分量下标的 tuple, 第一个为 token, 其余 (segment, 注释等) 的最后一维与 token 对齐;
+                            如 EPI 的 (x_enhancer, segment_enhancer, x_promoter, segment_promoter, y) 为 ((0, 1), (2, 3))
+    :return:
+    """
+
+    def trim(*element):
+        element = list(element)
+        for group in sequence_groups:
+            length = get_token_length(element[group[0]])
+            for index in group:
+                element[index] = element[index][..., :length]
+        return tuple(element)
+
+    return dataset.map(trim)
+
+
+def bucket_by_length(dataset,
+                     batch_size: int,
+                     bucket_boundaries: list,
+                     sequence_groups=((0,),),
+                     bucket_batch_sizes: list = None,
+                     drop_remainder=False):
+    """
+    按实际长度分桶组 batch, 每个 batch 只补齐到 batch 内的最大长度, 代替 dataset.batch(batch_size);
+    以第一组 token 的长度分桶. 样本的顺序会被打乱, 预测时使用 batch_by_length
+    :param dataset: 元素为 tuple 的 tf.data.Dataset
+    :param batch_size:
+    :param bucket_boundaries: get_bucket_boundaries 的返回值
+    :param sequence_groups: 见 trim_padding
+    :param bucket_batch_sizes: 每个桶的 batch_size, 长度为 len(bucket_boundaries) + 1, 默认都为 batch_size;
+                               短序列的桶可以使用更大的 batch_size
+    :param drop_remainder:
+    :return:
+    """
+    if bucket_batch_sizes is None:
+        bucket_batch_sizes = [batch_size] * (len(bucket_boundaries) + 1)
+    if len(bucket_batch_sizes) != len(bucket_boundaries) + 1:
+        raise ValueError("bucket_batch_sizes should have {} elements, got {}".format(
+            len(bucket_boundaries) + 1, len(bucket_batch_sizes)))
+
+    dataset = trim_padding(dataset, sequence_groups)
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda *element: get_token_length(element[sequence_groups[0][0]]),
+        bucket_boundaries=list(bucket_boundaries),
+        bucket_batch_sizes=list(bucket_batch_sizes),
+        drop_remainder=drop_remainder))
+
+
+def batch_by_length(dataset, batch_size: int, sequence_groups=((0,),), drop_remainder=False):
+    """
+    不改变样本顺序, 每个 batch 补齐到 batch 内的最大长度;
+    预测前先用 sort_by_length 按长度排序, 使相邻样本长度相近, 再用 unsort 恢复预测结果的顺序
+    :param dataset:
+    :param batch_size:
+    :param sequence_groups: 见 trim_padding
+    :param drop_remainder:
+    :return:
+    """
+    dataset = trim_padding(dataset, sequence_groups)
+    padded_shapes = tf.compat.v1.data.get_output_shapes(dataset)
+    return dataset.padded_batch(batch_size, padded_shapes=padded_shapes, drop_remainder=drop_remainder)
+
+
+def sort_by_length(x_data: np.ndarray, *arrays):
+    """
+    按 x_data 的实际长度升序排序
+    :param x_data: (N, L)
+    :param arrays: 需要同样排序的其他数组, 如标签
+    :return: order, 排序后的 x_data, 排序后的 arrays...
+    """
+    order = np.argsort(get_token_lengths(x_data), kind='stable')
+    return (order, x_data[order]) + tuple(np.asarray(array)[order] for array in arrays)
+
+
+def unsort(sorted_data: np.ndarray, order: np.ndarray):
+    """
+    sort_by_length 的逆操作
+    :param sorted_data: 按 order 排序后的数据 (如预测结果)
+    :param order: sort_by_length 返回的 order
+    :return:
+    """
+    data = np.empty_like(sorted_data)
+    data[order] = sorted_data
+    return data
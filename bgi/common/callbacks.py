@@ -1,7 +1,20 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
 import tensorflow.keras.backend as K
 import numpy as np
 from tensorflow.keras.callbacks import Callback, ModelCheckpoint
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 
 class HistoryCache:
 
@@ -264,4 +277,389 @@ class SingleModelCK(ModelCheckpoint):
         self.model = model
 
     def set_model(self, model):
-        pass
\ No newline at end of file
+        pass
+
+
+def get_peak_rss_mb():
+    """
+    当前进程的峰值常驻内存 (MB), 不支持的平台返回 None
+    :return:
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 下单位为 KB, macOS 下为字节
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def benchmark_dataset(dataset, steps=50, warmup=5):
+    """
+    只读取 dataset 而不训练, 测量输入管道产生一个 batch 的平均时间, 与 ThroughputLogger 的 step_time 比较:
+    接近或大于 step_time 时瓶颈在输入管道, 远小于 step_time 时瓶颈在模型
+    :param dataset: 与 fit 相同的 tf.data.Dataset (会新建一个迭代器, 不影响训练)
+    :param steps: 计时的 batch 数
+    :param warmup: 预热的 batch 数, 不计时 (填满 shuffle / prefetch 的缓冲区)
+    :return: 每个 batch 的秒数, dataset 提前结束时按实际读取的 batch 数计算
+    """
+    if tf.executing_eagerly():
+        iterator = iter(dataset)
+
+        def next_batch():
+            return next(iterator)
+    else:
+        # bert4keras.backend 默认关闭了 eager, 需要在 session 中读取
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        next_element = iterator.get_next()
+        session = tf.compat.v1.keras.backend.get_session()
+        session.run(iterator.initializer)
+
+        def next_batch():
+            return session.run(next_element)
+
+    count = 0
+    start = time.perf_counter()
+    try:
+        for ii in range(warmup + steps):
+            if ii == warmup:
+                start = time.perf_counter()
+            next_batch()
+            if ii >= warmup:
+                count += 1
+    except (StopIteration, tf.errors.OutOfRangeError):
+        pass
+    if count == 0:
+        return None
+    return (time.perf_counter() - start) / count
+
+
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """
+    记录每个训练 step 的耗时和吞吐量, 写入 CSV (log_path 以 .csv 结尾) 或 JSON lines 文件:
+        step_time    on_train_batch_begin 到 on_train_batch_end 的时间, 即 train function 的耗时
+        wait_time    上一个 step 结束到这个 step 开始的时间, 即 step 之外的主机端开销 (回调, Python 循环等)
+        input_step_time  输入管道产生一个 batch 的秒数 (benchmark_dataset 的结果, 可选)
+        examples_per_sec, tokens_per_sec, peak_rss_mb
+    每个 epoch 结束时打印汇总; 给出 input_step_time (benchmark_dataset 的结果) 时一并比较输入管道与训练的耗时
+    """
+
+    FIELDS = ['epoch', 'step', 'step_time', 'wait_time', 'input_step_time', 'examples_per_sec', 'tokens_per_sec',
+              'peak_rss_mb', 'loss']
+
+    def __init__(self, log_path, batch_size, tokens_per_example=None, log_every=1, input_step_time=None):
+        """
+        :param log_path:
+        :param batch_size: 全局 batch size
+        :param tokens_per_example: 每个样本的 token 数, None 时不记录 tokens_per_sec
+        :param log_every: 每 log_every 个 step 写一行, 汇总仍统计所有 step
+        :param input_step_time: 输入管道产生一个 batch 的秒数
+        """
+        super().__init__()
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.tokens_per_example = tokens_per_example
+        self.log_every = max(1, int(log_every))
+        self.input_step_time = input_step_time
+
+        self.step = 0
+        self.epoch = 0
+        self.log_file = None
+        self.writer = None
+        self.batch_begin_time = None
+        self.batch_end_time = None
+        self.step_times = []
+        self.wait_times = []
+
+    def on_train_begin(self, logs=None):
+        self.log_file = open(self.log_path, mode='w', newline='')
+        if str(self.log_path).endswith('.csv'):
+            self.writer = csv.DictWriter(self.log_file, fieldnames=self.FIELDS)
+            self.writer.writeheader()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.step_times = []
+        self.wait_times = []
+        self.batch_end_time = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin_time = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        logs = logs or {}
+        step_time = now - self.batch_begin_time
+        wait_time = 0.0 if self.batch_end_time is None else self.batch_begin_time - self.batch_end_time
+        self.batch_end_time = now
+        self.step += 1
+        self.step_times.append(step_time)
+        self.wait_times.append(wait_time)
+
+        if self.step % self.log_every == 0:
+            record = {
+                'epoch': self.epoch,
+                'step': self.step,
+                'step_time': step_time,
+                'wait_time': wait_time,
+                'input_step_time': self.input_step_time,
+                'examples_per_sec': self.batch_size / step_time,
+                'tokens_per_sec': None,
+                'peak_rss_mb': get_peak_rss_mb(),
+                'loss': None if logs.get('loss') is None else float(logs['loss']),
+            }
+            if self.tokens_per_example is not None:
+                record['tokens_per_sec'] = self.batch_size * self.tokens_per_example / step_time
+            self._write_record(record)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if len(self.step_times) == 0:
+            return
+        # 第一个 step 包含图的构建和输入管道的预热, 不计入汇总
+        step_times = self.step_times[1:] or self.step_times
+        wait_times = self.wait_times[1:] or self.wait_times
+        mean_step_time = float(np.mean(step_times))
+        mean_wait_time = float(np.mean(wait_times))
+        summary = "Epoch {}: {:.4f} s/step, {:.1f} examples/sec".format(
+            epoch + 1, mean_step_time, self.batch_size / mean_step_time)
+        if self.tokens_per_example is not None:
+            summary += ", {:.1f} tokens/sec".format(self.batch_size * self.tokens_per_example / mean_step_time)
+        summary += ", wait {:.1%} of the time".format(mean_wait_time / (mean_step_time + mean_wait_time))
+        if self.input_step_time is not None:
+            summary += ", input pipeline {:.4f} s/batch ({})".format(
+                self.input_step_time,
+                'input bound' if self.input_step_time >= 0.9 * mean_step_time else 'compute bound')
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None:
+            summary += ", peak RSS {:.0f} MB".format(peak_rss_mb)
+        print(summary)
+        self.log_file.flush()
+
+    def on_train_end(self, logs=None):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def _write_record(self, record):
+        if self.writer is not None:
+            self.writer.writerow({key: record.get(key) for key in self.FIELDS})
+        else:
+            self.log_file.write(json.dumps(record) + '\n')
+
+
+class ProfilerWindow(tf.keras.callbacks.Callback):
+    """
+    在 [start_step, end_step) 的 step 范围内记录 tf.profiler 的 trace, 用 TensorBoard 的 Profile 页面查看;
+    需要 tensorflow >= 2.2 (tf.profiler.experimental), 否则只打印提示
+    """
+
+    def __init__(self, log_dir, start_step, end_step):
+        """
+        :param log_dir:
+        :param start_step: 从 0 开始计数, 跨 epoch 累计
+        :param end_step:
+        """
+        super().__init__()
+        if end_step <= start_step:
+            raise ValueError("end_step ({}) must be greater than start_step ({})".format(end_step, start_step))
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.end_step = end_step
+        self.step = 0
+        self.active = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.step != self.start_step:
+            return
+        profiler = getattr(tf.profiler, 'experimental', None)
+        if profiler is None or not hasattr(profiler, 'start'):
+            print("tf.profiler.experimental is not available (tensorflow >= 2.2), skip profiling")
+            return
+        profiler.start(self.log_dir)
+        self.active = True
+        print("Profiling steps [{}, {}) to {}".format(self.start_step, self.end_step, self.log_dir))
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.active and self.step >= self.end_step:
+            self._stop()
+
+    def on_train_end(self, logs=None):
+        if self.active:
+            self._stop()
+
+    def _stop(self):
+        tf.profiler.experimental.stop()
+        self.active = False
+
+
+def get_profiling_callbacks(dataset, batch_size, tokens_per_example=None, profile_log=None, benchmark_input_steps=0,
+                            trace_steps=None, trace_dir=None):
+    """
+    根据训练脚本的 --profile-log / --benchmark-input-steps / --trace-steps 参数构建 ThroughputLogger 和 ProfilerWindow
+    :param dataset: 训练用的 dataset, benchmark_input_steps > 0 时先单独测量输入管道
+    :param batch_size: 全局 batch size
+    :param tokens_per_example:
+    :param profile_log: None 时不记录吞吐量
+    :param benchmark_input_steps:
+    :param trace_steps: 'START,END', None 时不记录 trace
+    :param trace_dir:
+    :return: callbacks 列表, 可能为空
+    """
+    callbacks = []
+    if profile_log is not None:
+        input_step_time = None
+        if benchmark_input_steps > 0:
+            input_step_time = benchmark_dataset(dataset, steps=benchmark_input_steps)
+            print("Input pipeline: ", input_step_time, " s/batch")
+        callbacks.append(ThroughputLogger(profile_log,
+                                          batch_size,
+                                          tokens_per_example=tokens_per_example,
+                                          input_step_time=input_step_time))
+    if trace_steps is not None:
+        start_step, end_step = [int(step) for step in str(trace_steps).split(',')]
+        callbacks.append(ProfilerWindow(trace_dir, start_step, end_step))
+    return callbacks
+
+
+class _MissingMetrics(dict):
+    """
+    格式化文件名时, 不存在的指标 (如按 step 保存时的 val_loss) 用 nan 代替
+    """
+
+    def __missing__(self, key):
+        return float('nan')
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """
+    异步、轮转的 checkpoint:
+    在主线程中把权重复制到内存, 由后台线程写入 HDF5 (与 model.save_weights 的格式相同, 可以 load_weights(by_name=True)),
+    训练只等待权重的复制; 只保留最近的 keep_last 个和 monitor 最好的 keep_best 个 checkpoint, 其余的删除
+    """
+
+    def __init__(self, filepath, monitor='loss', mode='auto', keep_last=None, keep_best=1, save_steps=None,
+                 save_epochs=True, model=None, verbose=0):
+        """
+        :param filepath: 同 ModelCheckpoint, 可以包含 {epoch}, {step} 和 logs 中的指标, 如 weights_{epoch:02d}-{loss:.4f}.hdf5
+        :param monitor: 用于选出最好的 checkpoint 的指标
+        :param mode: 'min', 'max' 或 'auto' (acc/auc 类指标为 'max', 其他为 'min')
+        :param keep_last: 保留最近的 checkpoint 个数, None 时全部保留
+        :param keep_best: 保留 monitor 最好的 checkpoint 个数
+        :param save_steps: 每 save_steps 个 step 保存一次, None 时只在 epoch 结束时保存
+        :param save_epochs: 是否在每个 epoch 结束时保存
+        :param model: 要保存的模型, 默认为训练的模型; 多 GPU 时可以传入单 GPU 的模板模型, 同 SingleModelCK
+        :param verbose:
+        """
+        super().__init__()
+        if mode == 'auto':
+            mode = 'max' if ('acc' in monitor or 'auc' in monitor or monitor.startswith('fmeasure')) else 'min'
+        if mode not in ('min', 'max'):
+            raise ValueError("Unknown mode '{}', expected 'min', 'max' or 'auto'".format(mode))
+        self.filepath = filepath
+        self.monitor = monitor
+        self.mode = mode
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.save_steps = save_steps
+        self.save_epochs = save_epochs
+        self.save_model = model
+        self.verbose = verbose
+
+        self.step = 0
+        self.epoch = 0
+        # 已写入的 checkpoint: (path, monitor 的值), 按保存的先后顺序
+        self.checkpoints = []
+        self._executor = None
+        self._pending = None
+
+    def set_model(self, model):
+        super().set_model(model)
+        if self.save_model is None:
+            self.save_model = model
+
+    def on_train_begin(self, logs=None):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.save_steps is not None and self.step % self.save_steps == 0:
+            self._save(logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.save_epochs:
+            self._save(logs)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def wait(self):
+        """
+        等待正在写入的 checkpoint, 后台线程中的异常在这里抛出
+        :return:
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _save(self, logs):
+        logs = logs or {}
+        metrics = _MissingMetrics({key: float(value) for key, value in logs.items() if np.ndim(value) == 0})
+        filepath = self.filepath.format_map(_MissingMetrics(metrics, epoch=self.epoch + 1, step=self.step))
+        value = metrics.get(self.monitor)
+
+        # 同一时间最多有一个快照在写入, 内存中最多两份权重
+        self.wait()
+        layers = [layer for layer in self.save_model.layers if len(layer.weights) > 0]
+        weights = [layer.trainable_weights + layer.non_trainable_weights for layer in layers]
+        values = K.batch_get_value([w for layer_weights in weights for w in layer_weights])
+        snapshot = []
+        for layer, layer_weights in zip(layers, weights):
+            snapshot.append((layer.name, [w.name for w in layer_weights], values[:len(layer_weights)]))
+            values = values[len(layer_weights):]
+
+        self._pending = self._executor.submit(self._write, filepath, snapshot, value)
+
+    def _write(self, filepath, snapshot, value):
+        import h5py
+
+        dirname = os.path.dirname(filepath)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with h5py.File(filepath + '.tmp', mode='w') as f:
+            f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in snapshot]
+            f.attrs['backend'] = K.backend().encode('utf8')
+            f.attrs['keras_version'] = str(tf.keras.__version__).encode('utf8')
+            for layer_name, weight_names, weight_values in snapshot:
+                group = f.create_group(layer_name)
+                group.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+                for name, weight_value in zip(weight_names, weight_values):
+                    group.create_dataset(name, data=weight_value)
+        os.replace(filepath + '.tmp', filepath)
+        if self.verbose > 0:
+            print("\nSaved checkpoint {} ({}: {})".format(filepath, self.monitor, value))
+
+        self.checkpoints = [(path, v) for path, v in self.checkpoints if path != filepath]
+        self.checkpoints.append((filepath, value))
+        self._rotate()
+
+    def _rotate(self):
+        if self.keep_last is None:
+            return
+        keep = set(path for path, _ in self.checkpoints[-self.keep_last:]) if self.keep_last > 0 else set()
+        scored = [(path, value) for path, value in self.checkpoints if value is not None and not np.isnan(value)]
+        scored.sort(key=lambda item: item[1], reverse=(self.mode == 'max'))
+        keep.update(path for path, _ in scored[:self.keep_best])
+
+        for path, _ in self.checkpoints:
+            if path not in keep and os.path.exists(path):
+                os.remove(path)
+                if self.verbose > 0:
+                    print("Removed checkpoint {}".format(path))
+        self.checkpoints = [(path, value) for path, value in self.checkpoints if path in keep]
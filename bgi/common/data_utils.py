@@ -7,6 +7,8 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 
+from bgi.common.kmer_utils import get_ngram_frame
+
 
 def generate_batch_samples(train_data,
                            first_token_id: int,
@@ -109,12 +111,8 @@ def load_npz_data_for_classification(file_name, ngram=3, only_one_slice=True, ng
         if ngram_index is not None and ii != ngram_index:
             continue
         if only_one_slice is True:
-            kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-            x_data_slice = x_data[:, slice_indexes]
+            # 第 ii 个读码框, x_data 的视图
+            x_data_slice = get_ngram_frame(x_data, ii, ngram)
             x_data_all.append(x_data_slice)
             y_data_all.append(y_data)
         else:
@@ -149,14 +147,8 @@ def load_npz_data_for_pretrain(file_name, ngram=3, only_one_slice=True, ngram_in
         if ngram_index is not None and ii != ngram_index:
             continue
         if only_one_slice is True:
-            kk = ii
-            slice_indexes = []
-            max_slice_seq_len = x_data.shape[1] // ngram * ngram
-
-            for gg in range(kk, max_slice_seq_len, ngram):
-                slice_indexes.append(gg)
-
-            x_data_slice = x_data[:, slice_indexes]
+            # 第 ii 个读码框, x_data 的视图
+            x_data_slice = get_ngram_frame(x_data, ii, ngram)
             x_data_all.append(x_data_slice)
         else:
             x_data_all.append(x_data)
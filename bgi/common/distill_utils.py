@@ -0,0 +1,163 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Embedding, Conv1D, MaxPooling1D, GlobalMaxPooling1D, Dropout, Dense, \
+    Lambda, Subtract
+
+TEACHER_NPZ_KEYS = ('x_ref', 'x_alt', 'p_ref', 'p_alt')
+
+
+def probability_to_logit(p, eps: float = 1e-7):
+    """
+    sigmoid 概率转为 logit, 预测器输出的概率先截断到 [eps, 1 - eps]
+    :param p: numpy 数组
+    :param eps:
+    :return: float32 数组
+    """
+    p = np.clip(np.asarray(p, dtype=np.float64), eps, 1.0 - eps)
+    return np.log(p / (1.0 - p)).astype(np.float32)
+
+
+def save_teacher_npz(filepath, x_ref: np.ndarray, x_alt: np.ndarray, p_ref: np.ndarray, p_alt: np.ndarray):
+    """
+    保存预测器的输入 token 和 ref/alt 的 sigmoid 输出, 作为蒸馏的 teacher 目标
+    :param filepath: .npz 文件
+    :param x_ref: (N, L) ref 序列的 token, 未切分 ngram 帧, 正链在前、反向互补链在后
+    :param x_alt: (N, L) alt 序列的 token, 行与 x_ref 一一对应
+    :param p_ref: (N, num_classes) 各 ngram 帧平均后的预测概率
+    :param p_alt: (N, num_classes)
+    :return:
+    """
+    if not (len(x_ref) == len(x_alt) == len(p_ref) == len(p_alt)):
+        raise ValueError("x_ref, x_alt, p_ref and p_alt should have the same number of rows, got {}".format(
+            (len(x_ref), len(x_alt), len(p_ref), len(p_alt))))
+    np.savez_compressed(filepath,
+                        x_ref=np.asarray(x_ref, dtype=np.int32),
+                        x_alt=np.asarray(x_alt, dtype=np.int32),
+                        p_ref=np.asarray(p_ref, dtype=np.float32),
+                        p_alt=np.asarray(p_alt, dtype=np.float32))
+
+
+def load_teacher_npz(filepaths):
+    """
+    读取并拼接 save_teacher_npz 保存的文件
+    :param filepaths: 文件路径或路径列表
+    :return: dict, 键为 TEACHER_NPZ_KEYS
+    """
+    if not isinstance(filepaths, (list, tuple)):
+        filepaths = [filepaths]
+    if len(filepaths) == 0:
+        raise ValueError("No teacher npz file")
+
+    data = {key: [] for key in TEACHER_NPZ_KEYS}
+    for filepath in filepaths:
+        loaded = np.load(filepath)
+        for key in TEACHER_NPZ_KEYS:
+            data[key].append(loaded[key])
+    return {key: np.concatenate(value) for key, value in data.items()}
+
+
+def soft_binary_crossentropy(temperature: float = 1.0):
+    """
+    蒸馏的软标签损失, y_true 和 y_pred 都是 logit (多标签, 每个类别独立的 sigmoid):
+    目标为 sigmoid(y_true / T), 学生为 y_pred / T, 乘以 T^2 使梯度的量级不随温度变化
+    :param temperature:
+    :return: keras 损失函数
+    """
+
+    def loss(y_true, y_pred):
+        y_pred = tf.cast(y_pred, tf.float32)
+        y_true = tf.cast(y_true, tf.float32)
+        targets = tf.sigmoid(y_true / temperature)
+        cross_entropy = tf.nn.sigmoid_cross_entropy_with_logits(labels=targets, logits=y_pred / temperature)
+        return tf.reduce_mean(cross_entropy, axis=-1) * (temperature ** 2)
+
+    loss.__name__ = 'soft_binary_crossentropy'
+    return loss
+
+
+def distillation_loss(num_classes: int, temperature: float = 1.0, hard_weight: float = 0.0):
+    """
+    teacher 与学生在同一个计算图中时的损失: y_pred 为 [学生 logit, teacher logit] 在最后一维的拼接,
+    y_true 为 DeepSEA 的 0/1 标签, hard_weight > 0 时加上学生对标签的交叉熵
+    :param num_classes:
+    :param temperature:
+    :param hard_weight:
+    :return: keras 损失函数
+    """
+    soft_loss = soft_binary_crossentropy(temperature)
+
+    def loss(y_true, y_pred):
+        y_pred = tf.cast(y_pred, tf.float32)
+        student_logits = y_pred[..., :num_classes]
+        teacher_logits = tf.stop_gradient(y_pred[..., num_classes:])
+        total = soft_loss(teacher_logits, student_logits)
+        if hard_weight > 0:
+            labels = tf.cast(y_true, tf.float32)
+            hard = tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=student_logits)
+            total = total + hard_weight * tf.reduce_mean(hard, axis=-1)
+        return total
+
+    loss.__name__ = 'distillation_loss'
+    return loss
+
+
+def build_cnn_student(vocab_size: int,
+                      num_classes: int,
+                      embedding_size: int = 64,
+                      filters: int = 128,
+                      kernel_size: int = 8,
+                      num_layers: int = 3,
+                      pool_size: int = 4,
+                      dropout_rate: float = 0.1,
+                      output_logits: bool = False):
+    """
+    纯 CNN 的学生模型, 输入与 bert4keras 的模型一致 ('Input-Token', 'Input-Segment'), 输出层同样命名为 'CLS-Activation',
+    因此预测器可以用 load_weights(by_name=True) 直接加载; Input-Segment 不参与计算, 只为兼容现有的数据管道
+    :param vocab_size:
+    :param num_classes:
+    :param embedding_size:
+    :param filters:
+    :param kernel_size:
+    :param num_layers: 卷积块的个数, 除最后一块外每块之后接 MaxPooling1D
+    :param pool_size:
+    :param dropout_rate:
+    :param output_logits: True 时输出 logit (训练蒸馏), False 时输出 sigmoid 概率 (预测); 两者的权重相同
+    :return: tf.keras.models.Model
+    """
+    x_in = Input(shape=(None,), name='Input-Token')
+    s_in = Input(shape=(None,), name='Input-Segment')
+
+    x = Embedding(input_dim=vocab_size, output_dim=embedding_size, name='Embedding-Token')(x_in)
+    for ii in range(num_layers):
+        x = Conv1D(filters, kernel_size, padding='same', activation='relu', name='CNN-Conv1D-{}'.format(ii))(x)
+        if ii < num_layers - 1:
+            x = MaxPooling1D(pool_size, padding='same', name='CNN-MaxPooling-{}'.format(ii))(x)
+    x = GlobalMaxPooling1D(name='CNN-GlobalMaxPooling')(x)
+    if dropout_rate > 0:
+        x = Dropout(dropout_rate, name='CNN-Dropout')(x)
+    output = Dense(
+        name='CLS-Activation',
+        units=num_classes,
+        activation=None if output_logits else 'sigmoid',
+        dtype='float32'
+    )(x)
+    return tf.keras.models.Model([x_in, s_in], output)
+
+
+def build_pair_student(student):
+    """
+    用同一个学生模型分别计算 ref 和 alt 序列, 输出 'Ref-Logits', 'Alt-Logits' 和 'Logit-Diff' (alt - ref),
+    与预测器输出的 ref/alt 分数和 logfoldchange 对应
+    :param student: 输入为 [token, segment], 输出 logit 的模型
+    :return: 输入为 ['Input-Ref-Token', 'Input-Alt-Token'] 的 tf.keras.models.Model
+    """
+    ref_in = Input(shape=(None,), name='Input-Ref-Token')
+    alt_in = Input(shape=(None,), name='Input-Alt-Token')
+    segment = Lambda(lambda x: tf.zeros_like(x), name='Input-Zero-Segment')(ref_in)
+
+    ref_logits = student([ref_in, segment])
+    alt_logits = student([alt_in, segment])
+    diff = Subtract(name='Logit-Diff')([alt_logits, ref_logits])
+    ref_logits = Lambda(lambda x: x, name='Ref-Logits')(ref_logits)
+    alt_logits = Lambda(lambda x: x, name='Alt-Logits')(alt_logits)
+    return tf.keras.models.Model([ref_in, alt_in], [ref_logits, alt_logits, diff])
@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+
+from bgi.common.sequence_utils import base_code_table
+
+# 与 samtools faidx 的 .fai 一致: name, length, offset, line_bases, line_width
+FASTA_INDEX_COLUMNS = ('name', 'length', 'offset', 'line_bases', 'line_width')
+
+
+def strided_windows(codes: np.ndarray, seq_size: int, seq_stride: int):
+    """
+    codes 中所有完整窗口的只读视图, 第 ii 个窗口从 ii * seq_stride 开始
+    :param codes: (L,)
+    :param seq_size:
+    :param seq_stride:
+    :return: (N, seq_size)
+    """
+    if len(codes) < seq_size:
+        return codes[:0].reshape((0, seq_size))
+
+    # numpy 1.19 中没有 sliding_window_view
+    num_windows = (len(codes) - seq_size) // seq_stride + 1
+    return np.lib.stride_tricks.as_strided(codes, shape=(num_windows, seq_size),
+                                           strides=(codes.strides[0] * seq_stride, codes.strides[0]),
+                                           writeable=False)
+
+
+def _get_buffer_windows(buffer: np.ndarray, fill: int, buffer_start: int, next_start: int, seq_size: int,
+                        seq_stride: int):
+    """
+    缓冲区中所有完整窗口的零拷贝视图
+    :param buffer:
+    :param fill: 缓冲区中已填充的长度
+    :param buffer_start: buffer[0] 在染色体中的位置
+    :param next_start: 下一个窗口在染色体中的起始位置
+    :param seq_size:
+    :param seq_stride:
+    :return: starts (N,) 窗口在染色体中的起始位置; windows (N, seq_size) buffer 的视图; 更新后的 next_start
+    """
+    first = next_start - buffer_start
+    if first < 0 or first + seq_size > fill:
+        return np.zeros(0, dtype=np.int64), buffer[:0].reshape((0, seq_size)), next_start
+
+    windows = strided_windows(buffer[first:fill], seq_size, seq_stride)
+    starts = next_start + np.arange(len(windows), dtype=np.int64) * seq_stride
+    return starts, windows, next_start + len(windows) * seq_stride
+
+
+def iter_fasta_windows(fname,
+                       seq_size: int = 1000,
+                       seq_stride: int = 500,
+                       buffer_size: int = 10000,
+                       filter_txt: str = None,
+                       skip_n: bool = False,
+                       skip_invalid: bool = False):
+    """
+    流式读取 FASTA, 按染色体切分出重叠的窗口, 替代 chunks += line / chunks = chunks[ii:] + line 的字符串拼接.
+    每条染色体使用同一个预分配的 uint8 缓冲区, 填满后一次输出其中所有完整的窗口, 再将未用完的尾部
+    (不超过 seq_size) 移到缓冲区开头, 因此总耗时与基因组长度成线性关系.
+
+    窗口是缓冲区的只读视图 (as_strided), 下一次迭代时会被覆盖, 需要保留时请先 copy
+    :param fname:
+    :param seq_size: 窗口长度
+    :param seq_stride: 相邻窗口起始位置的间隔
+    :param buffer_size: 缓冲区长度, 至少为 seq_size + seq_stride; 越大则每批的窗口越多
+    :param filter_txt: 以此开头的行被跳过; 以 '>' 开头的行总是作为新染色体的开始, 不会进入序列
+    :param skip_n: 跳过含 'N' 的行 (与原 process_fasta_raw_text 一致)
+    :param skip_invalid: 跳过含非 'ATCG' 字符的行 (与原 is_atcg_sequence 的行过滤一致)
+    :return: 逐批生成 (chrom, starts, windows): chrom 为 '>' 之后的名称;
+             starts (N,) int64 为窗口在 (过滤后的) 染色体序列中的起始位置; windows (N, seq_size) uint8 编码
+    """
+    buffer_size = max(buffer_size, seq_size + seq_stride)
+    buffer = np.empty(buffer_size, dtype=np.uint8)
+    filter_bytes = filter_txt.encode('ascii') if filter_txt is not None else None
+
+    chrom = None
+    fill = 0
+    buffer_start = 0
+    next_start = 0
+
+    with open(fname, mode='rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+
+            if line.startswith(b'>'):
+                # 新的染色体: 输出剩余的窗口后重置缓冲区, 窗口不跨越染色体
+                if fill > 0:
+                    starts, windows, next_start = _get_buffer_windows(buffer, fill, buffer_start, next_start,
+                                                                      seq_size, seq_stride)
+                    if len(windows) > 0:
+                        yield chrom, starts, windows
+                chrom = line[1:].split()[0].decode('ascii') if len(line) > 1 else ''
+                fill, buffer_start, next_start = 0, 0, 0
+                continue
+
+            if filter_bytes is not None and line.startswith(filter_bytes):
+                continue
+
+            codes = base_code_table[np.frombuffer(line, dtype=np.uint8)]
+            if skip_n is True and np.any(codes == 0):
+                continue
+            if skip_invalid is True and not np.all((codes >= 1) & (codes <= 4)):
+                continue
+
+            while len(codes) > 0:
+                if fill == 0 and buffer_start < next_start:
+                    # seq_stride > seq_size 时, 丢弃两个窗口之间的碱基
+                    skip = min(next_start - buffer_start, len(codes))
+                    codes = codes[skip:]
+                    buffer_start += skip
+                    continue
+
+                size = min(buffer_size - fill, len(codes))
+                buffer[fill:fill + size] = codes[:size]
+                codes = codes[size:]
+                fill += size
+
+                if fill == buffer_size:
+                    starts, windows, next_start = _get_buffer_windows(buffer, fill, buffer_start, next_start,
+                                                                      seq_size, seq_stride)
+                    if len(windows) > 0:
+                        yield chrom, starts, windows
+
+                    # 将下一个窗口起始位置之后的部分移到缓冲区开头
+                    keep_from = min(next_start - buffer_start, fill)
+                    buffer[:fill - keep_from] = buffer[keep_from:fill].copy()
+                    fill -= keep_from
+                    buffer_start += keep_from
+
+        if fill > 0:
+            starts, windows, next_start = _get_buffer_windows(buffer, fill, buffer_start, next_start,
+                                                              seq_size, seq_stride)
+            if len(windows) > 0:
+                yield chrom, starts, windows
+
+
+def build_fasta_index(fname, index_path: str = None):
+    """
+    扫描一遍 FASTA, 生成与 samtools faidx 相同格式的 .fai 索引, 每条染色体除最后一行外的行长必须相同
+    :param fname:
+    :param index_path: 默认为 fname + '.fai'
+    :return: [{'name', 'length', 'offset', 'line_bases', 'line_width'}, ...]
+    """
+    if index_path is None:
+        index_path = fname + '.fai'
+
+    records = []
+    record = None
+    last_line = False
+    offset = 0
+    with open(fname, mode='rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                record = {'name': line[1:].split()[0].decode('ascii'), 'length': 0, 'offset': offset + len(line),
+                          'line_bases': 0, 'line_width': 0}
+                records.append(record)
+                last_line = False
+            elif record is not None:
+                line_bases = len(line.rstrip(b'\r\n'))
+                if record['line_bases'] == 0:
+                    record['line_bases'] = line_bases
+                    record['line_width'] = len(line)
+                elif last_line or line_bases > record['line_bases']:
+                    raise ValueError("Different line length in '{}' of {}".format(record['name'], fname))
+                # 比其他行短的只能是最后一行
+                last_line = line_bases < record['line_bases']
+                record['length'] += line_bases
+            offset += len(line)
+
+    with open(index_path, mode='w') as f:
+        for record in records:
+            f.write('\t'.join([str(record[column]) for column in FASTA_INDEX_COLUMNS]) + '\n')
+    return records
+
+
+def load_fasta_index(fname, index_path: str = None):
+    """
+    读取 .fai 索引, 不存在或比 FASTA 旧时重新生成
+    :param fname:
+    :param index_path:
+    :return:
+    """
+    if index_path is None:
+        index_path = fname + '.fai'
+
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(fname):
+        return build_fasta_index(fname, index_path)
+
+    records = []
+    with open(index_path, mode='r') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            record = {'name': values[0]}
+            for column, value in zip(FASTA_INDEX_COLUMNS[1:], values[1:]):
+                record[column] = int(value)
+            records.append(record)
+    return records
+
+
+def read_fasta_region(f, record: dict, start: int, end: int):
+    """
+    按索引读取一条染色体 [start, end) 区间的编码, 不需要读取之前的序列
+    :param f: 以 'rb' 打开的 FASTA 文件
+    :param record: load_fasta_index 中的一条
+    :param start:
+    :param end:
+    :return: (end - start,) uint8
+    """
+    start = max(start, 0)
+    end = min(end, record['length'])
+    if start >= end:
+        return np.zeros(0, dtype=np.uint8)
+
+    line_bases, line_width = record['line_bases'], record['line_width']
+    begin = record['offset'] + start // line_bases * line_width + start % line_bases
+    stop = record['offset'] + (end - 1) // line_bases * line_width + (end - 1) % line_bases + 1
+
+    f.seek(begin)
+    raw = np.frombuffer(f.read(stop - begin), dtype=np.uint8)
+    raw = raw[(raw != ord('\n')) & (raw != ord('\r'))]
+    return base_code_table[raw]
@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 import pandas as pd
 
@@ -347,13 +351,17 @@ def multi_value_range_search(chr_gff: np.ndarray,
     return result
 
 
-def get_refseq_gff(gff_file: str, include_types: list):
+def get_refseq_gff(gff_file: str, include_types: list, use_index: bool = False, index_path: str = None):
     """
     读取Genebank注释文件
     :param gff_file:
     :param include_types:
+    :param use_index: 使用编译后的二进制索引（见 load_refseq_gff_index）
+    :param index_path:
     :return:
     """
+    if use_index is True:
+        return load_refseq_gff_index(gff_file, include_types, index_path=index_path)
 
     # include_types = ['direct_repeat',
     #                  'rRNA',
@@ -517,6 +525,214 @@ def get_refseq_gff(gff_file: str, include_types: list):
     return chr_gff_dict_3
 
 
+def get_file_sha1(file_name: str, block_size: int = 1 << 20):
+    """
+    计算文件的 SHA1
+    :param file_name:
+    :param block_size:
+    :return:
+    """
+    sha1 = hashlib.sha1()
+    with open(file_name, mode='rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_gff_type_names(include_types: list):
+    """
+    注释类型 -> uint8 编码，去除重复的类型并保持顺序
+    :param include_types:
+    :return:
+    """
+    type_names = []
+    for anno_type in include_types:
+        if anno_type not in type_names:
+            type_names.append(anno_type)
+    if len(type_names) > 256:
+        raise ValueError("At most 256 annotation types can be indexed, got {}".format(len(type_names)))
+    return type_names
+
+
+def get_refseq_gff_index_path(gff_file: str, include_types: list, index_path: str = None):
+    """
+    索引目录，不同的 include_types 使用不同的子目录
+    :param gff_file:
+    :param include_types:
+    :param index_path: 默认为 '<gff_file>.idx'
+    :return:
+    """
+    if index_path is None:
+        index_path = gff_file + '.idx'
+    types_key = hashlib.sha1('\n'.join(get_gff_type_names(include_types)).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(index_path, 'types_{}'.format(types_key))
+
+
+def compile_refseq_gff_index(gff_file: str, include_types: list, index_path: str = None, gff_sha1: str = None):
+    """
+    将 GFF 注释编译为按染色体存储的二进制索引：
+        <chr>.start.npy  int32, 按 (start, end) 排序
+        <chr>.end.npy    int32
+        <chr>.type.npy   uint8, 注释类型编码, 对应 meta.json 中的 'types'
+        meta.json        GFF 文件的 sha1/size/mtime, 类型字典, 各染色体的记录数
+    :param gff_file:
+    :param include_types:
+    :param index_path:
+    :param gff_sha1: 已计算过的 GFF sha1，避免重复计算
+    :return: 索引目录
+    """
+    index_path = get_refseq_gff_index_path(gff_file, include_types, index_path)
+    if os.path.exists(index_path) is False:
+        os.makedirs(index_path)
+
+    type_names = get_gff_type_names(include_types)
+    type_dict = {anno_type: code for code, anno_type in enumerate(type_names)}
+
+    chr_starts = {}
+    chr_ends = {}
+    chr_types = {}
+    with open(gff_file, mode='r', encoding='utf-8') as f:
+        for line in f:
+            # 过滤掉非 'NC_' 开头的数据
+            if line.startswith('NC_') is False:
+                continue
+            tokens = line.split('\t')
+            if len(tokens) < 5:
+                continue
+
+            code = type_dict.get(tokens[2], None)
+            if code is None:
+                continue
+
+            chr = tokens[0]
+            if chr not in chr_starts:
+                chr_starts[chr] = []
+                chr_ends[chr] = []
+                chr_types[chr] = []
+            chr_starts[chr].append(int(tokens[3]))
+            chr_ends[chr].append(int(tokens[4]))
+            chr_types[chr].append(code)
+
+    chroms = {}
+    for chr in chr_starts.keys():
+        starts = np.array(chr_starts[chr], dtype=np.int32)
+        ends = np.array(chr_ends[chr], dtype=np.int32)
+        types = np.array(chr_types[chr], dtype=np.uint8)
+
+        # 与 get_refseq_gff 一致，按 (start, end) 升序
+        order = np.lexsort((ends, starts))
+        np.save(os.path.join(index_path, '{}.start.npy'.format(chr)), starts[order])
+        np.save(os.path.join(index_path, '{}.end.npy'.format(chr)), ends[order])
+        np.save(os.path.join(index_path, '{}.type.npy'.format(chr)), types[order])
+        chroms[chr] = len(order)
+
+    stat = os.stat(gff_file)
+    meta = {
+        'gff_file': os.path.abspath(gff_file),
+        'gff_sha1': gff_sha1 if gff_sha1 is not None else get_file_sha1(gff_file),
+        'gff_size': stat.st_size,
+        'gff_mtime': stat.st_mtime,
+        'types': type_names,
+        'chroms': chroms,
+    }
+    # meta.json 最后写入，中断的编译不会被当作有效索引
+    meta_file = os.path.join(index_path, 'meta.json')
+    with open(meta_file + '.tmp', mode='w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+    return index_path
+
+
+def is_refseq_gff_index_valid(gff_file: str, index_path: str):
+    """
+    检查索引是否与 GFF 文件一致；size/mtime 未变化时不重新计算 sha1
+    :param gff_file:
+    :param index_path:
+    :return: (是否有效, 计算过的 sha1 或 None)
+    """
+    meta_file = os.path.join(index_path, 'meta.json')
+    if os.path.exists(meta_file) is False:
+        return False, None
+
+    with open(meta_file, mode='r', encoding='utf-8') as f:
+        meta = json.load(f)
+
+    stat = os.stat(gff_file)
+    if meta.get('gff_size') != stat.st_size:
+        return False, None
+    if meta.get('gff_mtime') == stat.st_mtime:
+        return True, None
+
+    # 文件被 touch 或重新拷贝过，按内容判断
+    gff_sha1 = get_file_sha1(gff_file)
+    if meta.get('gff_sha1') != gff_sha1:
+        return False, gff_sha1
+
+    meta['gff_mtime'] = stat.st_mtime
+    with open(meta_file + '.tmp', mode='w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+    return True, gff_sha1
+
+
+class GffTypeColumn(object):
+    """
+    GFF 索引的 type 列：保存内存映射的 uint8 编码，只在下标/切片取值时转换为注释类型名，
+    加载时不会读入整列
+    """
+
+    def __init__(self, codes: np.ndarray, type_names: np.ndarray):
+        """
+        :param codes: uint8 类型编码（内存映射）
+        :param type_names: 编码 -> 类型名的 object 数组
+        """
+        self.codes = codes
+        self.type_names = type_names
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        # 单个下标返回 str，切片返回对应区间的 object 数组，与 get_refseq_gff 的取值结果一致
+        return self.type_names[self.codes[index]]
+
+    def __array__(self, dtype=None, copy=None):
+        names = self.type_names[self.codes]
+        return names if dtype is None else names.astype(dtype)
+
+
+def load_refseq_gff_index(gff_file: str, include_types: list, index_path: str = None):
+    """
+    读取（必要时编译）GFF 二进制索引，start/end/type 以内存映射方式打开。
+    返回格式与 get_refseq_gff 相同: {chr: [starts, ends, anno_types]}，
+    其中 anno_types 为 GffTypeColumn，按下标或切片取值时才把编码转换为类型名
+    :param gff_file:
+    :param include_types:
+    :param index_path:
+    :return:
+    """
+    chr_index_path = get_refseq_gff_index_path(gff_file, include_types, index_path)
+    is_valid, gff_sha1 = is_refseq_gff_index_valid(gff_file, chr_index_path)
+    if is_valid is False:
+        print("Compile GFF index: ", chr_index_path)
+        compile_refseq_gff_index(gff_file, include_types, index_path=index_path, gff_sha1=gff_sha1)
+
+    with open(os.path.join(chr_index_path, 'meta.json'), mode='r', encoding='utf-8') as f:
+        meta = json.load(f)
+
+    # object 数组，按编码取值时只复制指针
+    type_names = np.empty(len(meta['types']), dtype=object)
+    type_names[:] = meta['types']
+
+    chr_gff_dict = {}
+    for chr in meta['chroms'].keys():
+        starts = np.load(os.path.join(chr_index_path, '{}.start.npy'.format(chr)), mmap_mode='r')
+        ends = np.load(os.path.join(chr_index_path, '{}.end.npy'.format(chr)), mmap_mode='r')
+        types = np.load(os.path.join(chr_index_path, '{}.type.npy'.format(chr)), mmap_mode='r')
+        chr_gff_dict[chr] = [starts, ends, GffTypeColumn(types, type_names)]
+    return chr_gff_dict
+
+
 def get_gff_array(chr_gff_dict: dict, chr: str, start: int, end: int, position: int, pool_size=8):
     anno_type_dict = {}
 
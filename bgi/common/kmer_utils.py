@@ -0,0 +1,532 @@
+from functools import lru_cache
+
+import numpy as np
+
+from bgi.common.sequence_utils import sequence_to_codes
+
+# 与 refseq_utils.get_word_dict_for_n_gram_alphabet / get_word_dict_for_n_gram_number 的字母表一致:
+# N=0, A=1, G=2, C=3, T=4
+KMER_ALPHABET = ['N', 'A', 'G', 'C', 'T']
+KMER_LAYOUTS = ('layer', 'full')
+
+# 互补碱基: N->N, A<->T, G<->C
+complement_code_table = np.array([0, 4, 3, 2, 1], dtype=np.int64)
+
+
+def get_kmer_base(word_index_from: int = 10, predefined_tokens: list = []):
+    """
+    第一个 k-mer ('N') 的 id, 与 get_word_dict_for_n_gram_* 中 word_index_from + len(word_dict) 的计算一致
+    :param word_index_from:
+    :param predefined_tokens:
+    :return:
+    """
+    num_predefined = len(predefined_tokens) if predefined_tokens is not None else 0
+    return max(word_index_from, num_predefined) + num_predefined
+
+
+def kmer_codes_to_id(codes, word_index_from: int = 10, predefined_tokens: list = [], number_keys: bool = False,
+                     layout: str = 'layer', n_gram: int = None):
+    """
+    k-mer 编码 -> id 的闭式计算, 支持长度小于 n_gram 的 k-mer
+
+    layout='layer' 对应 get_word_dict_for_n_gram_alphabet / _number:
+        长度为 1 的层: id = base + c1
+        长度为 L>=2 的层: 以 'N' 开头的 k-mer 不在字典中, 其余
+        id = base + 5^(L-1) + (c1 - 1) + 4 * sum_{l=2..L} c_l * 5^(l-2)
+    layout='full' 对应 deepsea_data_loader 中的 get_word_dict_5gram / 6gram:
+        按 n_gram 位五进制顺序编号, id = word_index_from + sum_l c_l * 5^(n_gram-l)
+
+    :param codes: 0~4 的编码序列
+    :param word_index_from:
+    :param predefined_tokens:
+    :param number_keys: True 时与 get_word_dict_for_n_gram_number 的十进制 key 一致,
+                        以 'N'(0) 开头的 k-mer 等价于去掉前导 0 的较短 k-mer
+    :param layout: 'layer' 或 'full'
+    :param n_gram: layout='full' 时必须指定
+    :return: id, 不在字典中的 k-mer 为 0
+    """
+    codes = [int(c) for c in codes]
+    if len(codes) == 0 or any(c < 0 or c > 4 for c in codes):
+        return 0
+
+    if layout == 'full':
+        if n_gram is None or len(codes) > n_gram:
+            return 0
+        value = 0
+        for c in codes:
+            value = value * 5 + c
+        return word_index_from + value
+
+    if layout != 'layer':
+        raise ValueError("Unknown k-mer layout '{}', expected one of {}".format(layout, KMER_LAYOUTS))
+
+    if number_keys is True:
+        while len(codes) > 1 and codes[0] == 0:
+            codes = codes[1:]
+    if n_gram is not None and len(codes) > n_gram:
+        return 0
+
+    base = get_kmer_base(word_index_from, predefined_tokens)
+    if len(codes) == 1:
+        return base + codes[0]
+    if codes[0] == 0:
+        return 0
+
+    index = codes[0] - 1
+    for ll in range(1, len(codes)):
+        index += 4 * codes[ll] * 5 ** (ll - 1)
+    return base + 5 ** (len(codes) - 1) + index
+
+
+def kmer_id_to_codes(word_id: int, word_index_from: int = 10, predefined_tokens: list = [], layout: str = 'layer',
+                     n_gram: int = None):
+    """
+    kmer_codes_to_id 的逆运算
+    :param word_id:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param layout:
+    :param n_gram: layout='full' 时必须指定
+    :return: 编码列表, 非 k-mer 的 id 返回 None
+    """
+    if layout == 'full':
+        value = int(word_id) - word_index_from
+        if n_gram is None or value < 0 or value >= 5 ** n_gram:
+            return None
+        codes = []
+        for _ in range(n_gram):
+            codes.append(value % 5)
+            value //= 5
+        return codes[::-1]
+
+    if layout != 'layer':
+        raise ValueError("Unknown k-mer layout '{}', expected one of {}".format(layout, KMER_LAYOUTS))
+
+    value = int(word_id) - get_kmer_base(word_index_from, predefined_tokens)
+    if value < 0:
+        return None
+    if value < 5:
+        return [value]
+
+    length = 2
+    while 5 ** length <= value:
+        length += 1
+    if n_gram is not None and length > n_gram:
+        return None
+
+    index = value - 5 ** (length - 1)
+    codes = [index % 4 + 1]
+    index //= 4
+    for _ in range(1, length):
+        codes.append(index % 5)
+        index //= 5
+    return codes
+
+
+def kmer_to_id(kmer: str, word_index_from: int = 10, predefined_tokens: list = [], layout: str = 'layer',
+               n_gram: int = None):
+    """
+    与 get_word_dict_for_n_gram_alphabet(...).get(kmer, 0) 等价
+    :param kmer:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param layout:
+    :param n_gram:
+    :return:
+    """
+    if len(kmer) == 0 or kmer.upper() != kmer:
+        return 0
+    return kmer_codes_to_id(sequence_to_codes(kmer), word_index_from=word_index_from,
+                            predefined_tokens=predefined_tokens, layout=layout, n_gram=n_gram)
+
+
+def id_to_kmer(word_id: int, word_index_from: int = 10, predefined_tokens: list = [], layout: str = 'layer',
+               n_gram: int = None):
+    """
+    id -> k-mer 字符串
+    :param word_id:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param layout:
+    :param n_gram:
+    :return: 非 k-mer 的 id 返回 None
+    """
+    codes = kmer_id_to_codes(word_id, word_index_from=word_index_from, predefined_tokens=predefined_tokens,
+                             layout=layout, n_gram=n_gram)
+    if codes is None:
+        return None
+    return ''.join([KMER_ALPHABET[c] for c in codes])
+
+
+def decimal_kmer_to_id(value, n_gram: int, word_index_from: int = 10, predefined_tokens: list = [],
+                       layout: str = 'layer'):
+    """
+    与 get_word_dict_for_n_gram_number(...).get(value, 0) 或 get_word_dict_6gram(...).get(value, 0) 等价,
+    value 为十进制拼接的 k-mer, 例如 12341
+    :param value:
+    :param n_gram:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param layout:
+    :return:
+    """
+    if value != int(value) or value < 0:
+        return 0
+    digits = str(int(value))
+    if len(digits) > n_gram or any(d > '4' for d in digits):
+        return 0
+    return kmer_codes_to_id([int(d) for d in digits], word_index_from=word_index_from,
+                            predefined_tokens=predefined_tokens, number_keys=True, layout=layout, n_gram=n_gram)
+
+
+def get_kmer_lookup_table(n_gram: int, word_index_from: int = 10, predefined_tokens: list = [],
+                          number_keys: bool = False, layout: str = 'layer'):
+    """
+    预先计算所有长度为 n_gram 的 k-mer 的 id
+    :param n_gram:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param number_keys:
+    :param layout:
+    :return: (5^n_gram,) int64, 下标为 k-mer 编码的五进制值 (首字符为最高位)
+    """
+    if layout not in KMER_LAYOUTS:
+        raise ValueError("Unknown k-mer layout '{}', expected one of {}".format(layout, KMER_LAYOUTS))
+
+    values = np.arange(5 ** n_gram, dtype=np.int64)
+    if layout == 'full':
+        return word_index_from + values
+
+    # 首位在前的各位编码, digits[:, 0] 为 c1
+    digits = (values[:, None] // (5 ** np.arange(n_gram - 1, -1, -1, dtype=np.int64))) % 5
+    lengths = np.full(len(values), n_gram, dtype=np.int64)
+    if number_keys is True:
+        # 去掉前导 0, 全为 0 时保留一位
+        leading_zeros = np.argmax(digits != 0, axis=1)
+        leading_zeros[np.all(digits == 0, axis=1)] = n_gram - 1
+        lengths = n_gram - leading_zeros
+
+    # 第 l 位 (从有效首位起) 的权重: 1, 4, 4*5, 4*5^2, ...
+    positions = np.arange(n_gram, dtype=np.int64)[None, :] - (n_gram - lengths)[:, None]
+    weights = np.where(positions == 0, 1, 4 * 5 ** np.maximum(positions - 1, 0))
+    weights[positions < 0] = 0
+    first = digits[np.arange(len(values)), n_gram - lengths]
+
+    index = (digits * weights).sum(axis=1) - 1
+    table = get_kmer_base(word_index_from, predefined_tokens) + 5 ** (lengths - 1) + index
+    table[lengths == 1] = get_kmer_base(word_index_from, predefined_tokens) + first[lengths == 1]
+    table[(lengths > 1) & (first == 0)] = 0
+    return table
+
+
+def get_kmer_lookup_table_from_dict(word_dict: dict, n_gram: int):
+    """
+    由已有的 word_dict (字符串 key 或十进制 key) 得到查找表, 供仍以 word_dict 为参数的函数使用
+    :param word_dict:
+    :param n_gram:
+    :return:
+    """
+    if word_dict is None:
+        return None
+
+    values = np.arange(5 ** n_gram, dtype=np.int64)
+    digits = (values[:, None] // (5 ** np.arange(n_gram - 1, -1, -1, dtype=np.int64))) % 5
+    if 'N' in word_dict:
+        alphabet = np.array(KMER_ALPHABET)
+        keys = [''.join(row) for row in alphabet[digits]]
+    else:
+        keys = (digits * (10 ** np.arange(n_gram - 1, -1, -1, dtype=np.int64))).sum(axis=1).tolist()
+    return np.array([word_dict.get(key, 0) for key in keys], dtype=np.int64)
+
+
+def get_ngram_frame(x: np.ndarray, frame: int, n_gram: int):
+    """
+    第 frame 个读码框, 即 x[..., frame:max_len:n_gram], max_len = L // n_gram * n_gram.
+    替代 slice_indexes 列表 + x[:, slice_indexes] 的复制: 返回的是 x 的跨步视图, 不复制数据,
+    同时保留 n_gram 个读码框时内存不会随 n_gram 成倍增加; 需要连续内存时再 np.ascontiguousarray
+    :param x: (..., L)
+    :param frame: 0 ~ n_gram - 1
+    :param n_gram:
+    :return: (..., len(range(frame, max_len, n_gram)))
+    """
+    if frame < 0 or frame >= n_gram:
+        raise ValueError("Frame {} out of range for {}-gram".format(frame, n_gram))
+    max_len = x.shape[-1] // n_gram * n_gram
+    return x[..., frame:max_len:n_gram]
+
+
+def get_ngram_frames(x: np.ndarray, n_gram: int):
+    """
+    全部 n_gram 个读码框的视图
+    :param x: (..., L)
+    :param n_gram:
+    :return: [get_ngram_frame(x, 0, n_gram), ..., get_ngram_frame(x, n_gram - 1, n_gram)]
+    """
+    return [get_ngram_frame(x, frame, n_gram) for frame in range(n_gram)]
+
+
+def get_kmer_values(codes: np.ndarray, n_gram: int, stride: int = 1):
+    """
+    n-gram 窗口的五进制值 (首字符为最高位), 第 jj 个窗口从 jj * stride 开始
+    :param codes: (..., L)
+    :param n_gram:
+    :param stride:
+    :return: values (..., T) int64; invalid (..., T) 含非 0~4 编码的窗口, 其 value 记为 0
+    """
+    codes = np.asarray(codes)
+    num_windows = max(codes.shape[-1] - n_gram + 1, 0)
+    values = np.zeros(codes.shape[:-1] + (len(range(0, num_windows, stride)),), dtype=np.int64)
+    invalid = np.zeros(values.shape, dtype=bool)
+    for ii in range(n_gram):
+        window = codes[..., ii:ii + num_windows:stride]
+        values = values * 5 + window
+        invalid |= (window < 0) | (window > 4)
+
+    values[invalid] = 0
+    return values, invalid
+
+
+def codes_to_kmer_ids(codes: np.ndarray, lut: np.ndarray, n_gram: int, stride: int = 1):
+    """
+    向量化的 n-gram 切分与查表, 等价于
+    [word_dict.get(seq[jj:jj + n_gram], 0) for jj in range(0, len(seq), stride) if jj + n_gram <= len(seq)]
+    :param codes: (..., L) 0~4 的编码, 其他值 (非 'NAGCT' 字符, PAD_CODE) 所在的 k-mer 记为 0
+    :param lut: get_kmer_lookup_table 的结果
+    :param n_gram:
+    :param stride:
+    :return: (..., T) int64
+    """
+    codes = np.asarray(codes)
+    if lut is None:
+        return np.zeros(codes.shape[:-1] + (0,), dtype=np.int64)
+
+    values, invalid = get_kmer_values(codes, n_gram, stride)
+    ids = lut[values]
+    ids[invalid] = 0
+    return ids
+
+
+def sequence_to_kmer_ids(seq: str, lut: np.ndarray, n_gram: int, stride: int = 1):
+    """
+    字符串序列 -> k-mer id, 等价于按 get_word_dict_for_n_gram_alphabet 逐个查字典
+    :param seq: 大写序列
+    :param lut:
+    :param n_gram:
+    :param stride:
+    :return:
+    """
+    codes = sequence_to_codes(seq)
+    # 字典中只有大写 key
+    codes[np.frombuffer(seq.encode('ascii', errors='replace'), dtype=np.uint8) >= ord('a')] = 255
+    return codes_to_kmer_ids(codes, lut, n_gram, stride)
+
+
+def number_codes_to_kmer_ids(actg: np.ndarray, lut: np.ndarray, n_gram: int, stride: int = 1,
+                             word_index_from: int = 10, predefined_tokens: list = [], layout: str = 'layer',
+                             vocab_n_gram: int = None, word_dict: dict = None):
+    """
+    与各 data loader 中按十进制 key 查 num_word_dict 的循环等价, 包括末尾不足 n_gram 的 k-mer:
+        for kk in range(0, len(actg), stride):
+            if kk + n_gram <= len(actg): key = np.dot(actg[kk:kk + n_gram], n_gram_value)
+            else: key = sum(actg[gg] * 10 ** (n_gram - gg % n_gram - 1)) * 10 ** (kk % n_gram)
+            gene.append(num_word_dict.get(key, 0))
+    :param actg: (L,) 0~4 编码, 由 one-hot 矩阵与 [1, 2, 3, 4] 相乘得到
+    :param lut: get_kmer_lookup_table(..., number_keys=True) 的结果
+    :param n_gram:
+    :param stride:
+    :param word_index_from: 与 lut 一致, 用于末尾的 k-mer
+    :param predefined_tokens: 与 lut 一致, 用于末尾的 k-mer
+    :param layout: 与 lut 一致, 用于末尾的 k-mer
+    :param vocab_n_gram: lut 对应的 n_gram, 默认与 n_gram 相同; 十进制 key 以 0 开头时与较短的 k-mer 等价,
+                         因此 vocab_n_gram >= n_gram 的 lut 也可以直接用于 n_gram 的窗口 (如 get_word_dict_6gram 用于 5-gram)
+    :param word_dict: 由 get_kmer_lookup_table_from_dict 得到 lut 时传入原字典, 末尾的 k-mer 按字典查找
+    :return: (ceil(L / stride),) int64
+    """
+    if vocab_n_gram is None:
+        vocab_n_gram = n_gram
+
+    actg = np.asarray(actg)
+    positions = np.arange(0, len(actg), stride)
+    gene = np.zeros(len(positions), dtype=np.int64)
+
+    num_full = len(positions[positions + n_gram <= len(actg)])
+    integer = np.all((actg >= 0) & (actg <= 4) & (actg == np.floor(actg)))
+    if integer and vocab_n_gram >= n_gram:
+        gene[:num_full] = codes_to_kmer_ids(actg.astype(np.int64), lut, n_gram, stride)[:num_full]
+        tail_from = num_full
+    else:
+        # 非整数编码 (如 N 为 0.25 的 one-hot) 较少出现, 按原始的十进制 key 逐个计算
+        tail_from = 0
+
+    gene[tail_from:] = _get_number_kmer_ids(actg, positions[tail_from:], n_gram, word_index_from=word_index_from,
+                                            predefined_tokens=predefined_tokens, layout=layout,
+                                            vocab_n_gram=vocab_n_gram, word_dict=word_dict)
+    return gene
+
+
+def _get_number_kmer_ids(actg: np.ndarray, positions, n_gram: int, word_index_from: int = 10,
+                         predefined_tokens: list = [], layout: str = 'layer', vocab_n_gram: int = None,
+                         word_dict: dict = None):
+    """
+    按原始的十进制 key 逐个计算 positions 处的 id, 用于末尾不足 n_gram 的 k-mer 和非整数编码
+    """
+    if vocab_n_gram is None:
+        vocab_n_gram = n_gram
+
+    gene = np.zeros(len(positions), dtype=np.int64)
+    n_gram_value = 10 ** np.arange(n_gram - 1, -1, -1)
+    for ii, kk in enumerate(positions):
+        if kk + n_gram <= len(actg):
+            value = int(np.dot(actg[kk:kk + n_gram], n_gram_value))
+        else:
+            value = 0
+            for gg in range(kk, len(actg)):
+                value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
+            value = value * (10 ** (kk % n_gram))
+        if word_dict is not None:
+            gene[ii] = word_dict.get(value, 0)
+        else:
+            gene[ii] = decimal_kmer_to_id(value, vocab_n_gram, word_index_from=word_index_from,
+                                          predefined_tokens=predefined_tokens, layout=layout)
+    return gene
+
+
+@lru_cache(maxsize=None)
+def get_reverse_complement_value_table(n_gram: int):
+    """
+    k-mer 的五进制值 -> 其反向互补 k-mer 的五进制值
+    :param n_gram:
+    :return: (5^n_gram,) int64
+    """
+    values = np.arange(5 ** n_gram, dtype=np.int64)
+    rc_values = np.zeros(len(values), dtype=np.int64)
+    for _ in range(n_gram):
+        # 由末位开始取, 互补后作为反链的首位
+        rc_values = rc_values * 5 + complement_code_table[values % 5]
+        values = values // 5
+    return rc_values
+
+
+def get_reverse_complement_lookup_table(lut: np.ndarray, n_gram: int):
+    """
+    k-mer id -> 反向互补 k-mer 的 id
+    :param lut: get_kmer_lookup_table 或 get_kmer_lookup_table_from_dict 的结果
+    :param n_gram:
+    :return: (max_id + 1,) int64; 预定义 token 的 id 保持不变, 0 以及不在 lut 中的 id 为 0
+    """
+    table = np.zeros(int(lut.max()) + 1, dtype=np.int64)
+    base = int(lut[lut > 0].min()) if np.any(lut > 0) else 0
+    table[:base] = np.arange(base)
+    table[lut] = lut[get_reverse_complement_value_table(n_gram)]
+    table[0] = 0
+    return table
+
+
+def reverse_complement_codes(codes: np.ndarray):
+    """
+    反向互补的编码序列, 非 0~4 的编码保持不变
+    :param codes: (..., L)
+    :return:
+    """
+    codes = np.asarray(codes)
+    valid = (codes >= 0) & (codes <= 4)
+    rc_codes = np.where(valid, complement_code_table[np.where(valid, codes, 0).astype(np.int64)], codes)
+    return rc_codes[..., ::-1].astype(codes.dtype)
+
+
+def reverse_complement_kmer_ids(ids: np.ndarray, rc_lut: np.ndarray, stride: int = 1):
+    """
+    由步长为 1 的正链 id 直接得到反向互补链的 id, 不再重新切分反链序列.
+    反链第 jj 个窗口是正链倒数第 jj 个窗口的反向互补, 因此 stride > 1 时需要步长为 1 的正链 id 才能对齐 frame
+    :param ids: (..., W) 步长为 1 的正链 id, W = L - n_gram + 1
+    :param rc_lut: get_reverse_complement_lookup_table 的结果
+    :param stride:
+    :return: (..., ceil(W / stride))
+    注意: layout='layer' 的字母字典中以 N 开头的 k-mer 为 0, 其反向互补无法由 id 还原,
+    这类窗口的结果为 0; 需要与重新切分完全一致时使用 codes_to_kmer_ids_both_strands
+    """
+    return rc_lut[np.asarray(ids)[..., ::-1]][..., ::stride]
+
+
+def codes_to_kmer_ids_both_strands(codes: np.ndarray, lut: np.ndarray, n_gram: int, stride: int = 1):
+    """
+    一次切分同时得到正链和反向互补链的 id, 与分别对 seq 和 reverse_complement(seq) 调用 codes_to_kmer_ids 的结果一致
+    :param codes: (..., L)
+    :param lut:
+    :param n_gram:
+    :param stride:
+    :return: forward (..., T), reverse (..., T)
+    """
+    codes = np.asarray(codes)
+    if lut is None:
+        empty = np.zeros(codes.shape[:-1] + (0,), dtype=np.int64)
+        return empty, empty
+
+    values, invalid = get_kmer_values(codes, n_gram, stride)
+    forward = lut[values]
+    forward[invalid] = 0
+
+    # 反链第 jj 个窗口对应正链的第 W - 1 - jj * stride 个窗口
+    offset = (codes.shape[-1] - n_gram) % stride if codes.shape[-1] >= n_gram else 0
+    if offset > 0:
+        values, invalid = get_kmer_values(codes[..., offset:], n_gram, stride)
+    reverse = lut[get_reverse_complement_value_table(n_gram)[values[..., ::-1]]]
+    reverse[invalid[..., ::-1]] = 0
+    return forward, reverse
+
+
+def sequence_to_kmer_ids_both_strands(seq: str, lut: np.ndarray, n_gram: int, stride: int = 1):
+    """
+    替代 Seq(seq).reverse_complement() 后再次切分
+    :param seq: 大写序列
+    :param lut:
+    :param n_gram:
+    :param stride:
+    :return: forward, reverse
+    """
+    codes = sequence_to_codes(seq)
+    codes[np.frombuffer(seq.encode('ascii', errors='replace'), dtype=np.uint8) >= ord('a')] = 255
+    return codes_to_kmer_ids_both_strands(codes, lut, n_gram, stride)
+
+
+def number_codes_to_kmer_ids_both_strands(actg: np.ndarray, lut: np.ndarray, n_gram: int, stride: int = 1,
+                                          word_index_from: int = 10, predefined_tokens: list = [],
+                                          layout: str = 'layer', vocab_n_gram: int = None, word_dict: dict = None):
+    """
+    number_codes_to_kmer_ids 的双链版本, 反链与将 one-hot 矩阵翻转 (data[:, ::-1, ::-1]) 后再切分的结果一致
+    :param actg: (L,)
+    :param lut:
+    :param n_gram:
+    :param stride:
+    :param word_index_from:
+    :param predefined_tokens:
+    :param layout:
+    :param vocab_n_gram:
+    :param word_dict:
+    :return: forward, reverse
+    """
+    if vocab_n_gram is None:
+        vocab_n_gram = n_gram
+    kwargs = dict(word_index_from=word_index_from, predefined_tokens=predefined_tokens, layout=layout,
+                  vocab_n_gram=vocab_n_gram, word_dict=word_dict)
+
+    actg = np.asarray(actg)
+    # one-hot 翻转后 A<->T, G<->C, 全 0 (N) 的位置不变
+    rc_actg = np.where(actg == 0, 0, 5 - actg)[::-1]
+
+    integer = np.all((actg >= 0) & (actg <= 4) & (actg == np.floor(actg)))
+    if not integer or vocab_n_gram < n_gram:
+        return (number_codes_to_kmer_ids(actg, lut, n_gram, stride, **kwargs),
+                number_codes_to_kmer_ids(rc_actg, lut, n_gram, stride, **kwargs))
+
+    positions = np.arange(0, len(actg), stride)
+    num_full = len(positions[positions + n_gram <= len(actg)])
+    forward = np.zeros(len(positions), dtype=np.int64)
+    reverse = np.zeros(len(positions), dtype=np.int64)
+
+    full_forward, full_reverse = codes_to_kmer_ids_both_strands(actg.astype(np.int64), lut, n_gram, stride)
+    forward[:num_full] = full_forward
+    reverse[:num_full] = full_reverse
+    forward[num_full:] = _get_number_kmer_ids(actg, positions[num_full:], n_gram, **kwargs)
+    reverse[num_full:] = _get_number_kmer_ids(rc_actg, positions[num_full:], n_gram, **kwargs)
+    return forward, reverse
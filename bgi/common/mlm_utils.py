@@ -0,0 +1,98 @@
+import numpy as np
+import tensorflow as tf
+
+MASK_MODES = ('choice', 'bernoulli')
+
+
+def add_cls_sep(train_data: np.ndarray, cls_token_id: int, sep_token_id: int):
+    """
+    每行前后加上 [CLS] 和 [SEP]
+    :param train_data: (N, L)
+    :param cls_token_id:
+    :param sep_token_id:
+    :return: (N, L + 2) int32
+    """
+    sequence = np.zeros((train_data.shape[0], train_data.shape[1] + 2), dtype=np.int32)
+    sequence[:, 0] = cls_token_id
+    sequence[:, 1:-1] = train_data
+    sequence[:, -1] = sep_token_id
+    return sequence
+
+
+def mask_tokens(sequence: np.ndarray,
+                first_token_id: int,
+                last_token_id: int,
+                mask_token_id: int,
+                word_from_index: int,
+                mask_rate: float = 0.15,
+                mode: str = 'choice',
+                rng: np.random.Generator = None):
+    """
+    一次为整个矩阵生成 MLM 掩码, 替代逐行的 np.random.choice 和逐个位置的 random.random().
+    被选中的位置 80% 替换为 mask_token_id, 10% 替换为 [first_token_id, last_token_id] 中的随机 token, 10% 保持不变;
+    id 小于 word_from_index 的特殊 token ([CLS], [SEP], padding 等) 不会被替换
+    :param sequence: (N, L)
+    :param first_token_id:
+    :param last_token_id: 包含在随机 token 的范围内, 与 random.randint 一致
+    :param mask_token_id:
+    :param word_from_index:
+    :param mask_rate:
+    :param mode: 'choice'    每行有放回地抽取 int(L * mask_rate) 个位置, 与原 np.random.choice 的统计一致
+                 'bernoulli' 每个位置独立地以 mask_rate 的概率被选中, 与原 is_sep_mask 分支的统计一致
+    :param rng: np.random.default_rng(seed), 默认使用新的随机种子
+    :return: masked_sequence (N, L), 与 sequence 的 dtype 相同
+    """
+    if mode not in MASK_MODES:
+        raise ValueError("Unknown mask mode '{}', expected one of {}".format(mode, MASK_MODES))
+    if rng is None:
+        rng = np.random.default_rng()
+
+    sequence = np.asarray(sequence)
+    masked_sequence = sequence.copy()
+    num_rows, seq_len = sequence.shape
+    if num_rows == 0 or seq_len == 0:
+        return masked_sequence
+
+    if mode == 'choice':
+        num_choice = int(seq_len * mask_rate)
+        rows = np.repeat(np.arange(num_rows), num_choice)
+        cols = rng.integers(0, seq_len, size=num_rows * num_choice)
+    else:
+        rows, cols = np.nonzero(rng.random((num_rows, seq_len)) < mask_rate)
+
+    dice = rng.random(len(rows))
+    random_tokens = rng.integers(first_token_id, last_token_id + 1, size=len(rows))
+
+    # 特殊 token 和 "保持不变" 的 10% 不需要写入; 同一位置被重复抽中时与原循环一样以最后一次为准
+    selected = (sequence[rows, cols] >= word_from_index) & (dice < 0.9)
+    rows, cols, dice, random_tokens = rows[selected], cols[selected], dice[selected], random_tokens[selected]
+    masked_sequence[rows, cols] = np.where(dice < 0.8, mask_token_id, random_tokens)
+    return masked_sequence
+
+
+def mask_tokens_tf(sequence,
+                   first_token_id: int,
+                   last_token_id: int,
+                   mask_token_id: int,
+                   word_from_index: int,
+                   mask_rate: float = 0.15):
+    """
+    mask_tokens 的 tf 版本, 在 tf.data 中按 batch 动态生成掩码, 每个 epoch 的掩码都不同.
+    每个位置独立地以 mask_rate 的概率被选中 (mode='bernoulli'), 80/10/10 的规则与 mask_tokens 一致
+    :param sequence: (batch_size, L) int
+    :param first_token_id:
+    :param last_token_id: 包含在随机 token 的范围内
+    :param mask_token_id:
+    :param word_from_index: 小于该值的特殊 token 不会被替换
+    :param mask_rate:
+    :return: masked_sequence, 与 sequence 的 dtype 相同
+    """
+    shape = tf.shape(sequence)
+    selected = (tf.random.uniform(shape) < mask_rate) & (sequence >= word_from_index)
+    dice = tf.random.uniform(shape)
+    random_tokens = tf.random.uniform(shape, minval=first_token_id, maxval=last_token_id + 1, dtype=sequence.dtype)
+
+    masked_sequence = tf.where(selected & (dice < 0.9), random_tokens, sequence)
+    masked_sequence = tf.where(selected & (dice < 0.8), tf.fill(shape, tf.cast(mask_token_id, sequence.dtype)),
+                               masked_sequence)
+    return masked_sequence
@@ -0,0 +1,37 @@
+import collections
+import traceback
+
+
+def apply_async_bounded(pool, func, tasks, max_in_flight: int):
+    """
+    逐个提交任务到进程池, 等待中的任务不超过 max_in_flight 个, 主进程中不会堆积任务的参数;
+    按提交顺序收集每个任务的结果, 子进程中的异常不会被静默丢弃, 而是记录下来, 其他任务继续执行
+    :param pool: multiprocessing.Pool
+    :param func: 子进程中执行的函数, 参数应尽量小 (如文件路径), 由子进程自己读取数据
+    :param tasks: 可迭代的参数 tuple, 可以是生成器
+    :param max_in_flight: 同时提交的任务数, 一般为进程数的 2 倍
+    :return: results 成功任务的 (args, result); errors 失败任务的 (args, 异常信息)
+    """
+    results = []
+    errors = []
+    pending = collections.deque()
+
+    def collect():
+        args, async_result = pending.popleft()
+        try:
+            results.append((args, async_result.get()))
+        except Exception as e:
+            # 子进程的 traceback 在 __cause__ 中
+            message = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+            if e.__cause__ is not None:
+                message = str(e.__cause__) + '\n' + message
+            errors.append((args, message))
+
+    for args in tasks:
+        while len(pending) >= max_in_flight:
+            collect()
+        pending.append((args, pool.apply_async(func, args=args)))
+
+    while len(pending) > 0:
+        collect()
+    return results, errors
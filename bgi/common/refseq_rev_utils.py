@@ -3,15 +3,14 @@ import os
 import gc
 from multiprocessing import Pool
 import sys
-import time
 
 import numpy as np
 from Bio import SeqIO
-from Bio.Alphabet import generic_dna
-from Bio.Seq import Seq
 
 sys.path.append("../../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_number, get_word_dict_for_n_gram_alphabet
+from bgi.common.fasta_utils import iter_fasta_windows
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, codes_to_kmer_ids_both_strands
 
 atcg_dict = {
     'A': 1,
@@ -106,35 +105,19 @@ atcg_dict = {
 #     return data
 
 
-def preccess_seq_chunks(seq_chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path, hg_name):
-    print("Slice: ", slice_index, seq_size, seq_stride, stride)
-    print(len(seq_chunks), seq_chunks[0:100])
-    set_atcg = set(list('ATCG'))
-    slice_seq_num_data = []
-    print("__1__")
-    for ii in range(0, len(seq_chunks), seq_stride):
-        if ii + seq_size <= len(seq_chunks):
-            seq = seq_chunks[ii:int(ii + seq_size)]
-            seq_number = []
-            for jj in range(0, len(seq), stride):
-                if jj + ngram <= len(seq):
-                    if word_dict is not None:
-                        seq_number.append(word_dict.get(seq[jj:jj + ngram], 0))
-
-            slice_seq_num_data.append(seq_number)
-
-            my_dna = Seq(seq, generic_dna)
-            seq_flip = str(my_dna.reverse_complement())
-            seq_list = []
-            seq_number = []
-            for jj in range(0, len(seq_flip), stride):
-                if jj + ngram <= len(seq_flip):
-                    if word_dict is not None:
-                        seq_number.append(word_dict.get(seq_flip[jj:jj + ngram], 0))
-                    # seq_list.append(seq[jj:jj+ngram])
-            slice_seq_num_data.append(seq_number)
-
-    print("__2__")
+def preccess_seq_chunks(seq_codes, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path, hg_name):
+    """
+    切分一个 slice 的窗口并保存, 正链和反向互补链交替排列
+    :param seq_codes: (N, seq_size) uint8, iter_fasta_windows 输出的窗口
+    :param slice_index: 保存的文件名中的序号
+    """
+    print("Slice: ", slice_index, seq_size, seq_stride, stride, seq_codes.shape)
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
+
+    # 反向互补链的 token 由同一次切分得到
+    seq_number, seq_flip_number = codes_to_kmer_ids_both_strands(seq_codes, kmer_lut, ngram, stride)
+    slice_seq_num_data = np.stack([seq_number, seq_flip_number], axis=1).reshape((-1, seq_number.shape[-1]))
+
     save_dict = {
         'data': slice_seq_num_data,
         # 'dict': word_dict
@@ -143,11 +126,9 @@ def preccess_seq_chunks(seq_chunks, slice_index, seq_size, seq_stride, stride, n
                              '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
                                                                             str(stride),
                                                                             str(slice_index)))
-    print("__3__: ", save_path)
+    print("Save: ", save_path)
     np.savez_compressed(save_path, **save_dict)
 
-    time.sleep(5)
-
 
 def process_fasta_raw_text_parallel(fname,
                                     chunk_size=10000,
@@ -162,85 +143,54 @@ def process_fasta_raw_text_parallel(fname,
                                     output_path: str = './',
                                     hg_name: str = 'hg19',
                                     pool_size: int = 8):
-    index = 0
-    chunks = ''
 
     # 例如 3-gram， 取999，存在问题， 只能取到997个特征
     seq_size = max(seq_size, seq_size // ngram * ngram + (ngram - 1))
 
     slice_index = 0
+    num_windows = 0
 
-    slice_seq_raw_data = []
-    slice_seq_num_data = []
-    set_atcg = set(list('ATCG'))
+    slice_seq_codes = []
+    results = []
 
     print("seq_size: ", seq_size)
-    with open(fname, mode='r', encoding='utf-8') as f:
-
-        pool = Pool(processes=pool_size)
-
-        for line in f:
-            # 去除 '\n'
-            line = line[:-1]
-            line = line.upper()
-            if filter_txt is not None and line.startswith(filter_txt):
-                continue
-
-            if skip_n is True:
-                if line.find('N') > -1:
-                    continue
-
-            # 检查是否不是 ‘ATCG’的字符
-            set_seq = set(list(line))
-            is_atcg = True
-            for atcg in set_seq:
-                if atcg not in set_atcg:
-                    is_atcg = False
-            if is_atcg is False:
-                continue
-
-            if len(chunks) < (seq_stride * slice_size + (seq_size - seq_stride)):
-                chunks += line
-            else:
-                for ii in range(0, int(seq_stride * slice_size), seq_stride):
-                    if ii + seq_size <= (seq_stride * slice_size + (seq_size - seq_stride)):
-                        continue
-
-                print("ii: ", slice_index, seq_stride * slice_size, len(chunks))
-                print("chunks: ", len(chunks))
-
-                seq_chunks = chunks[:(ii+seq_size)]
-                chunks = chunks[(ii+seq_size):]
-                chunks += line
-
-                slice_index += int((ii + seq_stride) / seq_stride)
-                pool.apply_async(preccess_seq_chunks, args=(seq_chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path, hg_name))
-
-
-            index += 1
-            if index % 100000 == 0:
-                print(index, len(line))
-
-        if len(chunks) > 0:
-            slice_index += int(len(chunks) / seq_stride)
-            pool.apply_async(preccess_seq_chunks,
-                             args=(chunks, slice_index, seq_size, seq_stride, stride, ngram, word_dict, output_path,
-                                 hg_name))
-
-        pool.close()
-        pool.join()
-
-        # if len(slice_seq_num_data) > 0:
-        #     save_dict = {
-        #         'data': slice_seq_num_data,
-        #         'dict': word_dict
-        #     }
-        #     save_path = os.path.join(output_path,
-        #                              '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-        #                                                                             str(stride), str(slice_index)))
-        #     np.savez_compressed(save_path, **save_dict)
-
-
+    pool = Pool(processes=pool_size)
+
+    # 主进程流式切分窗口, 每 slice_size 个窗口交给一个子进程切分 n-gram 并保存
+    for chrom, starts, windows in iter_fasta_windows(fname,
+                                                     seq_size=seq_size,
+                                                     seq_stride=seq_stride,
+                                                     buffer_size=chunk_size,
+                                                     filter_txt=filter_txt,
+                                                     skip_n=skip_n,
+                                                     skip_invalid=True):
+        # 窗口是缓冲区的视图, 需要复制
+        slice_seq_codes.append(windows.copy())
+        num_windows += len(windows)
+
+        while num_windows - slice_index >= slice_size:
+            seq_codes = np.concatenate(slice_seq_codes)
+            slice_index += slice_size
+            slice_seq_codes = [seq_codes[slice_size:]]
+
+            # 限制等待中的任务数, 避免窗口在主进程中堆积
+            while len(results) >= pool_size * 2:
+                results.pop(0).get()
+            print("chrom: ", chrom, starts[-1], slice_index)
+            results.append(pool.apply_async(preccess_seq_chunks,
+                                            args=(seq_codes[:slice_size], slice_index, seq_size, seq_stride, stride,
+                                                  ngram, word_dict, output_path, hg_name)))
+
+    if num_windows > slice_index:
+        slice_index = num_windows
+        results.append(pool.apply_async(preccess_seq_chunks,
+                                        args=(np.concatenate(slice_seq_codes), slice_index, seq_size, seq_stride,
+                                              stride, ngram, word_dict, output_path, hg_name)))
+
+    for result in results:
+        result.get()
+    pool.close()
+    pool.join()
 
 
 def process_fasta_raw_text(fname,
@@ -256,114 +206,55 @@ def process_fasta_raw_text(fname,
                            output_path: str = './',
                            hg_name: str = 'hg19'):
 
-    index = 0
-    chunks = ''
-
     # 例如 3-gram， 取999，存在问题， 只能取到997个特征
     seq_size = max(seq_size, seq_size//ngram * ngram + (ngram-1))
 
     slice_index = 0
+    num_windows = 0
 
-    slice_seq_raw_data = []
     slice_seq_num_data = []
 
-    set_atcg = set(list('ATCG'))
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
 
     print("seq_size: ", seq_size)
-    with open(fname, mode='r', encoding='utf-8') as f:
-        for line in f:
-            # 去除 '\n'
-            line = line[:-1]
-            line = line.upper()
-            if filter_txt is not None and line.startswith(filter_txt):
-                continue
-
-            if skip_n is True:
-                if line.find('N') > -1:
-                    continue
-
-            # 检查是否不是 ‘ATCG’的字符
-            set_seq = set(list(line))
-            is_atcg = True
-            for atcg in set_seq:
-                if atcg not in set_atcg:
-                    is_atcg = False
-            if is_atcg is False:
-                continue
-
-            if len(chunks) < chunk_size:
-                chunks += line
-            else:
-                for ii in range(0, chunk_size, seq_stride):
-                    if ii + seq_size <= chunk_size:
-                        seq = chunks[ii:int(ii+seq_size)]
-
-                        # 检查所有字符是否是 ‘ATCG’
-                        set_seq = set(list(seq))
-                        is_atcg = True
-                        for atcg in set_seq:
-                            if atcg not in set_atcg:
-                                is_atcg = False
-                        if is_atcg is False:
-                            continue
-
-                        seq_list = []
-                        seq_number = []
-                        for jj in range(0, len(seq), stride):
-                            if jj + ngram <= len(seq):
-                                if word_dict is not None:
-                                    seq_number.append(word_dict.get(seq[jj:jj+ngram], 0))
-                                #seq_list.append(seq[jj:jj+ngram])
-
-                        #slice_seq_raw_data.append(seq_list)
-                        # print(seq_number)
-                        slice_seq_num_data.append(seq_number)
-                        
-                        my_dna = Seq(seq, generic_dna)
-                        seq_flip = str(my_dna.reverse_complement())
-                        seq_list = []
-                        seq_number = []
-                        for jj in range(0, len(seq_flip), stride):
-                            if jj + ngram <= len(seq_flip):
-                                if word_dict is not None:
-                                    seq_number.append(word_dict.get(seq_flip[jj:jj+ngram], 0))
-                                #seq_list.append(seq[jj:jj+ngram])
-
-                        #slice_seq_raw_data.append(seq_list)
-                        # print(seq_number)
-                        slice_seq_num_data.append(seq_number)
-                        slice_index += 1
-
-                        if slice_index > 0 and slice_index % slice_size == 0:
-                            save_dict = {
-                                'data': slice_seq_num_data,
-                                #'dict': word_dict
-                            }
-                            save_path = os.path.join(output_path, '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram), str(stride), str(slice_index)))
-                            np.savez_compressed(save_path, **save_dict)
-
-                            slice_seq_raw_data = []
-                            slice_seq_num_data = []
-
-                # 更新为剩余的序列
-                chunks = chunks[ii:]
-                chunks += line
-
-            index += 1
-            if index % 100000 == 0:
-                print(index, len(line))
-
-        if len(slice_seq_num_data) > 0:
+    # 含非 'ATCG' 字符的行被跳过, 因此窗口中只有 'ATCG'
+    for chrom, starts, windows in iter_fasta_windows(fname,
+                                                     seq_size=seq_size,
+                                                     seq_stride=seq_stride,
+                                                     buffer_size=chunk_size,
+                                                     filter_txt=filter_txt,
+                                                     skip_n=skip_n,
+                                                     skip_invalid=True):
+        # 反向互补链的 token 由同一次切分得到, 正链和反链交替排列
+        seq_number, seq_flip_number = codes_to_kmer_ids_both_strands(windows, kmer_lut, ngram, stride)
+        slice_seq_num_data.append(np.stack([seq_number, seq_flip_number], axis=1))
+        num_windows += len(windows)
+
+        while num_windows - slice_index >= slice_size:
+            data = np.concatenate(slice_seq_num_data)
+            slice_index += slice_size
             save_dict = {
-                'data': slice_seq_num_data,
-                'dict': word_dict
+                'data': data[:slice_size].reshape((-1, data.shape[-1])),
+                #'dict': word_dict
             }
-            save_path = os.path.join(output_path,
-                                     '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-                                                                                    str(stride), str(slice_index)))
+            save_path = os.path.join(output_path, '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram), str(stride), str(slice_index)))
             np.savez_compressed(save_path, **save_dict)
-            del slice_seq_raw_data
-            del slice_seq_num_data
+
+            slice_seq_num_data = [data[slice_size:]]
+            print(chrom, starts[-1], slice_index)
+
+    if num_windows > slice_index:
+        slice_index = num_windows
+        data = np.concatenate(slice_seq_num_data)
+        save_dict = {
+            'data': data.reshape((-1, data.shape[-1])),
+            'dict': word_dict
+        }
+        save_path = os.path.join(output_path,
+                                 '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
+                                                                                str(stride), str(slice_index)))
+        np.savez_compressed(save_path, **save_dict)
+        del slice_seq_num_data
 
 
 if __name__ == '__main__':
@@ -1,6 +1,5 @@
 
 import os
-import random
 from multiprocessing import Pool
 import argparse
 import sys
@@ -11,6 +10,12 @@ import tensorflow.keras.backend as K
 
 sys.path.append("../../")
 from bgi.common.refseq_utils import get_word_dict_for_n_gram_alphabet
+from bgi.common.tfrecord_utils import write_to_tfrecord, create_token_feature, get_token_feature_spec, \
+    decode_token_feature, detect_token_schema, load_tfrecord_dataset
+from bgi.common.mlm_utils import add_cls_sep, mask_tokens
+from bgi.common.pool_utils import apply_async_bounded
+from bgi.common.shard_utils import TOKEN_SHARD_SUFFIX, iter_token_shard, open_token_shard, read_token_shard_header
+from bgi.common.kmer_utils import get_ngram_frame
 
 
 def generate_samples(train_data,
@@ -24,7 +29,12 @@ def generate_samples(train_data,
                      shuffle=True,
                      batch_size: int = 32,
                      output_path: str = '',
-                     file_name: str = ''
+                     file_name: str = '',
+                     seed: int = None,
+                     raw_sequence: bool = False,
+                     compression_type: str = 'ZLIB',
+                     max_shard_bytes: int = None,
+                     token_schema: str = 'int64'
                      ):
     """
     生成掩码字符串
@@ -36,127 +46,96 @@ def generate_samples(train_data,
         mask_token_id:
         sep_token_id:
         word_from_index:
+        seed: 随机种子, 默认使用新的随机种子
+        raw_sequence: 只保存原始序列, 由训练时的 tf.data 动态生成掩码
+        compression_type: 'GZIP', 'ZLIB' 或 'NONE'
+        max_shard_bytes: 每个 tfrecord 分片的目标大小, 默认不分片
+        token_schema: 'int64' 每个 token 为一个 int64; 'bytes' 整条序列为小端 uint16 的 bytes, 约为 1/4 大小
 
     Returns:
 
     """
 
     print("__1__")
-    batch_len = len(train_data) #int(len(train_data) // batch_size) * batch_size
+    batch_len = len(train_data)
 
-    if is_sep_mask:
-        sequence = np.zeros((batch_len, train_data.shape[1]+2), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1]+2), dtype=np.int32)
-        #segment_id = np.zeros_like(sequence, dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle == True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-
-            sequence[ii, 0] = cls_token_id
-            sequence[ii, 1:-1] = train_data[index, :]
-            sequence[ii, -1] = sep_token_id
-            masked_sequence[ii] = sequence[ii]
-
-            for word_pos in range(1, len(sequence[ii]) - 1):
-                if random.random() < 0.15:
-                    dice = random.random()
-                    if dice < 0.8:
-                        masked_sequence[ii, word_pos + 1] = mask_token_id
-                    elif dice < 0.9:
-                        masked_sequence[ii, word_pos + 1] = random.randint(first_token_id, last_token_id)
-                    # else: 10% of the time we just leave the word as is
-                    #output_mask[ii, word_pos] = 1
-        # return segment_id, sequence, masked_sequence
+    # 同一个带种子的 Generator 一次生成整个 slice 的掩码位置和 80/10/10 的选择
+    rng = np.random.default_rng(seed)
+    indexes = np.arange(batch_len)
+    if shuffle is True:
+        indexes = rng.permutation(batch_len)
 
+    if is_sep_mask:
+        sequence = add_cls_sep(train_data[indexes], cls_token_id, sep_token_id)
+    else:
+        sequence = np.asarray(train_data[indexes], dtype=np.int32)
+
+    # 保存原始序列时不生成掩码, 掩码在训练时由 tf.data 生成
+    if raw_sequence is True:
+        masked_sequence = None
+    elif is_sep_mask:
+        # 每个位置以 15% 的概率被选中, [CLS] 和 [SEP] 不会被替换
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='bernoulli', rng=rng)
     else:
-        sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-        masked_sequence = np.zeros((batch_len, train_data.shape[1]), dtype=np.int32)
-        #segment_id = np.zeros_like(sequence, dtype=np.int32)
-
-        indexes = np.arange(len(train_data))
-        if shuffle is True:
-            np.random.shuffle(indexes)
-
-        for ii in range(batch_len):
-            index = indexes[ii]
-            sequence[ii] = train_data[index]
-            masked_sequence[ii] = train_data[index]
-
-            choice_index = np.random.choice(len(sequence[ii]), int(len(sequence[ii]) * 0.15))
-            for word_pos in choice_index:
-                if sequence[ii, word_pos] < word_from_index:
-                    continue
-
-                dice = random.random()
-                if dice < 0.8:
-                    masked_sequence[ii, word_pos] = mask_token_id
-                elif dice < 0.9:
-                    masked_sequence[ii, word_pos] = random.randint(first_token_id, last_token_id)
-                # else: 10% of the time we just leave the word as is
-                # output_mask[ii, word_pos] = 1
-        # return segment_id, sequence, masked_sequence
+        # 每行有放回地抽取 15% 的位置, 与 np.random.choice 一致
+        masked_sequence = mask_tokens(sequence, first_token_id, last_token_id, mask_token_id, word_from_index,
+                                      mode='choice', rng=rng)
 
     # sequence = np.reshape(sequence, (sequence.shape[0], sequence.shape[1], 1))
-    print("masked_sequence: ", masked_sequence.shape)
+    if masked_sequence is not None:
+        print("masked_sequence: ", masked_sequence.shape)
     print("sequence: ", sequence.shape)
     print("__2__")
     # 保存到系统文件
-    serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'])
+    if raw_sequence is True:
+        serialized_instances = tfrecord_serialize([sequence], ['sequence'], token_schema=token_schema)
+    else:
+        serialized_instances = tfrecord_serialize([masked_sequence, sequence], ['masked_sequence', 'sequence'],
+                                                  token_schema=token_schema)
     print("__3__")
-    write_to_tfrecord(os.path.join(output_path, file_name), serialized_instances)
+    write_to_tfrecord(os.path.join(output_path, file_name), serialized_instances, compression_type=compression_type,
+                      max_shard_bytes=max_shard_bytes)
     print("__4__")
     print("Save: ", os.path.join(output_path, file_name))
 
 
-def tfrecord_serialize(instances, instance_keys):
-    """转为tfrecord的字符串，等待写入到文件
+def tfrecord_serialize(instances, instance_keys, token_schema='int64'):
+    """转为tfrecord的字符串，逐条生成，由 write_to_tfrecord 边生成边写入
     """
-    def create_feature(x):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=x))
-
-    serialized_instances = []
     for instance in zip(*instances):
         if len(instance) != len(instance_keys):
             continue
 
         features = {
-            k: create_feature(v)
+            k: create_token_feature(v, token_schema)
             for k, v in zip(instance_keys, instance)
         }
         tf_features = tf.train.Features(feature=features)
         tf_example = tf.train.Example(features=tf_features)
         serialized_instance = tf_example.SerializeToString()
-        serialized_instances.append(serialized_instance)
+        yield serialized_instance
 
-    return serialized_instances
 
-
-def write_to_tfrecord(record_name, serialized_instances):
-    options = tf.io.TFRecordOptions(
-        compression_type=tf.io.TFRecordOptions.compression_type_map.get('ZLIB'))
-
-    writer = tf.io.TFRecordWriter(record_name, options)
-    for serialized_instance in serialized_instances:
-        writer.write(serialized_instance)
-
-
-def load_tfrecord(record_names, sequence_length=100, batch_size=32):
-    """给原方法补上parse_function
+def load_tfrecord(record_names, sequence_length=100, batch_size=32, token_schema=None, **kwargs):
+    """
+    按 batch 读取 tfrecord, 每个 batch 由 tf.io.parse_example 一次解析
+    其他参数见 bgi.common.tfrecord_utils.load_tfrecord_dataset
     """
+    if not isinstance(record_names, list):
+        record_names = [record_names]
+    if token_schema is None:
+        token_schema = detect_token_schema(record_names, 'sequence')
+
     def parse_function(serialized):
         features = {
-            'masked_sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
-            # 'segmentId': tf.io.FixedLenFeature([sequence_length], tf.int64),
-            'sequence': tf.io.FixedLenFeature([sequence_length], tf.int64),
+            'masked_sequence': get_token_feature_spec(sequence_length, token_schema),
+            'sequence': get_token_feature_spec(sequence_length, token_schema),
         }
-        features = tf.io.parse_single_example(serialized, features)
-        masked_sequence = features['masked_sequence']
+        features = tf.io.parse_example(serialized, features)
+        masked_sequence = decode_token_feature(features['masked_sequence'], sequence_length, token_schema)
         segment_id = K.zeros_like(masked_sequence, dtype='int64')
-        sequence = features['sequence']
+        sequence = decode_token_feature(features['sequence'], sequence_length, token_schema)
         x = {
             'Input-Token': masked_sequence,
             'Input-Segment': segment_id,
@@ -164,19 +143,82 @@ def load_tfrecord(record_names, sequence_length=100, batch_size=32):
         y = sequence
         return x, y
 
-    if not isinstance(record_names, list):
-        record_names = [record_names]
+    return load_tfrecord_dataset(record_names, parse_function, batch_size, **kwargs)
 
-    dataset = tf.data.TFRecordDataset(record_names)
-    dataset = dataset.map(map_func=parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    # dataset = dataset.repeat()
-    # dataset = dataset.shuffle(batch_size * 1000)
-    # dataset = dataset.batch(batch_size)
-    # dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
+def load_token_shard_dataset(shard_names, columns=None, batch_rows=1024):
+    """
+    直接从 int16 分片流式读取 token 序列, 不需要先转为 tfrecord
+    :param shard_names: 分片路径 (shard_utils.TOKEN_SHARD_SUFFIX)
+    :param columns: 列的切片, 如 slice(kk, max_len, ngram) 取第 kk 个 frame
+    :param batch_rows: 每次从 memmap 读取的行数
+    :return: 逐行的 int32 序列
+    """
+    if not isinstance(shard_names, list):
+        shard_names = [shard_names]
+
+    seq_width = read_token_shard_header(shard_names[0])['width']
+    seq_len = len(range(seq_width)[columns]) if columns is not None else seq_width
+
+    def generator():
+        for shard_name in shard_names:
+            for rows in iter_token_shard(shard_name, batch_rows=batch_rows, columns=columns):
+                yield rows
+
+    dataset = tf.data.Dataset.from_generator(generator,
+                                             output_types=tf.int16,
+                                             output_shapes=tf.TensorShape([None, seq_len]))
+    dataset = dataset.apply(tf.data.experimental.unbatch())
+    dataset = dataset.map(lambda x: tf.cast(x, tf.int32), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return dataset
 
 
+def generate_samples_from_file(train_file, frame, ngram, *args):
+    """
+    在子进程中读取一个 .npz 或 int16 分片 (或其中第 frame 个 frame) 并生成样本, 主进程只传递文件路径
+    :param train_file:
+    :param frame: 第几个 frame, None 为整个序列
+    :param ngram:
+    :param args: generate_samples 的其他参数
+    :return: train_file, frame, 样本数
+    """
+    if str(train_file).endswith(TOKEN_SHARD_SUFFIX):
+        # int16 分片为 memmap, 只读取这个 frame 的列
+        train_data, _ = open_token_shard(train_file)
+    else:
+        with np.load(train_file) as loaded:
+            train_data = loaded['data']
+    if frame is not None:
+        train_data = get_ngram_frame(train_data, frame, ngram)
+    train_data = np.asarray(train_data, dtype=np.int32)
+
+    generate_samples(train_data, *args)
+    return train_file, frame, len(train_data)
+
+
+def get_pretrain_tasks(train_data_path: str, ngram: int, only_one_slice: bool, sample_args: tuple,
+                       record_args: tuple):
+    """
+    每个文件的每个 frame 为一个任务, 只包含文件路径和 frame, 数据由子进程读取
+    """
+    for file_name in sorted(os.listdir(train_data_path)):
+        if str(file_name).endswith(TOKEN_SHARD_SUFFIX):
+            base_name = file_name[:-len(TOKEN_SHARD_SUFFIX)]
+        elif str(file_name).endswith('.npz'):
+            base_name = file_name[:-len('.npz')]
+        else:
+            continue
+        train_file = os.path.join(train_data_path, file_name)
+
+        frames = range(ngram) if only_one_slice is True else [None]
+        for frame in frames:
+            if frame is None:
+                tf_file_name = base_name + '.tfrecord'
+            else:
+                tf_file_name = base_name + '_{}.tfrecord'.format(str(frame))
+            yield (train_file, frame, ngram) + sample_args + (tf_file_name,) + record_args
+
+
 def prepare_pretrain_data(train_data_path: str,
                           output_path: str,
                           pool_size: int = 8,
@@ -192,72 +234,40 @@ def prepare_pretrain_data(train_data_path: str,
                           shuffle=True,
                           batch_size: int = 32,
                           only_one_slice: bool = True,
+                          raw_sequence: bool = False,
+                          compression_type: str = 'ZLIB',
+                          max_shard_bytes: int = None,
+                          token_schema: str = 'int64',
                           ):
-
-    files = os.listdir(train_data_path)
-
-    # 并行生成数据
+    sample_args = (first_token_id,
+                   last_token_id,
+                   CLS_ID,
+                   MASK_ID,
+                   PAD_ID,
+                   word_from_index,
+                   is_sep_mask,
+                   shuffle,
+                   batch_size,
+                   output_path,
+                   )
+    # seed, raw_sequence, compression_type, max_shard_bytes, token_schema
+    record_args = (None, raw_sequence, compression_type, max_shard_bytes, token_schema)
+
+    # 并行生成数据, 同时提交的任务不超过 pool_size * 2 个
     pool = Pool(processes=pool_size)
-    results = []
-    for file_name in files:
-
-        if str(file_name).endswith('.npz') is False:
-            continue
-        train_file = os.path.join(train_data_path, file_name)
-        print("File: ", train_file)
-        loaded = np.load(train_file)
-        x_train = loaded['data']
-
-        tf_file_name = file_name.replace('.npz', '.tfrecord')
-        # 读取所有数据
-        if only_one_slice is True:
-            # kk = random.randint(0, int(ngram) - 1)
-            for kk in range(ngram):
-                slice_indexes = []
-                max_slice_seq_len = x_train.shape[1] // ngram * ngram
-                for gg in range(kk, max_slice_seq_len, ngram):
-                    slice_indexes.append(gg)
-
-                print("max_slice_seq_len: ", max_slice_seq_len, kk)
-                print("slice_indexes: ", len(slice_indexes))
-                suffix = '_{}.tfrecord'.format(str(kk))
-                tf_file_name = tf_file_name.replace('.tfrecord', suffix)
-
-                pool.apply_async(generate_samples,
-                                 args=(x_train[:, slice_indexes],
-                                       first_token_id,
-                                       last_token_id,
-                                       CLS_ID,
-                                       MASK_ID,
-                                       PAD_ID,
-                                       word_from_index,
-                                       is_sep_mask,
-                                       shuffle,
-                                       batch_size,
-                                       output_path,
-                                       tf_file_name,
-                                       ))
-                # results.append(result)
-
-        else:
-            pool.apply_async(generate_samples,
-                             args=(x_train,
-                                   first_token_id,
-                                   last_token_id,
-                                   CLS_ID,
-                                   MASK_ID,
-                                   PAD_ID,
-                                   word_from_index,
-                                   is_sep_mask,
-                                   shuffle,
-                                   batch_size,
-                                   output_path,
-                                   tf_file_name,
-                                   ))
-            # results.append(result)
+    tasks = get_pretrain_tasks(train_data_path, ngram, only_one_slice, sample_args, record_args)
+    results, errors = apply_async_bounded(pool, generate_samples_from_file, tasks, max_in_flight=pool_size * 2)
     pool.close()
     pool.join()
 
+    for _, (train_file, frame, num_samples) in results:
+        print("Done: ", train_file, frame, num_samples)
+    for args, message in errors:
+        print("Failed: ", args[0], args[1])
+        print(message)
+    if len(errors) > 0:
+        raise RuntimeError("{} of {} tasks failed".format(len(errors), len(results) + len(errors)))
+
 
 if __name__ == '__main__':
 
@@ -3,6 +3,11 @@ import os
 import numpy as np
 from Bio import SeqIO
 import argparse
+import sys
+
+sys.path.append("../../")
+from bgi.common.fasta_utils import iter_fasta_windows
+from bgi.common.kmer_utils import get_kmer_lookup_table_from_dict, codes_to_kmer_ids
 
 # import networkx as nx
 # import seaborn as sns
@@ -113,78 +118,51 @@ def process_fasta_raw_text(fname,
                            output_path: str = './',
                            hg_name: str = 'hg19'):
 
-    index = 0
-    chunks = ''
-
     # 例如 3-gram， 取999，存在问题， 只能取到997个特征
     seq_size = max(seq_size, seq_size//ngram * ngram + (ngram-1))
 
     slice_index = 0
+    num_windows = 0
 
-    slice_seq_raw_data = []
     slice_seq_num_data = []
 
+    kmer_lut = get_kmer_lookup_table_from_dict(word_dict, ngram)
+
     print("seq_size: ", seq_size)
-    with open(fname, mode='r', encoding='utf-8') as f:
-        for line in f:
-            # 去除 '\n'
-            line = line[:-1]
-            line = line.upper()
-            if filter_txt is not None and line.startswith(filter_txt):
-                continue
-
-            if line.find('N') > -1 and skip_n is True:
-                continue
-
-            if len(chunks) < chunk_size:
-                chunks += line
-            else:
-                for ii in range(0, chunk_size, seq_stride):
-                    if ii + seq_size <= chunk_size:
-                        seq = chunks[ii:int(ii+seq_size)]
-                        seq_list = []
-                        seq_number = []
-                        for jj in range(0, len(seq), stride):
-                            if jj + ngram <= len(seq):
-                                if word_dict is not None:
-                                    seq_number.append(word_dict.get(seq[jj:jj+ngram], 0))
-                                #seq_list.append(seq[jj:jj+ngram])
-
-                        #slice_seq_raw_data.append(seq_list)
-                        # print(seq_number)
-                        slice_seq_num_data.append(seq_number)
-                        slice_index += 1
-
-                        if slice_index > 0 and slice_index % slice_size == 0:
-                            save_dict = {
-                                'data': slice_seq_num_data,
-                                #'dict': word_dict
-                            }
-                            save_path = os.path.join(output_path, '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram), str(stride), str(slice_index)))
-                            np.savez_compressed(save_path, **save_dict)
-
-                            slice_seq_raw_data = []
-                            slice_seq_num_data = []
-
-                # 更新为剩余的序列
-                chunks = chunks[ii:]
-                chunks += line
-
-            index += 1
-            if index % 100000 == 0:
-                print(index, len(line))
-
-        if len(slice_seq_num_data) > 0:
+    # 流式读取, chunk_size 为每条染色体的缓冲区长度
+    for chrom, starts, windows in iter_fasta_windows(fname,
+                                                     seq_size=seq_size,
+                                                     seq_stride=seq_stride,
+                                                     buffer_size=chunk_size,
+                                                     filter_txt=filter_txt,
+                                                     skip_n=skip_n):
+        slice_seq_num_data.append(codes_to_kmer_ids(windows, kmer_lut, ngram, stride))
+        num_windows += len(windows)
+
+        while num_windows - slice_index >= slice_size:
+            data = np.concatenate(slice_seq_num_data)
+            slice_index += slice_size
             save_dict = {
-                'data': slice_seq_num_data,
-                'dict': word_dict
+                'data': data[:slice_size],
+                #'dict': word_dict
             }
-            save_path = os.path.join(output_path,
-                                     '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
-                                                                                    str(stride), str(slice_index)))
+            save_path = os.path.join(output_path, '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram), str(stride), str(slice_index)))
             np.savez_compressed(save_path, **save_dict)
-            slice_seq_raw_data = []
-            slice_seq_num_data = []
+
+            slice_seq_num_data = [data[slice_size:]]
+            print(chrom, starts[-1], slice_index)
+
+    if num_windows > slice_index:
+        slice_index = num_windows
+        save_dict = {
+            'data': np.concatenate(slice_seq_num_data),
+            'dict': word_dict
+        }
+        save_path = os.path.join(output_path,
+                                 '{}_seq_gram_{}_stride_{}_slice_{}.npz'.format(hg_name, str(ngram),
+                                                                                str(stride), str(slice_index)))
+        np.savez_compressed(save_path, **save_dict)
+        del slice_seq_num_data
 
 
 if __name__ == '__main__':
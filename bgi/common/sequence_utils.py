@@ -0,0 +1,123 @@
+import numpy as np
+
+# 与 refseq_utils.atcg_dict 一致: N=0, A=1, G=2, C=3, T=4
+N_CODE = 0
+PAD_CODE = 254
+INVALID_CODE = 255
+
+base_code_table = np.full(256, INVALID_CODE, dtype=np.uint8)
+for _base, _code in (('N', 0), ('A', 1), ('G', 2), ('C', 3), ('T', 4)):
+    base_code_table[ord(_base)] = _code
+    base_code_table[ord(_base.lower())] = _code
+
+SEQUENCE_POLICIES = ('drop', 'mask', 'keep')
+
+
+def sequence_to_codes(seq: str):
+    """
+    序列转换为 uint8 编码, 非 'NAGCT' 的字符编码为 INVALID_CODE
+    :param seq:
+    :return:
+    """
+    return base_code_table[np.frombuffer(seq.encode('ascii', errors='replace'), dtype=np.uint8)]
+
+
+def sequences_to_codes(sequences: list, seq_len: int = None):
+    """
+    批量转换为 (N, seq_len) 的 uint8 编码矩阵, 长度不足的部分补 PAD_CODE
+    :param sequences:
+    :param seq_len: 默认为最长序列的长度, 超出的部分被截断
+    :return: codes, lengths
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    if seq_len is None:
+        seq_len = int(lengths.max()) if len(lengths) > 0 else 0
+
+    codes = np.full((len(sequences), seq_len), PAD_CODE, dtype=np.uint8)
+    for ii, seq in enumerate(sequences):
+        seq_codes = sequence_to_codes(seq[:seq_len])
+        codes[ii, :len(seq_codes)] = seq_codes
+    return codes, np.minimum(lengths, seq_len)
+
+
+def longest_run_lengths(mask: np.ndarray):
+    """
+    每行中连续 True 的最长长度, 向量化计算
+    :param mask: (N, L) bool
+    :return: (N,) int
+    """
+    mask = np.atleast_2d(mask)
+    if mask.shape[1] == 0:
+        return np.zeros(mask.shape[0], dtype=np.int64)
+    counts = np.cumsum(mask, axis=1)
+    # 每个位置之前最后一个 False 处的累计数, 相减即为以该位置结尾的连续 True 的长度
+    run_starts = np.maximum.accumulate(np.where(mask, 0, counts), axis=1)
+    return (counts - run_starts).max(axis=1)
+
+
+def check_sequence_codes(codes: np.ndarray, policy: str = 'drop', max_n_fraction: float = 1.0,
+                         max_n_run_fraction: float = 1.0):
+    """
+    一次向量化检查所有窗口是否只包含 'ATCG'
+    :param codes: (N, L) uint8 编码矩阵, PAD_CODE 的位置不参与检查
+    :param policy: 'drop'  含非 'ATCG' 字符的窗口被丢弃
+                   'mask'  保留窗口, 由 mask_invalid_tokens 将覆盖非 'ATCG' 字符的 token 置为 0
+                   'keep'  保留窗口, 不做处理
+    :param max_n_fraction: 'mask'/'keep' 时, N 的总比例 (即所有 N-run 的总长度) 超过该值的窗口仍被丢弃
+    :param max_n_run_fraction: 'mask'/'keep' 时, 最长的连续 N (N-run) 占窗口的比例超过该值的窗口仍被丢弃,
+                               如 gap 区域边缘的窗口
+    :return: keep (N,) 是否保留; invalid (N, L) 非 'ATCG' 的位置; n_fraction (N,) N 的比例;
+             n_run_fraction (N,) 最长 N-run 的比例
+    """
+    if policy not in SEQUENCE_POLICIES:
+        raise ValueError("Unknown sequence policy '{}', expected one of {}".format(policy, SEQUENCE_POLICIES))
+
+    codes = np.atleast_2d(codes)
+    is_pad = codes == PAD_CODE
+    is_n = codes == N_CODE
+    invalid = (is_n | (codes > 4)) & ~is_pad
+
+    lengths = np.maximum(codes.shape[1] - is_pad.sum(axis=1), 1)
+    n_fraction = is_n.sum(axis=1) / lengths
+    n_run_fraction = longest_run_lengths(is_n) / lengths
+
+    if policy == 'drop':
+        keep = ~invalid.any(axis=1)
+    else:
+        keep = (n_fraction <= max_n_fraction) & (n_run_fraction <= max_n_run_fraction)
+    return keep, invalid, n_fraction, n_run_fraction
+
+
+def mask_invalid_tokens(tokens: np.ndarray, invalid: np.ndarray, ngram: int, stride: int = 1, mask_token: int = 0):
+    """
+    将覆盖了非 'ATCG' 位置的 n-gram token 置为 mask_token
+    :param tokens: (N, T), 第 jj 个 token 对应位置 [jj * stride, jj * stride + ngram)
+    :param invalid: (N, L), check_sequence_codes 返回的 invalid
+    :param ngram:
+    :param stride:
+    :param mask_token:
+    :return:
+    """
+    tokens = np.array(tokens, copy=True)
+    if tokens.shape[1] == 0:
+        return tokens
+
+    counts = np.zeros((invalid.shape[0], invalid.shape[1] + 1), dtype=np.int32)
+    np.cumsum(invalid, axis=1, out=counts[:, 1:])
+
+    token_starts = np.arange(tokens.shape[1]) * stride
+    token_ends = np.minimum(token_starts + ngram, invalid.shape[1])
+    token_starts = np.minimum(token_starts, invalid.shape[1])
+    masked = (counts[:, token_ends] - counts[:, token_starts]) > 0
+    tokens[masked] = mask_token
+    return tokens
+
+
+def is_atcg_sequence(seq: str):
+    """
+    单条序列是否只包含 'ATCG', 用于逐条处理的记录 (vcf_utils, CADD 的 process_raw_text); 批量的窗口用 check_sequence_codes
+    :param seq:
+    :return:
+    """
+    codes = sequence_to_codes(seq)
+    return bool(np.all((codes >= 1) & (codes <= 4)))
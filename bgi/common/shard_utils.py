@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# 定长 int16 token 分片:
+#   8 字节 TOKEN_SHARD_MAGIC | 4 字节小端 uint32 的头部长度 | JSON 头部 (以空格补齐到 64 字节对齐) | rows * width 个小端 int16
+# 头部包含 rows, width, ngram, stride, vocab_hash 等, 数据部分可直接 np.memmap, 无需解压即可随机读取任意行
+TOKEN_SHARD_SUFFIX = '.tokens'
+TOKEN_SHARD_MAGIC = b'BGITOKEN'
+TOKEN_SHARD_DTYPE = '<i2'
+_HEADER_ALIGN = 64
+
+
+def get_vocab_hash(word_dict: dict):
+    """
+    word_dict 的摘要, 用于检查分片与训练时的字典是否一致
+    :param word_dict:
+    :return:
+    """
+    if word_dict is None:
+        return None
+    items = sorted([(str(key), int(value)) for key, value in word_dict.items()])
+    return hashlib.md5(json.dumps(items).encode('utf-8')).hexdigest()
+
+
+def write_token_shard(path: str, data: np.ndarray, ngram: int, stride: int = 1, vocab_hash: str = None, **extra):
+    """
+    保存为定长 int16 分片, 先写入临时文件再重命名, 中断时不会留下不完整的分片
+    :param path:
+    :param data: (rows, width) token id, 必须在 int16 范围内
+    :param ngram:
+    :param stride:
+    :param vocab_hash: get_vocab_hash(word_dict)
+    :param extra: 其他写入头部的信息, 如 chrom, start
+    :return: header
+    """
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError("Token shard expects a 2-D array, got shape {}".format(data.shape))
+    info = np.iinfo(np.int16)
+    if data.size > 0 and (data.min() < info.min or data.max() > info.max):
+        raise ValueError("Token id out of int16 range: [{}, {}]".format(data.min(), data.max()))
+
+    header = {'rows': int(data.shape[0]), 'width': int(data.shape[1]), 'dtype': TOKEN_SHARD_DTYPE,
+              'ngram': int(ngram), 'stride': int(stride), 'vocab_hash': vocab_hash}
+    header.update(extra)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_size = len(TOKEN_SHARD_MAGIC) + 4 + len(header_bytes)
+    header_bytes += b' ' * (-header_size % _HEADER_ALIGN)
+
+    with open(path + '.tmp', mode='wb') as f:
+        f.write(TOKEN_SHARD_MAGIC)
+        f.write(np.uint32(len(header_bytes)).astype('<u4').tobytes())
+        f.write(header_bytes)
+        data.astype(TOKEN_SHARD_DTYPE).tofile(f)
+    os.replace(path + '.tmp', path)
+    return header
+
+
+def read_token_shard_header(path: str):
+    """
+    只读取头部
+    :param path:
+    :return: header, 其中 'offset' 为数据部分的起始位置
+    """
+    with open(path, mode='rb') as f:
+        magic = f.read(len(TOKEN_SHARD_MAGIC))
+        if magic != TOKEN_SHARD_MAGIC:
+            raise ValueError("Not a token shard: {}".format(path))
+        header_len = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    header['offset'] = len(TOKEN_SHARD_MAGIC) + 4 + header_len
+    return header
+
+
+def open_token_shard(path: str, mode: str = 'r'):
+    """
+    以 memmap 打开分片
+    :param path:
+    :param mode: np.memmap 的 mode
+    :return: data (rows, width) int16 memmap, header
+    """
+    header = read_token_shard_header(path)
+    if header['rows'] == 0:
+        return np.zeros((0, header['width']), dtype=header['dtype']), header
+    data = np.memmap(path, dtype=header['dtype'], mode=mode, offset=header['offset'],
+                     shape=(header['rows'], header['width']))
+    return data, header
+
+
+def iter_token_shard(path: str, batch_rows: int = 1024, columns=None, rows=None):
+    """
+    按批读取分片, 每次只读入 batch_rows 行
+    :param path:
+    :param batch_rows:
+    :param columns: 列的切片或下标, 如 slice(kk, max_len, ngram) 取第 kk 个 frame
+    :param rows: 只读取这些行 (如打乱后的行号), 默认按顺序读取全部
+    :return: (n, len(columns)) int16
+    """
+    data, header = open_token_shard(path)
+    if columns is None:
+        columns = slice(None)
+    if rows is None:
+        for start in range(0, header['rows'], batch_rows):
+            yield np.asarray(data[start:start + batch_rows, columns])
+    else:
+        rows = np.asarray(rows)
+        for start in range(0, len(rows), batch_rows):
+            yield np.asarray(data[rows[start:start + batch_rows]][:, columns])
+
+
+def load_token_shard(path: str, columns=None):
+    """
+    读取整个分片 (或其中的若干列) 到内存
+    :param path:
+    :param columns:
+    :return:
+    """
+    data, _ = open_token_shard(path)
+    if columns is None:
+        return np.array(data)
+    return np.array(data[:, columns])
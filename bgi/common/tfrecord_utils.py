@@ -0,0 +1,490 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+# 'NONE' 即不压缩, 本地 NVMe 上读取未压缩的 tfrecord 快得多
+TFRECORD_COMPRESSION_TYPES = ('GZIP', 'ZLIB', 'NONE')
+
+# token 序列在 tfrecord 中的两种格式:
+#   'int64' 每个 token 为 Int64List 中的一个值 (原格式), 读取时为 FixedLenFeature([L], tf.int64)
+#   'bytes' 整条序列为一个小端 uint16 的 bytes, 读取时为 FixedLenFeature([], tf.string) + tf.io.decode_raw
+# 字典的 id 不超过 16 位, 'bytes' 的记录约为 'int64' 的 1/4, 解析也更快
+TOKEN_SCHEMAS = ('int64', 'bytes')
+TOKEN_BYTES_DTYPE = '<u2'
+
+# 每条记录的额外开销: 8 字节长度 + 4 字节长度的 CRC + 4 字节数据的 CRC
+_RECORD_OVERHEAD = 16
+
+
+def get_compression_type(compression_type):
+    """
+    转为 tf.io.TFRecordOptions / TFRecordDataset 使用的压缩类型, None 和 'NONE' 为 ''
+    :param compression_type: 'GZIP', 'ZLIB', 'NONE', '' 或 None
+    :return:
+    """
+    if compression_type is None or compression_type == '':
+        return ''
+    compression_type = str(compression_type).upper()
+    if compression_type not in TFRECORD_COMPRESSION_TYPES:
+        raise ValueError("Unknown compression type '{}', expected one of {}".format(compression_type,
+                                                                                   TFRECORD_COMPRESSION_TYPES))
+    return '' if compression_type == 'NONE' else compression_type
+
+
+def int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+
+
+def token_bytes_feature(values):
+    """
+    一条 token 序列保存为一个小端 uint16 的 bytes
+    :param values: token id, 必须在 [0, 65535] 范围内
+    :return:
+    """
+    values = np.asarray(values)
+    if values.size > 0 and (values.min() < 0 or values.max() > np.iinfo(np.uint16).max):
+        raise ValueError("Token id out of uint16 range: [{}, {}]".format(values.min(), values.max()))
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[values.astype(TOKEN_BYTES_DTYPE).tobytes()]))
+
+
+def create_token_feature(values, token_schema='int64'):
+    """
+    :param values: 一条 token 序列
+    :param token_schema: 'int64' 或 'bytes'
+    :return:
+    """
+    if token_schema == 'int64':
+        return int64_feature(values)
+    if token_schema == 'bytes':
+        return token_bytes_feature(values)
+    raise ValueError("Unknown token schema '{}', expected one of {}".format(token_schema, TOKEN_SCHEMAS))
+
+
+def get_token_feature_spec(sequence_length: int, token_schema='int64'):
+    """
+    tf.io.parse_single_example / parse_example 中 token 序列的 feature
+    :param sequence_length:
+    :param token_schema:
+    :return:
+    """
+    if token_schema == 'int64':
+        return tf.io.FixedLenFeature([sequence_length], tf.int64)
+    if token_schema == 'bytes':
+        return tf.io.FixedLenFeature([], tf.string)
+    raise ValueError("Unknown token schema '{}', expected one of {}".format(token_schema, TOKEN_SCHEMAS))
+
+
+def decode_token_feature(value, sequence_length: int, token_schema='int64'):
+    """
+    将 get_token_feature_spec 解析出的 feature 转为 int64 的 token 序列, 两种格式的结果相同
+    :param value: 单条记录为 [] 的 tf.string, 按 batch 解析时为 [batch_size]
+    :param sequence_length:
+    :param token_schema:
+    :return: [sequence_length] 或 [batch_size, sequence_length] int64
+    """
+    if token_schema == 'int64':
+        return value
+    tokens = tf.io.decode_raw(value, tf.uint16, little_endian=True)
+    tokens = tf.cast(tokens, tf.int64)
+    if value.shape.rank == 0:
+        return tf.reshape(tokens, [sequence_length])
+    return tf.reshape(tokens, [-1, sequence_length])
+
+
+def get_tfrecord_index_path(record_name: str):
+    """
+    x.tfrecord 的索引为 x.index.json, 不会被按 '.tfrecord' 后缀查找文件的代码读到
+    """
+    return os.path.splitext(record_name)[0] + '.index.json'
+
+
+def load_tfrecord_index(record_name: str):
+    """
+    读取 TFRecordShardWriter 写入的索引
+    :param record_name: 写入时的 record_name
+    :return: {'compression_type', 'examples', 'shards': [{'file', 'examples', 'bytes', 'file_bytes'}, ...]},
+             没有索引时返回 None
+    """
+    index_path = get_tfrecord_index_path(record_name)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, mode='r') as f:
+        return json.load(f)
+
+
+def _fsync_file(path: str):
+    # 远程文件系统 (gs://, hdfs://) 上的文件由 tf.io 负责
+    if not os.path.exists(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TFRecordShardWriter(object):
+    """
+    边生成边写入的 tfrecord writer, 达到目标大小 (或记录数) 时切换到新的分片,
+    关闭时 flush/close/fsync 每个分片, 并写入记录每个分片样本数的索引 (get_tfrecord_index_path)
+
+    不分片时只写入 record_name 一个文件; 分片时文件名为 x-00000.tfrecord, x-00001.tfrecord, ...
+
+        with TFRecordShardWriter(record_name, compression_type='NONE', max_shard_bytes=256 << 20) as writer:
+            for example in examples:
+                writer.write(example.SerializeToString())
+    """
+
+    def __init__(self, record_name: str, compression_type='ZLIB', max_shard_bytes: int = None,
+                 max_shard_examples: int = None):
+        """
+        :param record_name:
+        :param compression_type: 'GZIP', 'ZLIB' 或 'NONE'
+        :param max_shard_bytes: 每个分片未压缩的目标大小, None 或 0 为不按大小分片
+        :param max_shard_examples: 每个分片的最大记录数, None 或 0 为不按记录数分片
+        """
+        self.record_name = record_name
+        self.compression_type = get_compression_type(compression_type)
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_examples = max_shard_examples
+        self.shards = []
+        self._writer = None
+        self._closed = False
+
+    def get_shard_name(self, shard_index: int):
+        if not self.max_shard_bytes and not self.max_shard_examples:
+            return self.record_name
+        name, ext = os.path.splitext(self.record_name)
+        return '{}-{:05d}{}'.format(name, shard_index, ext)
+
+    def _open_shard(self):
+        shard_name = self.get_shard_name(len(self.shards))
+        options = tf.io.TFRecordOptions(compression_type=self.compression_type)
+        self._writer = tf.io.TFRecordWriter(shard_name, options)
+        self.shards.append({'file': os.path.basename(shard_name), 'examples': 0, 'bytes': 0})
+
+    def _close_shard(self):
+        self._writer.flush()
+        self._writer.close()
+        self._writer = None
+
+        shard = self.shards[-1]
+        shard_name = os.path.join(os.path.dirname(self.record_name), shard['file'])
+        _fsync_file(shard_name)
+        if os.path.exists(shard_name):
+            shard['file_bytes'] = os.path.getsize(shard_name)
+
+    def _is_full(self):
+        shard = self.shards[-1]
+        if self.max_shard_examples and shard['examples'] >= self.max_shard_examples:
+            return True
+        if self.max_shard_bytes and shard['bytes'] >= self.max_shard_bytes:
+            return True
+        return False
+
+    def write(self, serialized: bytes):
+        if self._closed:
+            raise ValueError("Write to a closed writer: {}".format(self.record_name))
+
+        if self._writer is None:
+            self._open_shard()
+        elif self._is_full():
+            self._close_shard()
+            self._open_shard()
+
+        self._writer.write(serialized)
+        self.shards[-1]['examples'] += 1
+        self.shards[-1]['bytes'] += len(serialized) + _RECORD_OVERHEAD
+
+    def close(self):
+        """
+        关闭最后一个分片并写入索引, 没有任何记录时也会生成一个空文件
+        :return: 分片列表
+        """
+        if self._closed:
+            return self.shards
+
+        if self._writer is None and len(self.shards) == 0:
+            self._open_shard()
+        if self._writer is not None:
+            self._close_shard()
+
+        index = {
+            'compression_type': self.compression_type if self.compression_type != '' else 'NONE',
+            'examples': sum([shard['examples'] for shard in self.shards]),
+            'shards': self.shards,
+        }
+        index_path = get_tfrecord_index_path(self.record_name)
+        with open(index_path + '.tmp', mode='w') as f:
+            json.dump(index, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+
+        self._closed = True
+        return self.shards
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def write_to_tfrecord(record_name, serialized_instances, compression_type='ZLIB', max_shard_bytes: int = None,
+                      max_shard_examples: int = None):
+    """
+    将序列化的记录逐条写入 (可以是生成器), 写完后关闭
+    :param record_name:
+    :param serialized_instances:
+    :param compression_type:
+    :param max_shard_bytes:
+    :param max_shard_examples:
+    :return: 分片列表
+    """
+    with TFRecordShardWriter(record_name, compression_type=compression_type, max_shard_bytes=max_shard_bytes,
+                             max_shard_examples=max_shard_examples) as writer:
+        for serialized_instance in serialized_instances:
+            writer.write(serialized_instance)
+    return writer.shards
+
+
+def load_compression_type(record_names):
+    """
+    判断 tfrecord 的压缩类型: 先找 TFRecordShardWriter 的索引, 没有时尝试读取第一条记录; 空文件跳过
+    :param record_names: 一个或多个 tfrecord 文件, 同一组文件的压缩类型应相同
+    :return: '', 'GZIP' 或 'ZLIB'
+    """
+    if not isinstance(record_names, (list, tuple)):
+        record_names = [record_names]
+
+    for record_name in record_names:
+        index = load_tfrecord_index(record_name)
+        if index is not None:
+            return get_compression_type(index['compression_type'])
+
+        readable = False
+        for ct in TFRECORD_COMPRESSION_TYPES:
+            try:
+                for _ in tf.data.TFRecordDataset(record_name, compression_type=get_compression_type(ct)).take(1):
+                    return get_compression_type(ct)
+                readable = True
+            except (tf.errors.DataLossError, tf.errors.InvalidArgumentError):
+                continue
+        if readable is False:
+            raise ValueError("Can not read tfrecord: {}".format(record_name))
+    return ''
+
+
+def _read_first_example(record_name: str, compression_type=None):
+    """
+    读取第一条记录
+    :return: tf.train.Example, 文件为空时返回 None
+    """
+    if compression_type is None:
+        compression_type = load_compression_type(record_name)
+    dataset = tf.data.TFRecordDataset(record_name, compression_type=get_compression_type(compression_type))
+    for serialized in dataset.take(1):
+        return tf.train.Example.FromString(serialized.numpy())
+    return None
+
+
+def load_tfrecord_dataset(record_names,
+                          parse_function,
+                          batch_size: int,
+                          compression_type=None,
+                          shuffle_size: int = 0,
+                          repeat: bool = False,
+                          deterministic: bool = True,
+                          cycle_length: int = None,
+                          block_length: int = 1,
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                          drop_remainder: bool = False,
+                          cache: str = None,
+                          prefetch_buffer_size=tf.data.experimental.AUTOTUNE,
+                          seed: int = None):
+    """
+    读取 tfrecord 的 tf.data 流水线: 并行 interleave 多个文件 -> (cache) -> (repeat) -> (shuffle) -> 先 batch
+    -> 用 parse_function 对整个 batch 解析 -> prefetch.
+    parse_function 的输入为 [batch_size] 的 tf.string, 应使用 tf.io.parse_example 一次解析整个 batch,
+    替代每条记录一次 tf.io.parse_single_example 的 map, 多核 CPU 上不再受限于解析速度
+
+        def parse_function(serialized):
+            features = tf.io.parse_example(serialized, {'x': get_token_feature_spec(seq_len, token_schema)})
+            x = decode_token_feature(features['x'], seq_len, token_schema)
+            return {'Input-Token': x, 'Input-Segment': tf.zeros_like(x)}
+
+    :param record_names: 一个或多个 tfrecord 文件
+    :param parse_function: 解析一个 batch 的函数
+    :param batch_size:
+    :param compression_type: 默认由 load_compression_type 判断
+    :param shuffle_size: 打乱的 buffer 大小 (记录数), 0 为不打乱; 打乱时文件的顺序也会打乱
+    :param repeat: 无限重复, 用于训练
+    :param deterministic: False 时允许 interleave/map 按完成的先后输出, 吞吐更高但顺序不固定
+    :param cycle_length: 同时读取的文件数, 默认由 tf.data 根据 CPU 核数决定
+    :param block_length: 每个文件连续读取的记录数
+    :param num_parallel_calls: interleave 和解析的并行数
+    :param drop_remainder: 丢弃最后不足 batch_size 的 batch
+    :param cache: None 为不缓存; '' 或 'memory' 缓存在内存; 其他为缓存文件的路径. 缓存的是未解析的记录
+    :param prefetch_buffer_size: 预取的 batch 数, None 或 0 为不预取
+    :param seed: 打乱的随机种子
+    :return:
+    """
+    if not isinstance(record_names, (list, tuple)):
+        record_names = [record_names]
+    if len(record_names) == 0:
+        raise ValueError("No tfrecord files to load")
+    if compression_type is None:
+        compression_type = load_compression_type(record_names)
+    compression_type = get_compression_type(compression_type)
+
+    dataset = tf.data.Dataset.from_tensor_slices(list(record_names))
+    if shuffle_size > 0:
+        dataset = dataset.shuffle(len(record_names), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.interleave(lambda record_name: tf.data.TFRecordDataset(record_name,
+                                                                             compression_type=compression_type),
+                                 cycle_length=cycle_length if cycle_length is not None else tf.data.experimental.AUTOTUNE,
+                                 block_length=block_length,
+                                 num_parallel_calls=num_parallel_calls)
+
+    if cache is not None:
+        dataset = dataset.cache('' if cache == 'memory' else cache)
+    if repeat is True:
+        dataset = dataset.repeat()
+    if shuffle_size > 0:
+        dataset = dataset.shuffle(shuffle_size, seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    dataset = dataset.map(parse_function, num_parallel_calls=num_parallel_calls)
+    if prefetch_buffer_size:
+        dataset = dataset.prefetch(prefetch_buffer_size)
+
+    # TF 2.0 中 interleave/map 还没有 deterministic 参数
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    return dataset.with_options(options)
+
+
+def get_example_token_schema(example, feature_key: str):
+    """
+    :param example: tf.train.Example
+    :param feature_key:
+    :return: 'int64' 或 'bytes'
+    """
+    kind = example.features.feature[feature_key].WhichOneof('kind')
+    if kind == 'int64_list':
+        return 'int64'
+    if kind == 'bytes_list':
+        return 'bytes'
+    raise ValueError("Feature '{}' is not a token sequence: {}".format(feature_key, kind))
+
+
+def detect_token_schema(record_names, feature_key: str, compression_type=None, default='int64'):
+    """
+    读取第一条非空记录, 判断 token 序列是 'int64' 还是 'bytes' 格式, 读取时据此选择 feature
+    :param record_names: 一个或多个 tfrecord 文件, 同一组文件的格式应相同
+    :param feature_key: token 序列的 key, 如 'sequence', 'x', 'seq'
+    :param compression_type: 默认由 load_compression_type 判断
+    :param default: 所有文件都为空时返回的格式
+    :return:
+    """
+    if not isinstance(record_names, (list, tuple)):
+        record_names = [record_names]
+    for record_name in record_names:
+        example = _read_first_example(record_name, compression_type)
+        if example is not None:
+            return get_example_token_schema(example, feature_key)
+    return default
+
+
+def convert_example_token_schema(example, token_keys, token_schema='bytes'):
+    """
+    将 tf.train.Example 中的 token 序列转为 token_schema 格式, 其他 feature 不变
+    :param example: tf.train.Example, 原地修改
+    :param token_keys: token 序列的 key
+    :param token_schema:
+    :return: example
+    """
+    for key in token_keys:
+        if key not in example.features.feature:
+            continue
+        feature = example.features.feature[key]
+        if get_example_token_schema(example, key) == 'int64':
+            values = np.asarray(feature.int64_list.value, dtype=np.int64)
+        else:
+            values = np.frombuffer(feature.bytes_list.value[0], dtype=TOKEN_BYTES_DTYPE)
+        feature.CopyFrom(create_token_feature(values, token_schema))
+    return example
+
+
+def convert_tfrecord_token_schema(input_file: str, output_file: str, token_keys, token_schema='bytes',
+                                  input_compression_type=None, compression_type='ZLIB',
+                                  max_shard_bytes: int = None):
+    """
+    将已有的 tfrecord 转为另一种 token 格式, 逐条读取并写入
+    :param input_file:
+    :param output_file:
+    :param token_keys: token 序列的 key, 标签等其他 feature 保持不变
+    :param token_schema: 'bytes' 或 'int64'
+    :param input_compression_type: 输入的压缩类型, 默认自动判断
+    :param compression_type: 输出的压缩类型
+    :param max_shard_bytes:
+    :return: 分片列表
+    """
+    if input_compression_type is None:
+        input_compression_type = load_compression_type(input_file)
+
+    def serialized_instances():
+        dataset = tf.data.TFRecordDataset(input_file, compression_type=get_compression_type(input_compression_type))
+        for serialized in dataset:
+            example = tf.train.Example.FromString(serialized.numpy())
+            example = convert_example_token_schema(example, token_keys, token_schema)
+            yield example.SerializeToString()
+
+    return write_to_tfrecord(output_file, serialized_instances(), compression_type=compression_type,
+                             max_shard_bytes=max_shard_bytes)
+
+
+if __name__ == '__main__':
+    # 将已有的 tfrecord 转为 'bytes' (或转回 'int64') 格式:
+    #   python tfrecord_utils.py --data ./tfrecord --output ./tfrecord_bytes --keys masked_sequence,sequence
+    _argparser = argparse.ArgumentParser(
+        description='Convert token features of tfrecords between the int64 and the uint16 bytes schema',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    _argparser.add_argument(
+        '--data', type=str, required=True, metavar='PATH',
+        help='A tfrecord file or a path of tfrecord files')
+    _argparser.add_argument(
+        '--output', type=str, required=True, metavar='PATH',
+        help='A path which save converted files')
+    _argparser.add_argument(
+        '--keys', type=str, default='masked_sequence,sequence', metavar='NAME',
+        help='Token features to convert, e.g. "x" for DeepSEA, "seq,alt_seq,alt_type" for CADD')
+    _argparser.add_argument(
+        '--token-schema', type=str, default='bytes', choices=TOKEN_SCHEMAS,
+        help='Schema of the converted token features')
+    _argparser.add_argument(
+        '--compression', type=str, default='ZLIB', choices=TFRECORD_COMPRESSION_TYPES,
+        help='Compression of the converted files')
+
+    _args = _argparser.parse_args()
+
+    if os.path.isdir(_args.data):
+        input_files = [os.path.join(_args.data, file_name) for file_name in sorted(os.listdir(_args.data))
+                       if str(file_name).endswith('.tfrecord')]
+    else:
+        input_files = [_args.data]
+
+    if os.path.exists(_args.output) is False:
+        os.makedirs(_args.output)
+
+    token_keys = [key.strip() for key in _args.keys.split(',') if len(key.strip()) > 0]
+    for input_file in input_files:
+        output_file = os.path.join(_args.output, os.path.basename(input_file))
+        convert_tfrecord_token_schema(input_file, output_file, token_keys, token_schema=_args.token_schema,
+                                      compression_type=_args.compression)
+        print("Save: ", output_file)
@@ -10,6 +10,7 @@ from pyfaidx import Fasta
 
 sys.path.append("../../")
 from bgi.common.genebank_utils import get_gene_feature_array, get_refseq_gff
+from bgi.common.sequence_utils import is_atcg_sequence
 
 fasta = 'D:\\Genomics\\Data\\Hg38\\GCF_000001405.25_GRCh37.p13_genomic.fna'
 fasta = '/data/huadajiyin/data/hg19/GCF_000001405.25_GRCh37.p13_genomic.fna'
@@ -171,7 +172,6 @@ def extract_variant_seq(loc, orient, chr, chr_gff_dict, name='', padding_seq_len
 
     alt_seq = str(genome[chr][max(start,0):(end + alt_shift_seq_len)])
     alt_seq = alt_seq.upper()
-    set_atcg = set(list('ATCG'))
 
     # if orient == '-':
     #     reverse_seq = Seq(promoter, generic_dna)
@@ -180,12 +180,7 @@ def extract_variant_seq(loc, orient, chr, chr_gff_dict, name='', padding_seq_len
     seq = seq.upper()
 
     # 检查是否不是 ‘ATCG’的字符
-    set_seq = set(list(seq))
-    is_atcg = True
-    for atcg in set_seq:
-        if atcg not in set_atcg:
-            is_atcg = False
-    if is_atcg is False:
+    if is_atcg_sequence(seq) is False:
         return None, None, None
 
     annotations = get_gene_feature_array(chr_gff_dict, chr, start, end)
@@ -543,7 +538,7 @@ if __name__ == '__main__':
 
 
     # 标注特征文件
-    chr_gff_dict = get_refseq_gff(gff_file, include_types)
+    chr_gff_dict = get_refseq_gff(gff_file, include_types, use_index=True)
 
     chr_convert_dict = {}
     for k, v in chr_dict.items():
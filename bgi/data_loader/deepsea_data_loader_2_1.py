@@ -1,12 +1,16 @@
 # -*- coding:utf-8 -*-
 
 import pickle
+import sys
 
 import h5py
 import numpy as np
 import scipy.io as sio
 from tqdm import tqdm
 
+sys.path.append("../../")
+from bgi.common.kmer_utils import get_kmer_lookup_table, number_codes_to_kmer_ids
+
 
 def save_obj(obj, name):
     with open(name, 'wb') as f:
@@ -16,68 +20,6 @@ def load_obj(name):
     with open(name, 'rb') as f:
         return pickle.load(f)
 
-def get_word_dict_5gram(word_index_from=3):
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        # print(int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t), (n + a + g + c + t))
-                        word_dict[int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t)] = index
-                        index += 1
-    return word_dict
-
-
-
-
-def get_word_dict_6gram(word_index_from=3):
-    N = [0, 1, 2, 3, 4]
-
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-    # 从3开始
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        S = N
-                        for s in S:
-                            # print(n+a+g+c+t+s)
-                            # dict_list.append(n+a+g+c+t+s)
-                            # word_dict[n + a + g + c + t + s] = index
-                            word_dict[int(n * 10 ** 5 + a * 10 ** 4 + g * 10 ** 3 + c * 10 ** 2 + t * 10 ** 1 + s)] = index
-                            index += 1
-    return word_dict
-
-
-
-
 def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='valid.mat', test_path='test.mat',
                                          dict_path="../../data/word_dict_5gram.pkl", step=1, n_gram=5, shuffle=False,
                                          break_in_10w=True, **kwargs):
@@ -112,14 +54,11 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
     print("n_gram_value: ", n_gram_value)
 
     word_index_from = 3
-    num_word_dict = get_word_dict_6gram(word_index_from)
+    # 与原 get_word_dict_6gram(word_index_from) 的 id 一致
+    kmer_lut = get_kmer_lookup_table(6, word_index_from=word_index_from, layout='full')
 
-    print("num_word_dict: ", len(num_word_dict))
-    print("num_word_dict: ", num_word_dict.get(0))
-    print("num_word_dict: ", num_word_dict.get(1))
-    print("num_word_dict: ", num_word_dict.get(2))
-    print("num_word_dict: ", num_word_dict.get(3))
-    print("num_word_dict: ", num_word_dict.get(4))
+    print("kmer_lut: ", len(kmer_lut))
+    print("kmer_lut: ", kmer_lut[:5])
 
     x_train = []
     y_train = []
@@ -162,16 +101,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
                     #gene.append(num_word_dict.get(actg_temp_value, 0))
                     # print(gene)
                 else:
-                    for kk in range(0, len(actg), step):
-                        actg_temp_value = 0
-                        if kk + n_gram <= len(actg):
-                            actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                            actg_temp_value = int(actg_temp_value)
-                        else:
-                            for gg in range(kk, len(actg)):
-                                actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                            actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-                        gene.append(num_word_dict.get(actg_temp_value, 0))
+                    gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=word_index_from, layout='full', vocab_n_gram=6)
                 x_train.append(np.array(gene))
                 y_train.append(slice_label[:, jj])
 
@@ -246,18 +176,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
             actg = np.matmul(actg_value, data[ii, :, :])
 
             # for ss in range(n_gram):
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=word_index_from, layout='full', vocab_n_gram=6)
 
 
             x_test.append(np.array(gene))
@@ -329,18 +248,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
         for ii in range(data.shape[0]):
             actg = np.matmul(actg_value, data[ii, :, :])
 
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=word_index_from, layout='full', vocab_n_gram=6)
 
             # if len(gene) != labels.shape[1]:
             #    print("请注意，长度非1000")
@@ -1,12 +1,16 @@
 # -*- coding:utf-8 -*-
 
 import pickle
+import sys
 
 import h5py
 import numpy as np
 import scipy.io as sio
 from tqdm import tqdm
 
+sys.path.append("../../")
+from bgi.common.kmer_utils import get_kmer_lookup_table
+
 
 def save_obj(obj, name):
     with open(name, 'wb') as f:
@@ -16,68 +20,6 @@ def load_obj(name):
     with open(name, 'rb') as f:
         return pickle.load(f)
 
-def get_word_dict_5gram(word_index_from=3):
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        # print(int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t), (n + a + g + c + t))
-                        word_dict[int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t)] = index
-                        index += 1
-    return word_dict
-
-
-
-
-def get_word_dict_6gram(word_index_from=3):
-    N = [0, 1, 2, 3, 4]
-
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-    # 从3开始
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        S = N
-                        for s in S:
-                            # print(n+a+g+c+t+s)
-                            # dict_list.append(n+a+g+c+t+s)
-                            # word_dict[n + a + g + c + t + s] = index
-                            word_dict[int(n * 10 ** 5 + a * 10 ** 4 + g * 10 ** 3 + c * 10 ** 2 + t * 10 ** 1 + s)] = index
-                            index += 1
-    return word_dict
-
-
-
-
 def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='valid.mat', test_path='test.mat',
                                          dict_path="../../data/word_dict_5gram.pkl", step=1, n_gram=5, shuffle=False,
                                          break_in_10w=True, **kwargs):
@@ -112,14 +54,11 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
     print("n_gram_value: ", n_gram_value)
 
     word_index_from = 3
-    num_word_dict = get_word_dict_6gram(word_index_from)
-
-    print("num_word_dict: ", len(num_word_dict))
-    print("num_word_dict: ", num_word_dict.get(0))
-    print("num_word_dict: ", num_word_dict.get(1))
-    print("num_word_dict: ", num_word_dict.get(2))
-    print("num_word_dict: ", num_word_dict.get(3))
-    print("num_word_dict: ", num_word_dict.get(4))
+    # 与原 get_word_dict_6gram(word_index_from) 的 id 一致
+    kmer_lut = get_kmer_lookup_table(6, word_index_from=word_index_from, layout='full')
+
+    print("kmer_lut: ", len(kmer_lut))
+    print("kmer_lut: ", kmer_lut[:5])
 
     x_train = []
     y_train = []
@@ -18,66 +18,6 @@ def load_obj(name):
     with open(name, 'rb') as f:
         return pickle.load(f)
 
-def get_word_dict_5gram(word_index_from=3):
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        # print(int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t), (n + a + g + c + t))
-                        word_dict[int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t)] = index
-                        index += 1
-    return word_dict
-
-
-
-
-def get_word_dict_6gram(word_index_from=3):
-    N = [0, 1, 2, 3, 4]
-
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-    # 从3开始
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        S = N
-                        for s in S:
-                            # print(n+a+g+c+t+s)
-                            # dict_list.append(n+a+g+c+t+s)
-                            # word_dict[n + a + g + c + t + s] = index
-                            word_dict[int(n * 10 ** 5 + a * 10 ** 4 + g * 10 ** 3 + c * 10 ** 2 + t * 10 ** 1 + s)] = index
-                            index += 1
-    return word_dict
-
-
 def get_word_dict_for_n_gram(word_index_from=3, n_gram:int=6, alphabet:list=['A','C','T','G','U'], predefined_tokens:list=[]):
     word_dict = {}
 
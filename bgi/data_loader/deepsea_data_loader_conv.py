@@ -1,6 +1,7 @@
 # -*- coding:utf-8 -*-
 
 import pickle
+import sys
 
 import h5py
 import numpy as np
@@ -9,6 +10,9 @@ from tqdm import tqdm
 
 from multiprocessing import Pool
 
+sys.path.append("../../")
+from bgi.common.kmer_utils import get_kmer_lookup_table, number_codes_to_kmer_ids
+
 
 def save_obj(obj, name):
     with open(name, 'wb') as f:
@@ -18,68 +22,7 @@ def load_obj(name):
     with open(name, 'rb') as f:
         return pickle.load(f)
 
-def get_word_dict_5gram(word_index_from=3):
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        # print(int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t), (n + a + g + c + t))
-                        word_dict[int(n * 10**4 + a * 10**3 + g * 10**2 + c * 10**1 + t)] = index
-                        index += 1
-    return word_dict
-
-
-
-
-def get_word_dict_6gram(word_index_from=3):
-    N = [0, 1, 2, 3, 4]
-
-    word_dict = {}
-    N = [0, 1, 2, 3, 4]
-    # 从3开始
-    index = word_index_from
-    for n in N:
-        # print(n)
-        A = N
-        for a in A:
-            # print(n+a)
-            G = N
-            for g in G:
-                # print(n+a+g)
-                C = N
-                for c in C:
-                    # print(n+a+g+c)
-                    T = N
-                    for t in T:
-                        # print(n+a+g+c+t)
-                        # dict_list.append(n+a+g+c+t)
-                        S = N
-                        for s in S:
-                            # print(n+a+g+c+t+s)
-                            # dict_list.append(n+a+g+c+t+s)
-                            # word_dict[n + a + g + c + t + s] = index
-                            word_dict[int(n * 10 ** 5 + a * 10 ** 4 + g * 10 ** 3 + c * 10 ** 2 + t * 10 ** 1 + s)] = index
-                            index += 1
-    return word_dict
-
-
-
-def preccess_data(slice, slice_index, actg_value, step, n_gram,  n_gram_value, num_word_dict, train_counter, train_path):
+def preccess_data(slice, slice_index, actg_value, step, n_gram,  n_gram_value, kmer_lut, train_counter, train_path):
 
     loaded = h5py.File(train_path, 'r')
     data = loaded['trainxdata']
@@ -108,20 +51,7 @@ def preccess_data(slice, slice_index, actg_value, step, n_gram,  n_gram_value, n
         actg = np.matmul(slice_data[:, :, jj], actg_value)
 
         # for ss in range(n_gram):
-        gene = []
-        for kk in range(0, len(actg), step):
-            actg_temp_value = 0
-            if kk + n_gram <= len(actg):
-                actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                actg_temp_value = int(actg_temp_value)
-            else:
-                for gg in range(kk, len(actg)):
-                    actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-
-                # print("10 ** (kk % n_gram): ", 10 ** (kk % n_gram))
-                actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-            gene.append(num_word_dict.get(actg_temp_value, 0))
+        gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=3, layout='full', vocab_n_gram=6)
 
         x_train.append(np.array(gene))
         y_train.append(slice_label[:, jj])
@@ -178,7 +108,8 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
         print(10 ** (n_gram - ii - 1))
     print("n_gram_value: ", n_gram_value)
 
-    num_word_dict = get_word_dict_6gram()
+    # 与原 get_word_dict_6gram() 的 id 一致
+    kmer_lut = get_kmer_lookup_table(6, word_index_from=3, layout='full')
 
 
     if train_path is not None:
@@ -198,7 +129,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
         for ii in range(int(data.shape[2]/slice)):
             if ii != 4:
                 continue
-            pool.apply_async(preccess_data, args=(slice, ii, actg_value, step, n_gram,  n_gram_value, num_word_dict, ii, train_path))
+            pool.apply_async(preccess_data, args=(slice, ii, actg_value, step, n_gram,  n_gram_value, kmer_lut, ii, train_path))
 
         pool.close()
         pool.join()
@@ -219,18 +150,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
             actg = np.matmul(actg_value, data[ii, :, :])
 
             # for ss in range(n_gram):
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=3, layout='full', vocab_n_gram=6)
 
 
             x_test.append(np.array(gene))
@@ -302,18 +222,7 @@ def load_data_step_bitf_1000index_1000bp(train_path='train.mat', valid_path='val
         for ii in range(data.shape[0]):
             actg = np.matmul(actg_value, data[ii, :, :])
 
-            gene = []
-            for kk in range(0, len(actg), step):
-                actg_temp_value = 0
-                if kk + n_gram <= len(actg):
-                    actg_temp_value = np.dot(actg[kk:kk + n_gram], n_gram_value)
-                    actg_temp_value = int(actg_temp_value)
-                else:
-                    for gg in range(kk, len(actg)):
-                        actg_temp_value += actg[gg] * (10 ** (n_gram - gg % n_gram - 1))
-                    actg_temp_value = actg_temp_value * (10 ** (kk % n_gram))
-
-                gene.append(num_word_dict.get(actg_temp_value, 0))
+            gene = number_codes_to_kmer_ids(actg, kmer_lut, n_gram, step, word_index_from=3, layout='full', vocab_n_gram=6)
 
             # if len(gene) != labels.shape[1]:
             #    print("请注意，长度非1000")